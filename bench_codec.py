@@ -0,0 +1,49 @@
+"""
+Micro-benchmark of rpcudp.codec against the generic umsgpack it falls back
+to, on the frames a node sends most.
+
+Usage: python3 bench_codec.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+from rpcudp import codec
+from rpcudp import umsgpack
+
+
+def frames():
+    node_id = os.urandom(20)
+    key = os.urandom(20)
+    contacts = [(os.urandom(20), '10.0.0.%i' % i, 9000 + i)
+                for i in range(20)]
+    return {
+        'ping': ['ping', (node_id,)],
+        'find_node': ['find_node', (node_id, key)],
+        'find_node response': contacts,
+        'store': ['store', (node_id, key, 'tag', 'file.txt',
+                            os.urandom(1024), True)],
+        'find_value response': {'value': os.urandom(4096)},
+    }
+
+
+def run(number):
+    print("%-20s %12s %12s %12s %12s" % ('frame', 'packb', 'codec',
+                                         'unpackb', 'codec'))
+    for name, frame in frames().items():
+        data = umsgpack.packb(frame)
+        assert codec.packb(frame) == data
+        timings = [
+            timeit.timeit(lambda: umsgpack.packb(frame), number=number),
+            timeit.timeit(lambda: codec.packb(frame), number=number),
+            timeit.timeit(lambda: umsgpack.unpackb(data), number=number),
+            timeit.timeit(lambda: codec.unpackb(data), number=number),
+        ]
+        usecs = ["%9.2f us" % (t / number * 1e6) for t in timings]
+        print("%-20s %12s %12s %12s %12s" % (name, *usecs))
+        print("%-20s %12s %11.1fx %12s %11.1fx" % (
+            '', '', timings[0] / timings[1], '', timings[2] / timings[3]))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,85 @@
+"""
+Micro-benchmarks of RoutingTable.get_bucket_for as the table grows, which
+should cost about the same with 10 buckets as with hundreds, and of the
+ContactIndex lookup behind find_neighbors against sorting every contact
+and against the bulk distance kernel.
+
+Usage: python3 bench_routing.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+import distance
+from node import Node
+from routing import ContactIndex, RoutingTable
+
+
+def table(buckets):
+    router = RoutingTable(None, 20, Node(os.urandom(20)))
+    while len(router.buckets) < buckets:
+        # split the widest bucket, like a table that saw a spread of ids
+        index = max(range(len(router.buckets)),
+                    key=lambda i: router.buckets[i].range[1] -
+                    router.buckets[i].range[0])
+        router.split_bucket(index)
+    return router
+
+
+def run(number):
+    print("%8s %14s" % ('buckets', 'get_bucket_for'))
+    nodes = [Node(os.urandom(20)) for _ in range(1000)]
+    for size in (1, 10, 50, 100, 200, 400, 800):
+        router = table(size)
+        for node in nodes:
+            index = router.get_bucket_for(node)
+            assert router.buckets[index].has_in_range(node)
+        elapsed = timeit.timeit(
+            lambda: [router.get_bucket_for(node) for node in nodes],
+            number=number)
+        print("%8i %11.3f us" % (size, elapsed / number / len(nodes) * 1e6))
+
+    print()
+    print("%8s %14s %14s" % ('contacts', 'closest', 'sorted'))
+    targets = [node.long_id for node in nodes[:100]]
+    for size in (100, 1000, 5000, 20000):
+        index = ContactIndex()
+        for _ in range(size):
+            index.add(Node(os.urandom(20)))
+        contacts = list(index.nodes.values())
+        timings = [
+            timeit.timeit(lambda: [index.closest(target, 20)
+                                   for target in targets], number=number),
+            timeit.timeit(lambda: [sorted(contacts, key=lambda n, t=target:
+                                          n.long_id ^ t)[:20]
+                                   for target in targets], number=number),
+        ]
+        usecs = ["%11.3f us" % (t / number / len(targets) * 1e6)
+                 for t in timings]
+        print("%8i %14s %14s" % (size, *usecs))
+
+    print()
+    print("%8s %14s %14s" % ('contacts', 'closest', 'kernel'))
+    targets = [node.long_id for node in nodes]
+    for size in (50, 200, 1000, 5000):
+        index = ContactIndex()
+        for _ in range(size):
+            index.add(Node(os.urandom(20)))
+        index.packed = distance.pack(index.ids)
+        assert distance.nearest(targets, index.ids, 20, index.packed) == \
+            [[index.ids.index(n.long_id) for n in index.closest(target, 20)]
+             for target in targets]
+        timings = [
+            timeit.timeit(lambda: [index.closest(target, 20)
+                                   for target in targets], number=number),
+            timeit.timeit(lambda: distance.nearest(targets, index.ids, 20,
+                                                   index.packed),
+                          number=number),
+        ]
+        usecs = ["%11.3f us" % (t / number / len(targets) * 1e6)
+                 for t in timings]
+        print("%8i %14s %14s" % (size, *usecs))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -29,9 +29,13 @@ async def add(file_list, tag_list, server):
             tmp = lf.read()
         lfiles.append(tmp)
 
+    # one tag at a time: the stores of a tag all go to the peers closest to
+    # it, so issuing them together lets them share datagrams
     for t in tag_list:
+        sets = []
         for i in range(len(file_list)):
-            await server.set(t, file_list[i], lfiles[i])
+            sets.append(server.set(t, file_list[i], lfiles[i]))
+        await asyncio.gather(*sets)
 
 async def add_tags(tag_query, tag_list, server):
     response = await get_fileIds(tag_query, server)
@@ -142,6 +146,9 @@ async def get_fileIds(tag_query, server, prt=False):
             return files
 
     else:
+        # every tag of the query is looked up at once
+        loads = await server.get_many(
+            [item for item in tokens if item not in ops], True)
         stack = []
         for item in tokens:
             if item in ops:
@@ -167,7 +174,7 @@ async def get_fileIds(tag_query, server, prt=False):
                         else:
                             stack.append(op1.union(op2))
             else:
-                load = await server.get(item, True)
+                load = loads[item]
                 if load:
                     stack.append(pickle.loads(load))
                 else:
@@ -187,8 +194,9 @@ async def list(tag_query, server, prt = False):
     to_return = []
     fids = await get_fileIds(tag_query, server, False)
     if len(fids):
+        loads = await server.get_many(fids, False)
         for f in fids:
-            l = (await server.get(f, False))
+            l = loads[f]
             if not l:
                 print('No results')
                 return
@@ -215,8 +223,9 @@ async def get(tag_query, server):
 
 async def delete(tag_query, server):
     files = await get_fileIds(tag_query, server, False)
+    loads = await server.get_many(files, False)
     for f in files:
-        l = (await server.get(f, False))
+        l = loads[f]
         # print(l)
         # input()
         if not l:
@@ -240,7 +249,7 @@ if __name__ == '__main__':
         sys.exit(1)
 
     loop = asyncio.get_event_loop()
-    server = Server(storage=AwesomeStorage())
+    server = Server(storage=AwesomeStorage(), batch_window=0.002)
     loop.run_until_complete(server.listen(int(sys.argv[2]), sys.argv[1]))
     bootstrap_node = (sys.argv[3], int(sys.argv[4]))
     loop.run_until_complete(server.bootstrap([bootstrap_node]))
@@ -1,101 +1,307 @@
 from collections import Counter
+import time
+import asyncio
 import logging
 
 from node import Node, NodeHeap
-from utils import gather_dict
+from rpcudp.protocol import BUSY_REPLY
 
 
 log = logging.getLogger(__name__)
 
+# why a lookup stopped
+DONE = 'done'
+FOUND = 'found'
+DEADLINE = 'deadline'
+BUDGET = 'budget'
+
+
+class LookupTrace:
+    """
+    What one lookup did: each call with the hop the peer was reached at,
+    its round trip time and outcome, and when the k closest last changed.
+    """
+    def __init__(self, target):
+        self.target = target
+        self.start = time.monotonic()
+        # peer id -> [peer, hop, sent, rtt, outcome, nodes returned]
+        self.calls = {}
+        # (seconds, calls made) when the k closest last changed
+        self.converged = (0.0, 0)
+        self.outcome = None
+        self.duration = None
+
+    def call_sent(self, peer, hop):
+        sent = time.monotonic() - self.start
+        self.calls[peer.id] = [peer, hop, sent, None, None, 0]
+
+    def call_done(self, peer, response):
+        call = self.calls[peer.id]
+        call[3] = time.monotonic() - self.start - call[2]
+        response = RPCFindResponse(response)
+        if not response.happened():
+            busy = response.response[1] is BUSY_REPLY
+            call[4] = 'busy' if busy else 'failed'
+        elif response.has_value():
+            call[4] = 'value'
+        else:
+            call[4] = 'ok'
+            call[5] = len(response.get_node_list())
+
+    def closest_changed(self):
+        self.converged = (time.monotonic() - self.start, len(self.calls))
+
+    def finish(self, outcome):
+        self.outcome = outcome
+        self.duration = time.monotonic() - self.start
+
+    def as_dict(self):
+        answered = [c for c in self.calls.values() if c[4] in ('ok', 'value')]
+        return {
+            'target': self.target.id.hex(),
+            'outcome': self.outcome,
+            'duration': self.duration,
+            'hops': max([c[1] for c in answered], default=0),
+            'converged': self.converged[0],
+            'converged_calls': self.converged[1],
+            'failed': sum(1 for c in self.calls.values()
+                          if c[4] == 'failed'),
+            'calls': [{'peer': str(peer), 'hop': hop, 'sent': sent,
+                       'rtt': rtt, 'outcome': outcome, 'nodes': nodes}
+                      for peer, hop, sent, rtt, outcome, nodes
+                      in self.calls.values()],
+        }
+
 
 class SpiderCrawl:
-    def __init__(self, protocol, node, peers, ksize, alpha):
+    def __init__(self, protocol, node, peers, ksize, alpha, timeout=None,
+                 max_calls=None, trace=None):
+        """
+        Args:
+            timeout (float): Seconds after which the lookup returns what it
+                             found so far, None for no deadline
+            max_calls (int): Calls after which no more peers are queried,
+                             None for no budget
+            trace (LookupTrace): Where to record the lookup, if anywhere
+        """
         self.protocol = protocol
         self.ksize = ksize
         self.alpha = alpha
         self.node = node
+        self.timeout = timeout
+        self.max_calls = max_calls
+        self.trace = trace
+        self.calls = 0
+        # why the lookup stopped, once it has
+        self.outcome = None
+        # the LookupSession the crawl is part of, if any
+        self.session = None
         self.nearest = NodeHeap(self.node, self.ksize)
-        self.last_ids_crawled = []
+        # peer id -> calls it is away from us, 1 for the peers we start from
+        self.hops = {peer.id: 1 for peer in peers}
         log.info("creating spider with peers: %s", peers)
         self.nearest.push(peers)
 
     async def _find(self, rpcmethod):
-        log.info("crawling network with nearest: %s", str(tuple(self.nearest)))
-        count = self.alpha
-        if self.nearest.get_ids() == self.last_ids_crawled:
-            count = len(self.nearest)
-        self.last_ids_crawled = self.nearest.get_ids()
-
-        dicts = {}
-        for peer in self.nearest.get_uncontacted()[:count]:
-            dicts[peer.id] = rpcmethod(peer, self.node)
-            self.nearest.mark_contacted(peer)
-        found = await gather_dict(dicts)
-        return await self._nodes_found(found)
-
-    async def _nodes_found(self, responses):
+        """
+        Query the closest uncontacted peers with alpha calls in flight at
+        all times, the next one being queried as soon as any call returns,
+        until the k closest peers known have all answered or _done says
+        so, or the deadline or call budget is reached. Calls still running
+        then are left to end on their own.
+        """
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        outcome = DONE
+        inflight = {}
+        while not self._done():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    outcome = DEADLINE
+                    break
+            free = self.alpha - len(inflight)
+            if self.max_calls is not None:
+                free = min(free, self.max_calls - self.calls)
+            if free > 0:
+                # the fastest peers first among those as close to the target
+                uncontacted = self.protocol.router.by_latency(
+                    self.nearest.get_uncontacted(), self.node)
+                for peer in uncontacted[:free]:
+                    if self.session is not None:
+                        call = self.session.call(rpcmethod, peer, self.node)
+                    else:
+                        call = rpcmethod(peer, self.node)
+                    future = asyncio.ensure_future(call)
+                    inflight[future] = peer
+                    self.nearest.mark_contacted(peer)
+                    self.calls += 1
+                    if self.trace is not None:
+                        self.trace.call_sent(peer, self.hops[peer.id])
+            closest = set(self.nearest.get_ids())
+            if not any(p.id in closest for p in inflight.values()):
+                if self.nearest.have_contacted_all():
+                    break
+                if self.max_calls is not None and \
+                        self.calls >= self.max_calls:
+                    outcome = BUDGET
+                    break
+            done, _ = await asyncio.wait(
+                inflight, timeout=remaining,
+                return_when=asyncio.FIRST_COMPLETED)
+            responses = {inflight.pop(future): future.result()
+                         for future in done}
+            if self.trace is not None:
+                for peer, response in responses.items():
+                    self.trace.call_done(peer, response)
+            self._nodes_found(responses)
+            if self.trace is not None and \
+                    set(self.nearest.get_ids()) != closest:
+                self.trace.closest_changed()
+        if self._done():
+            outcome = FOUND
+        self.outcome = outcome
+        if outcome in (DEADLINE, BUDGET):
+            log.info("lookup of %s stopped by its %s after %i calls",
+                     self.node.id.hex(), outcome, self.calls)
+        if self.trace is not None:
+            self.trace.finish(outcome)
+        return await self._result()
+
+    def _learn(self, peer, nodes):
+        """
+        Add the nodes peer told us about to the nearest ones.
+        """
+        hop = self.hops.get(peer.id, 1) + 1
+        for node in nodes:
+            self.hops.setdefault(node.id, hop)
+        self.nearest.push(nodes)
+        if self.session is not None:
+            self.session.learn(self, nodes, hop)
+
+    def _done(self):
+        return False
+
+    def _nodes_found(self, responses):
+        raise NotImplementedError
+
+    async def _result(self):
         raise NotImplementedError
 
 
+class LookupSession:
+    """
+    Lookups of many keys run together. They share a number of calls in
+    flight, skip the peers that failed or were busy in any of them, and
+    each one is told of the nodes the others learn, which the closer ones
+    of can spare it a few hops. Calls to the same peer going out together
+    share datagrams when the protocol batches them.
+    """
+    def __init__(self, concurrency):
+        self.slots = asyncio.Semaphore(concurrency)
+        self.crawls = set()
+        # ids of the nodes any of the lookups learnt of
+        self.known = set()
+        self.failed = set()
+
+    async def find(self, crawl):
+        """
+        Run crawl as part of the session, returning what it finds.
+        """
+        crawl.session = self
+        self.crawls.add(crawl)
+        try:
+            return await crawl.find()
+        finally:
+            self.crawls.discard(crawl)
+
+    async def call(self, rpcmethod, peer, target):
+        if peer.id in self.failed:
+            return (False, None)
+        async with self.slots:
+            result = await rpcmethod(peer, target)
+        if not result[0]:
+            self.failed.add(peer.id)
+        return result
+
+    def learn(self, crawl, nodes, hop):
+        """
+        Tell the other running crawls of the nodes crawl learnt of at hop,
+        those none of them had heard of yet.
+        """
+        nodes = [node for node in nodes if node.id not in self.known]
+        if not nodes:
+            return
+        self.known.update(node.id for node in nodes)
+        for other in self.crawls:
+            if other is not crawl:
+                for node in nodes:
+                    other.hops.setdefault(node.id, hop)
+                other.nearest.push(nodes)
+
+
 class ValueSpiderCrawl(SpiderCrawl):
-    def __init__(self, protocol, node, peers, ksize, alpha):
-        SpiderCrawl.__init__(self, protocol, node, peers, ksize, alpha)
-        self.nearest_without_value = NodeHeap(self.node, 1)
+    def __init__(self, protocol, node, peers, ksize, alpha, timeout=None,
+                 max_calls=None, trace=None):
+        SpiderCrawl.__init__(self, protocol, node, peers, ksize, alpha,
+                             timeout, max_calls, trace)
+        self.found_values = []
 
     async def find(self):
         return await self._find(self.protocol.call_find_value)
 
-    async def _nodes_found(self, responses):
+    def _done(self):
+        return bool(self.found_values)
+
+    def _nodes_found(self, responses):
         toremove = []
-        found_values = []
-        for peerid, response in responses.items():
+        for peer, response in responses.items():
             response = RPCFindResponse(response)
             if not response.happened():
-                toremove.append(peerid)
+                toremove.append(peer.id)
             elif response.has_value():
-                found_values.append(response.get_value())
+                self.found_values.append(response.get_value())
             else:
-                peer = self.nearest.get_node(peerid)
-                self.nearest_without_value.push(peer)
-                self.nearest.push(response.get_node_list())
+                self._learn(peer, response.get_node_list())
         self.nearest.remove(toremove)
 
-        if found_values:
-            return await self._handle_found_values(found_values)
-        if self.nearest.have_contacted_all():
+    async def _result(self):
+        if not self.found_values:
             # not found!
             return None
-        return await self.find()
+        return await self._handle_found_values(self.found_values)
 
     async def _handle_found_values(self, values):
+        """
+        The value most peers returned. It is not stored again at the
+        closest peer without it: find_value returns the raw storage entry,
+        without the tag and name a store needs.
+        """
         value_counts = Counter(values)
         if len(value_counts) != 1:
-            pass
-            # log.warning("Got multiple values for key %i: %s", self.node.long_id, str(values))
-        value = value_counts.most_common(1)[0][0]
-        peer = self.nearest_without_value.popleft()
-        if peer:
-            await self.protocol.call_store(peer, self.node.id, value)
-        return value
+            log.debug("got %i values for key %s", len(value_counts),
+                      self.node.id.hex())
+        return value_counts.most_common(1)[0][0]
 
 
 class NodeSpiderCrawl(SpiderCrawl):
     async def find(self):
         return await self._find(self.protocol.call_find_node)
 
-    async def _nodes_found(self, responses):
+    def _nodes_found(self, responses):
         toremove = []
-        for peerid, response in responses.items():
+        for peer, response in responses.items():
             response = RPCFindResponse(response)
             if not response.happened():
-                toremove.append(peerid)
+                toremove.append(peer.id)
             else:
-                self.nearest.push(response.get_node_list())
+                self._learn(peer, response.get_node_list())
         self.nearest.remove(toremove)
 
-        if self.nearest.have_contacted_all():
-            return list(self.nearest)
-        return await self.find()
+    async def _result(self):
+        return list(self.nearest)
 
 
 class RPCFindResponse:
@@ -113,4 +319,6 @@ class RPCFindResponse:
 
     def get_node_list(self):
         nodelist = self.response[1] or []
-        return [Node(*nodeple) for nodeple in nodelist]
+        # compact responses already carry Node objects
+        return [nodeple if isinstance(nodeple, Node) else Node(*nodeple)
+                for nodeple in nodelist]
@@ -0,0 +1,79 @@
+"""
+Bulk XOR distance kernel: the k closest of many ids to each of many
+targets in one call.
+
+With NumPy installed, ids are packed as rows of three big endian 64 bit
+words (the 160 bits padded with zeros) and the candidates are picked with
+argpartition over the XOR of the top words, for a whole block of targets
+at once. Rows whose order the top words do not settle are finished with
+full Python ints. Without NumPy, everything is done with Python ints.
+"""
+import heapq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HAVE_NUMPY = numpy is not None
+
+# targets compared at once, bounding the memory of the distance matrix
+BLOCK = 256
+
+_PAD = bytes(4)
+
+
+def pack(ids):
+    """
+    Pack integer ids for nearest, or return None without NumPy.
+    """
+    if numpy is None:
+        return None
+    data = b''.join(long_id.to_bytes(20, 'big') + _PAD for long_id in ids)
+    words = numpy.frombuffer(data, dtype='>u8').reshape(-1, 3)
+    return words.astype(numpy.uint64)
+
+
+def _exact(target, ids, k):
+    return heapq.nsmallest(k, range(len(ids)), key=lambda i: ids[i] ^ target)
+
+
+def nearest(targets, ids, k, packed=None):
+    """
+    For each of the integer targets, the indexes in ids of the k ids
+    closest to it, nearest first. packed is pack(ids), if already known.
+    """
+    k = min(k, len(ids))
+    if not k:
+        return [[] for _ in targets]
+    if numpy is None:
+        return [_exact(target, ids, k) for target in targets]
+    if packed is None:
+        packed = pack(ids)
+
+    result = []
+    for begin in range(0, len(targets), BLOCK):
+        block = targets[begin:begin + BLOCK]
+        high = pack(block)[:, :1] ^ packed[:, 0]
+        if k < len(ids):
+            picked = numpy.argpartition(high, k - 1, axis=1)[:, :k]
+        else:
+            picked = numpy.tile(numpy.arange(len(ids)), (len(block), 1))
+        top = numpy.take_along_axis(high, picked, axis=1)
+        order = numpy.argsort(top, axis=1)
+        picked = numpy.take_along_axis(picked, order, axis=1)
+        top = numpy.take_along_axis(top, order, axis=1)
+
+        # equal top words leave the order, or who is kth, undecided: sort
+        # every id not beyond the kth top word on all of its words
+        kth = top[:, -1:]
+        undecided = (top[:, 1:] == top[:, :-1]).any(axis=1) | \
+            ((high == kth).sum(axis=1) > (top == kth).sum(axis=1))
+        rows = picked.tolist()
+        for row in numpy.flatnonzero(undecided).tolist():
+            candidates = numpy.flatnonzero(high[row] <= kth[row, 0])
+            words = packed[candidates] ^ pack(block[row:row + 1])
+            order = numpy.lexsort((words[:, 2], words[:, 1], words[:, 0]))
+            rows[row] = candidates[order[:k]].tolist()
+        result.extend(rows)
+    return result
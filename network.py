@@ -1,30 +1,116 @@
+import os
+import time
 import random
 import pickle
 import asyncio
 import logging
+from collections import deque, OrderedDict
 
 from node import Node
 from utils import digest
 from crawling import NodeSpiderCrawl
 from protocol import KademliaProtocol
-from crawling import ValueSpiderCrawl
+from crawling import ValueSpiderCrawl, LookupTrace, LookupSession, DONE
 from storage import ForgetfulStorage, AwesomeStorage
 
 log = logging.getLogger(__name__)
 
+class LookupCache:
+    """
+    The closest nodes found by recent lookups, by key, for ttl seconds and
+    for the maxsize keys used last. A key is forgotten as soon as one of
+    its nodes fails a call.
+    """
+    def __init__(self, maxsize=256, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # dkey -> (expiry time, nodes), least recently used first
+        self.entries = OrderedDict()
+        # node id -> dkeys of the entries holding it
+        self.keys_of = {}
+
+    def get(self, dkey):
+        entry = self.entries.get(dkey)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(dkey)
+            return None
+        self.entries.move_to_end(dkey)
+        return list(entry[1])
+
+    def put(self, dkey, nodes):
+        if dkey in self.entries:
+            self._drop(dkey)
+        if self.maxsize <= 0:
+            return
+        self.entries[dkey] = (time.monotonic() + self.ttl, list(nodes))
+        for node in nodes:
+            self.keys_of.setdefault(node.id, set()).add(dkey)
+        while len(self.entries) > self.maxsize:
+            self._drop(next(iter(self.entries)))
+
+    def node_failed(self, node):
+        for dkey in list(self.keys_of.get(node.id, ())):
+            self._drop(dkey)
+
+    def _drop(self, dkey):
+        _, nodes = self.entries.pop(dkey)
+        for node in nodes:
+            keys = self.keys_of.get(node.id)
+            if keys is not None:
+                keys.discard(dkey)
+                if not keys:
+                    del self.keys_of[node.id]
+
+    def __len__(self):
+        return len(self.entries)
+
+
 class Server:
 
     protocol_class = KademliaProtocol
 
-    def __init__(self, ksize=20, alpha=3, node_id=None, storage=None):
+    def __init__(self, ksize=20, alpha=3, node_id=None, storage=None,
+                 batch_window=None, refresh_interval=3600,
+                 refresh_concurrency=4, ready_contacts=None,
+                 lookup_timeout=None, lookup_calls=None, traces=0,
+                 lookup_cache_size=256, lookup_cache_ttl=30):
         self.ksize = ksize
         self.alpha = alpha
+        self.batch_window = batch_window
+        self.refresh_interval = refresh_interval
+        # bucket refreshes and republishes running at once, over all cycles
+        self.refresh_slots = asyncio.Semaphore(refresh_concurrency)
+        self.refresh_task = None
+        # (start, duration, buckets refreshed, keys republished) of the
+        # last complete refresh cycle
+        self.last_refresh = None
         self.storage = (storage or ForgetfulStorage())
         self.node = Node(node_id or digest(random.getrandbits(255)))
         self.transport = None
         self.protocol = None
         self.refresh_loop = None
         self.save_state_loop = None
+        # state loaded by load_state, restored once listening
+        self.saved_state = None
+        # set once a bootstrap filled the table with ready_contacts contacts,
+        # or filled it as much as it could
+        self.ready_contacts = ready_contacts or ksize
+        self.ready = asyncio.Event()
+        self.fill_task = None
+        # deadline in seconds and call budget of the lookups behind get,
+        # set and delete, which return what they found so far when reached
+        self.lookup_timeout = lookup_timeout
+        self.lookup_calls = lookup_calls
+        # traces of the last lookups, as dicts, none are taken with 0
+        self.traces = deque(maxlen=traces)
+        # closest nodes of recently looked up keys, reused by get, set and
+        # delete so that many calls for a key cost one lookup
+        self.lookup_cache = LookupCache(lookup_cache_size, lookup_cache_ttl)
+        # (crawl class, id) -> task of the lookup running for that id,
+        # shared by everyone asking for it meanwhile
+        self.pending_lookups = {}
 
     def stop(self):
         if self.transport is not None:
@@ -33,11 +119,23 @@ class Server:
         if self.refresh_loop:
             self.refresh_loop.cancel()
 
+        if self.refresh_task:
+            self.refresh_task.cancel()
+
+        if self.fill_task:
+            self.fill_task.cancel()
+
         if self.save_state_loop:
             self.save_state_loop.cancel()
 
+        for task in list(self.pending_lookups.values()):
+            task.cancel()
+
     def _create_protocol(self):
-        return self.protocol_class(self.node, self.storage, self.ksize)
+        protocol = self.protocol_class(self.node, self.storage, self.ksize,
+                                       self.batch_window)
+        protocol.lookup_cache = self.lookup_cache
+        return protocol
 
     async def listen(self, port, interface='0.0.0.0'):
         self.node = Node(self.node.id, interface, port)
@@ -47,61 +145,285 @@ class Server:
         log.info("Node %i listening on %s:%i",
                  self.node.long_id, interface, port)
         self.transport, self.protocol = await listen
+        # large values travel over TCP on the same port number, the one the
+        # system picked when port is 0
+        port = self.transport.get_extra_info('sockname')[1]
+        try:
+            await self.protocol.listen_bulk(interface, port)
+        except OSError as err:
+            log.warning("cannot listen for bulk transfers on %s:%i, large "
+                        "values are sent in fragments: %s", interface, port,
+                        err)
+        if self.saved_state is not None:
+            self.restore_state(self.saved_state)
+            self.saved_state = None
         # finally, schedule refreshing table
         self.refresh_table()
 
     def refresh_table(self):
-        log.debug("Refreshing routing table")
-        asyncio.ensure_future(self._refresh_table())
+        """
+        Start a refresh cycle unless one is still running, and schedule the
+        next one about refresh_interval seconds later. The interval is
+        jittered so that nodes started together drift apart.
+        """
+        if self.refresh_task is None or self.refresh_task.done():
+            log.debug("Refreshing routing table")
+            self.refresh_task = asyncio.ensure_future(self._refresh_table())
+        else:
+            log.warning("previous refresh cycle still running, skipping")
         loop = asyncio.get_event_loop()
-        self.refresh_loop = loop.call_later(3600, self.refresh_table)
+        delay = self.refresh_interval * random.uniform(0.9, 1.1)
+        self.refresh_loop = loop.call_later(delay, self.refresh_table)
 
     async def _refresh_table(self):
-        results = []
-        for node_id in self.protocol.get_refresh_ids():
-            node = Node(node_id)
-            nearest = self.protocol.router.find_neighbors(node, self.alpha)
-            spider = NodeSpiderCrawl(self.protocol, node, nearest,
-                                     self.ksize, self.alpha)
-            results.append(spider.find())
-
-        await asyncio.gather(*results)
+        """
+        Refresh the lonely buckets and republish the old keys, spreading
+        them over the first half of the interval rather than all at once.
+        """
+        start = time.monotonic()
+        jobs = [(self._refresh_bucket, node_id) for node_id in
+                self.protocol.get_refresh_ids(self.refresh_interval)]
+        jobs += [(self._republish, item) for item in
+                 self.storage.iter_republish(self.refresh_interval)]
+        random.shuffle(jobs)
+
+        spacing = self.refresh_interval / 2 / max(len(jobs), 1)
+        running = []
+        try:
+            for job, arg in jobs:
+                await asyncio.sleep(spacing * random.uniform(0.5, 1.5))
+                await self.refresh_slots.acquire()
+                task = asyncio.ensure_future(job(arg))
+                task.add_done_callback(
+                    lambda _: self.refresh_slots.release())
+                running.append(task)
+            results = await asyncio.gather(*running, return_exceptions=True)
+        finally:
+            # stopping the server cancels the cycle, and its jobs with it
+            for task in running:
+                task.cancel()
+
+        refreshed = sum(1 for (job, _), result in zip(jobs, results)
+                        if job == self._refresh_bucket and result is True)
+        republished = sum(1 for (job, _), result in zip(jobs, results)
+                          if job == self._republish and result is True)
+        duration = time.monotonic() - start
+        self.last_refresh = (start, duration, refreshed, republished)
+        log.info("refresh cycle took %.1fs: %i buckets refreshed, "
+                 "%i keys republished", duration, refreshed, republished)
+
+    async def _refresh_bucket(self, node_id):
+        node = Node(node_id)
+        router = self.protocol.router
+        bucket = router.buckets[router.get_bucket_for(node)]
+        if bucket.last_updated > time.monotonic() - self.refresh_interval:
+            # it saw a lookup since the cycle started
+            return False
+        nearest = router.find_neighbors(node, self.alpha, fast=True)
+        spider = NodeSpiderCrawl(self.protocol, node, nearest,
+                                 self.ksize, self.alpha)
+        await spider.find()
+        return True
 
-        for dkey, value in self.storage.iter_older_than(3600):
-            await self.set_digest(dkey, value)
+    async def _republish(self, item):
+        dkey, key, name, value, hash = item
+        return await self.set_digest(dkey, key, name, value, hash)
 
     async def bootstrappable_neighbors(self):
         neighbors = self.protocol.router.find_neighbors(self.node)
         print(neighbors) # added by myselfs
         return [tuple(n)[-2:] for n in neighbors]
 
-    async def bootstrap(self, addrs):
+    async def bootstrap(self, addrs, fill_budget=30):
+        """
+        Join through any of the seeds at addrs: crawl toward our own id from
+        the first seeds to answer, then fill the far buckets in the
+        background for at most fill_budget seconds, see fill_buckets.
+        """
         log.debug("Attempting to bootstrap node with %i initial contacts",
                   len(addrs))
-        cos = list(map(self.bootstrap_node, addrs))
-        gathered = await asyncio.gather(*cos)
-        nodes = [node for node in gathered if node is not None]
+        pending = [asyncio.ensure_future(self.bootstrap_node(addr))
+                   for addr in addrs]
+        nodes = []
+        while pending and not nodes:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            nodes = [node for node in map(self._seed_result, done)
+                     if node is not None]
+        for task in pending:
+            # seeds answering later are still good contacts
+            task.add_done_callback(self._welcome_seed)
         spider = NodeSpiderCrawl(self.protocol, self.node, nodes,
                                  self.ksize, self.alpha)
-        return await spider.find()
+        found = await spider.find()
+        if self.fill_task:
+            self.fill_task.cancel()
+        self.fill_task = asyncio.ensure_future(self.fill_buckets(fill_budget))
+        return found
+
+    def _welcome_seed(self, task):
+        node = self._seed_result(task)
+        if node is not None:
+            self.protocol.welcome_if_new(node)
+
+    @staticmethod
+    def _seed_result(task):
+        """
+        The node a bootstrap_node task reached, None if it did not answer,
+        failed or was cancelled.
+        """
+        if task.cancelled():
+            return None
+        if task.exception() is not None:
+            log.warning("could not reach seed: %r", task.exception())
+            return None
+        return task.result()
+
+    async def fill_buckets(self, budget=30, concurrency=8):
+        """
+        Look up a random id at every distance from our own id beyond that
+        of our closest contact, concurrency at a time and for at most
+        budget seconds, so that the far buckets are populated before the
+        first refresh. Sets self.ready as soon as the table holds
+        ready_contacts contacts, or when done.
+        """
+        router = self.protocol.router
+        closest = router.find_neighbors(self.node, 1)
+        shared = 0
+        if closest:
+            shared = 160 - self.node.distance_to(closest[0]).bit_length()
+        slots = asyncio.Semaphore(concurrency)
+        lookups = [asyncio.ensure_future(self._fill_bucket(bits, slots))
+                   for bits in range(160 - shared, 160)]
+        start = time.monotonic()
+        try:
+            self._check_ready()
+            if lookups:
+                await asyncio.wait(lookups, timeout=budget)
+        finally:
+            for task in lookups:
+                task.cancel()
+            log.info("filled table with %i contacts in %.1fs",
+                     len(router.contacts), time.monotonic() - start)
+            self.ready.set()
+
+    async def _fill_bucket(self, bits, slots):
+        # an id differing from ours at bit bits and randomly below it
+        long_id = (self.node.long_id ^ (1 << bits)) >> bits << bits
+        long_id |= random.getrandbits(bits)
+        node = Node(long_id.to_bytes(20, 'big'))
+        async with slots:
+            nearest = self.protocol.router.find_neighbors(node, self.alpha,
+                                                          fast=True)
+            spider = NodeSpiderCrawl(self.protocol, node, nearest,
+                                     self.ksize, self.alpha)
+            await spider.find()
+        self._check_ready()
+
+    def _check_ready(self):
+        contacts = len(self.protocol.router.contacts)
+        if not self.ready.is_set() and contacts >= self.ready_contacts:
+            log.info("ready with %i contacts", contacts)
+            self.ready.set()
 
     async def bootstrap_node(self, addr):
         result = await self.protocol.ping(addr, self.node.id)
         return Node(result[1], addr[0], addr[1]) if result[0] else None
 
+    async def _lookup(self, crawl_class, node, nearest, session=None):
+        """
+        Run a crawl of crawl_class toward node from nearest, within the
+        lookup deadline and budget and as part of session if given, keeping
+        its trace if traces are taken. A lookup of the same kind for node
+        that is already running is waited for instead.
+        """
+        key = (crawl_class, node.id)
+        pending = self.pending_lookups.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(
+                self._crawl(crawl_class, node, nearest, session))
+            self.pending_lookups[key] = pending
+            pending.add_done_callback(
+                lambda _: self.pending_lookups.pop(key, None))
+        # a caller giving up does not cancel it for the others
+        return await asyncio.shield(pending)
+
+    async def _crawl(self, crawl_class, node, nearest, session):
+        trace = LookupTrace(node) if self.traces.maxlen else None
+        spider = crawl_class(self.protocol, node, nearest, self.ksize,
+                             self.alpha, self.lookup_timeout,
+                             self.lookup_calls, trace)
+        try:
+            if session is not None:
+                result = await session.find(spider)
+            else:
+                result = await spider.find()
+        finally:
+            if trace is not None:
+                self.traces.append(trace.as_dict())
+        if crawl_class is NodeSpiderCrawl and spider.outcome == DONE \
+                and result:
+            # only complete lookups, not what a deadline cut short
+            self.lookup_cache.put(node.id, result)
+        return result
+
+    async def _find_nodes(self, node, nearest, session=None):
+        """
+        The closest nodes to node, as found by a lookup for it in the last
+        lookup_cache_ttl seconds or by a new one.
+        """
+        nodes = self.lookup_cache.get(node.id)
+        if nodes is None:
+            nodes = await self._lookup(NodeSpiderCrawl, node, nearest,
+                                       session)
+        return nodes
+
+    async def _get_digest(self, dkey, session=None):
+        node = Node(dkey)
+        nearest = self.protocol.router.find_neighbors(node)
+        if not nearest:
+            log.warning("There are no known neighbors to get key %s",
+                        dkey.hex())
+            return None
+        # the closest nodes of a recent lookup answer in one round
+        nearest = self.lookup_cache.get(dkey) or nearest
+        return await self._lookup(ValueSpiderCrawl, node, nearest, session)
+
+    async def get_many(self, keys, hash=False, concurrency=None):
+        """
+        Look up many keys at once, in a LookupSession allowing concurrency
+        calls in flight (4 alpha by default), which takes about the time of
+        a single lookup. Returns a dict of the value of each key, None for
+        the keys not found.
+        """
+        keys = list(keys)
+        dkeys = {key: digest(key) if hash else key for key in keys}
+        session = LookupSession(concurrency or 4 * self.alpha)
+        unique = list(set(dkeys.values()))
+        values = await asyncio.gather(
+            *[self._get_digest(dkey, session) for dkey in unique])
+        values = dict(zip(unique, values))
+        return {key: values[dkeys[key]] for key in keys}
+
+    async def find_nodes_many(self, dkeys, concurrency=None):
+        """
+        The closest nodes to each of many dkeys, looked up together like in
+        get_many. Returns a dict of the nodes of each dkey.
+        """
+        dkeys = list(set(dkeys))
+        session = LookupSession(concurrency or 4 * self.alpha)
+        router = self.protocol.router
+        results = await asyncio.gather(
+            *[self._find_nodes(Node(dkey), router.find_neighbors(Node(dkey)),
+                               session) for dkey in dkeys])
+        return dict(zip(dkeys, results))
+
     async def get(self, key, hash=False):
         log.info("Looking up key %s", key)
         dkey = key
         if hash:
             dkey = digest(key)
-        node = Node(dkey)
-        nearest = self.protocol.router.find_neighbors(node)
-        if not nearest:
-            log.warning("There are no known neighbors to get key %s", key)
-            return None
-        spider = ValueSpiderCrawl(self.protocol, node, nearest,
-                                  self.ksize, self.alpha)
-        return await spider.find()
+        return await self._get_digest(dkey)
 
     async def delete(self, key, hash = True):
         dkey = key
@@ -118,8 +440,7 @@ class Server:
         if not nearest:
             log.warning("There are no known neighbors to get key %s", key)
             return None
-        spider = NodeSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha)
-        nodes = await spider.find()
+        nodes = await self._find_nodes(node, nearest)
 
         results = [self.protocol.call_delete(n, dkey) for n in nodes]
         # return true only if at least one delete call succeeded
@@ -133,9 +454,7 @@ class Server:
         if not nearest:
             log.warning("There are no known neighbors to set key %s", key)
             return None
-        spider = NodeSpiderCrawl(self.protocol, node, nearest,
-                                 self.ksize, self.alpha)
-        nodes = await spider.find()
+        nodes = await self._find_nodes(node, nearest)
         log.info("setting '%s' on %s", dkey.hex(), list(map(str, nodes)))
 
         results = [self.protocol.call_delete_tag(n, dkey, key, value) for n in nodes]
@@ -160,9 +479,7 @@ class Server:
                         dkey.hex())
             return False
 
-        spider = NodeSpiderCrawl(self.protocol, node, nearest,
-                                 self.ksize, self.alpha)
-        nodes = await spider.find()
+        nodes = await self._find_nodes(node, nearest)
         log.info("setting '%s' on %s", dkey.hex(), list(map(str, nodes)))
 
         # if this node is close too, then store here as well
@@ -174,29 +491,84 @@ class Server:
         return any(await asyncio.gather(*results))
 
     def save_state(self, fname):
+        """
+        Write the routing table, with the age of every contact and the round
+        trip times measured to them, so that a restart can pick up from it.
+        """
         log.info("Saving state to %s", fname)
+        router = self.protocol.router
+        rtt = {}
+        for node in router.contacts.nodes.values():
+            estimate = self.protocol.get_rtt((node.ip, node.port))
+            if estimate is not None:
+                rtt[(node.ip, node.port)] = estimate
         data = {
             'ksize': self.ksize,
             'alpha': self.alpha,
             'id': self.node.id,
-            'neighbors': self.bootstrappable_neighbors()
+            'table': router.snapshot(),
+            'rtt': rtt,
+            'neighbors': [(n.ip, n.port)
+                          for n in router.find_neighbors(self.node)],
         }
         if not data['neighbors']:
             log.warning("No known neighbors, so not writing to cache.")
             return
-        with open(fname, 'wb') as file:
+        # never leave a truncated file behind if interrupted
+        with open(fname + '.tmp', 'wb') as file:
             pickle.dump(data, file)
+        os.replace(fname + '.tmp', fname)
 
     @classmethod
     def load_state(cls, fname):
+        """
+        Create a server from a file written by save_state. Its routing table
+        is restored when it starts listening.
+        """
         log.info("Loading state from %s", fname)
         with open(fname, 'rb') as file:
             data = pickle.load(file)
-        svr = Server(data['ksize'], data['alpha'], data['id'])
-        if data['neighbors']:
-            svr.bootstrap(data['neighbors'])
+        svr = cls(data['ksize'], data['alpha'], data['id'])
+        svr.saved_state = data
         return svr
 
+    def restore_state(self, data):
+        """
+        Reload a saved routing table so the node answers lookups right away,
+        then make sure its contacts are still alive in the background.
+        """
+        if 'table' not in data:
+            # written by an older version, only addresses to bootstrap from
+            asyncio.ensure_future(self.bootstrap(data['neighbors']))
+            return
+        self.protocol.router.load_snapshot(data['table'])
+        for address, (srtt, rttvar) in data['rtt'].items():
+            self.protocol.set_rtt(address, srtt, rttvar)
+        log.info("restored %i contacts",
+                 len(self.protocol.router.contacts))
+        asyncio.ensure_future(self.revalidate())
+
+    async def revalidate(self, concurrency=16):
+        """
+        Ping every contact in the routing table, at most concurrency at a
+        time, dropping the ones that do not answer. Returns the number of
+        contacts that did.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def check(node):
+            async with semaphore:
+                result = await self.protocol.call_ping(node)
+            if not result[0] and result[1] is None:
+                # not worth more chances after a restart
+                self.protocol.router.remove_contact(node)
+            return result[0]
+
+        nodes = list(self.protocol.router.contacts.nodes.values())
+        alive = sum(await asyncio.gather(*map(check, nodes)))
+        log.info("%i of %i restored contacts are alive", alive, len(nodes))
+        return alive
+
     def save_state_regularly(self, fname, frequency=600):
         self.save_state(fname)
         loop = asyncio.get_event_loop()
@@ -1,13 +1,33 @@
-from operator import itemgetter
-import heapq
+import bisect
+import weakref
 
 
 class Node:
-    def __init__(self, node_id, ip=None, port=None):
-        self.id = node_id
-        self.ip = ip
-        self.port = port
-        self.long_id = int(node_id.hex(), 16)
+    """
+    A contact: a 160 bit id and, for peers, the address it is reached at.
+
+    Nodes are interned, creating a node with the id, ip and port of a live
+    one returns that same object, so a contact seen in every response does
+    not cost a new allocation each time. Nodes must not be changed.
+    """
+    __slots__ = ('id', 'ip', 'port', 'long_id', '__weakref__')
+
+    _pool = weakref.WeakValueDictionary()
+
+    def __new__(cls, node_id, ip=None, port=None):
+        key = (node_id, ip, port)
+        node = cls._pool.get(key)
+        if node is None:
+            node = super().__new__(cls)
+            node.id = node_id
+            node.ip = ip
+            node.port = port
+            node.long_id = int.from_bytes(node_id, 'big')
+            cls._pool[key] = node
+        return node
+
+    def __reduce__(self):
+        return (self.__class__, (self.id, self.ip, self.port))
 
     def same_home_as(self, node):
         return self.ip == node.ip and self.port == node.port
@@ -26,61 +46,105 @@ class Node:
 
 
 class NodeHeap:
+    """
+    The maxsize nodes closest to node seen by a crawl, and which of them
+    were contacted.
+
+    Nodes are kept by their distance to node, in a sorted list of distances
+    and a dict from distance to node, distances being unique to an id. Up
+    to twice maxsize nodes are kept, so that the ones behind take the place
+    of peers that fail and are removed. The uncontacted ones are tracked as
+    they are pushed and contacted, in a sorted list of their distances.
+    """
     def __init__(self, node, maxsize):
         self.node = node
-        self.heap = []
-        self.contacted = set()
         self.maxsize = maxsize
+        self.capacity = 2 * maxsize
+        self.distances = []
+        self.nodes = {}
+        self.uncontacted = []
+        self.contacted = set()
+
+    def _distance(self, node_id):
+        return self.node.long_id ^ int.from_bytes(node_id, 'big')
+
+    @staticmethod
+    def _discard(distances, distance):
+        index = bisect.bisect_left(distances, distance)
+        if index < len(distances) and distances[index] == distance:
+            del distances[index]
+
+    def _drop(self, distance):
+        del self.nodes[distance]
+        self._discard(self.distances, distance)
+        self._discard(self.uncontacted, distance)
 
     def remove(self, peers):
-        peers = set(peers)
-        if not peers:
-            return
-        nheap = []
-        for distance, node in self.heap:
-            if node.id not in peers:
-                heapq.heappush(nheap, (distance, node))
-        self.heap = nheap
+        for node_id in peers:
+            distance = self._distance(node_id)
+            if distance in self.nodes:
+                self._drop(distance)
 
     def get_node(self, node_id):
-        for _, node in self.heap:
-            if node.id == node_id:
-                return node
+        return self.nodes.get(self._distance(node_id))
+
+    def _cutoff(self):
+        # the distance of the farthest node among the maxsize closest
+        if len(self.distances) > self.maxsize:
+            return self.distances[self.maxsize - 1]
         return None
 
     def have_contacted_all(self):
-        return len(self.get_uncontacted()) == 0
+        cutoff = self._cutoff()
+        return not self.uncontacted or \
+            (cutoff is not None and self.uncontacted[0] > cutoff)
 
     def get_ids(self):
         return [n.id for n in self]
 
     def mark_contacted(self, node):
         self.contacted.add(node.id)
+        self._discard(self.uncontacted, self.node.distance_to(node))
 
     def popleft(self):
-        return heapq.heappop(self.heap)[1] if self else None
+        if not self.distances:
+            return None
+        node = self.nodes[self.distances[0]]
+        self._drop(self.distances[0])
+        return node
 
     def push(self, nodes):
         if not isinstance(nodes, list):
             nodes = [nodes]
 
         for node in nodes:
-            if node not in self:
-                distance = self.node.distance_to(node)
-                heapq.heappush(self.heap, (distance, node))
+            distance = self.node.distance_to(node)
+            if distance in self.nodes:
+                continue
+            full = len(self.distances) >= self.capacity
+            if full and distance > self.distances[-1]:
+                continue
+            bisect.insort(self.distances, distance)
+            self.nodes[distance] = node
+            if node.id not in self.contacted:
+                bisect.insort(self.uncontacted, distance)
+            if full:
+                self._drop(self.distances[-1])
 
     def __len__(self):
-        return min(len(self.heap), self.maxsize)
+        return min(len(self.distances), self.maxsize)
 
     def __iter__(self):
-        nodes = heapq.nsmallest(self.maxsize, self.heap)
-        return iter(map(itemgetter(1), nodes))
+        nodes = self.nodes
+        return iter([nodes[d] for d in self.distances[:self.maxsize]])
 
     def __contains__(self, node):
-        for _, other in self.heap:
-            if node.id == other.id:
-                return True
-        return False
+        return self.node.distance_to(node) in self.nodes
 
     def get_uncontacted(self):
-        return [n for n in self if n.id not in self.contacted]
+        cutoff = self._cutoff()
+        end = len(self.uncontacted)
+        if cutoff is not None:
+            end = bisect.bisect_right(self.uncontacted, cutoff)
+        nodes = self.nodes
+        return [nodes[d] for d in self.uncontacted[:end]]
@@ -2,25 +2,36 @@ import random
 import asyncio
 import logging
 
-from rpcudp.protocol import RPCProtocol
+from rpcudp.protocol import RPCProtocol, BUSY_REPLY
 
 from node import Node
 from routing import RoutingTable
-from utils import digest
 
 log = logging.getLogger(__name__)
 
 
 class KademliaProtocol(RPCProtocol):
-    def __init__(self, source_node, storage, ksize):
-        RPCProtocol.__init__(self)
+    # compact method ids, append only
+    rpc_methods = ('stun', 'ping', 'store', 'delete', 'delete_tag',
+                   'find_node', 'find_value', 'stats')
+    contact_factory = Node
+    # stores sent at once to a new contact, and pause between those chunks
+    handoff_chunk = 16
+    handoff_pause = 0.05
+
+    def __init__(self, source_node, storage, ksize, batch_window=None):
+        RPCProtocol.__init__(self, batch_window=batch_window)
         self.router = RoutingTable(self, ksize, source_node)
         self.storage = storage
         self.source_node = source_node
+        # node id -> items still to be handed off to that new contact
+        self.handoffs = {}
+        # lookup results to drop when one of their nodes fails, if cached
+        self.lookup_cache = None
 
-    def get_refresh_ids(self):
+    def get_refresh_ids(self, max_age=3600):
         ids = []
-        for bucket in self.router.lonely_buckets():
+        for bucket in self.router.lonely_buckets(max_age):
             rid = random.randint(*bucket.range).to_bytes(20, byteorder='big')
             ids.append(rid)
         return ids
@@ -74,6 +85,11 @@ class KademliaProtocol(RPCProtocol):
             return self.rpc_find_node(sender, nodeid, key)
         return {'value': value}
 
+    def rpc_stats(self, sender, nodeid):
+        source = Node(nodeid, sender[0], sender[1])
+        self.welcome_if_new(source)
+        return self.metrics.as_dict()
+
     async def call_find_node(self, node_to_ask, node_to_find):
         address = (node_to_ask.ip, node_to_ask.port)
         result = await self.find_node(address, self.source_node.id,
@@ -106,29 +122,79 @@ class KademliaProtocol(RPCProtocol):
         result = await self.delete_tag(address, self.source_node.id, dkey ,key, value)
         return self.handle_call_response(result, node_to_ask)
 
+    async def call_stats(self, node_to_ask):
+        address = (node_to_ask.ip, node_to_ask.port)
+        result = await self.stats(address, self.source_node.id)
+        return self.handle_call_response(result, node_to_ask)
+
     def welcome_if_new(self, node):
         if not self.router.is_new_node(node):
+            self.router.mark_seen(node)
             return
 
         log.info("never seen %s before, adding to router", node)
-        for key, value in self.storage:
-            keynode = Node(digest(key))
-            neighbors = self.router.find_neighbors(keynode)
+        # only the keys this node is closer to than to any contact are
+        # handed off
+        lower, upper, mask = self.router.neighbourhood(self.source_node)
+        own = self.source_node.long_id
+        keys = [dkey for dkey in self.storage.keys_between(lower, upper)
+                if (int.from_bytes(dkey, 'big') ^ own) & mask == 0]
+        nearest = self.router.contacts.closest_many(
+            [int.from_bytes(dkey, 'big') for dkey in keys], self.router.ksize)
+        items = []
+        for dkey, neighbors in zip(keys, nearest):
+            keynode = Node(dkey)
             if neighbors:
                 last = neighbors[-1].distance_to(keynode)
                 new_node_close = node.distance_to(keynode) < last
                 first = neighbors[0].distance_to(keynode)
                 this_closest = self.source_node.distance_to(keynode) < first
             if not neighbors or (new_node_close and this_closest):
-                asyncio.ensure_future(self.call_store(node, key, value))
+                items.extend(self.storage.store_args(dkey))
+        if items:
+            self.handoff(node, items)
         self.router.add_contact(node)
 
+    def handoff(self, node, items):
+        """
+        Store items on node, a few at a time so that a new contact close to
+        many keys does not get them all in one burst.
+        """
+        if node.id in self.handoffs:
+            self.handoffs[node.id].extend(items)
+            return
+        self.handoffs[node.id] = list(items)
+        asyncio.ensure_future(self._handoff(node))
+
+    async def _handoff(self, node):
+        items = self.handoffs[node.id]
+        try:
+            sent = 0
+            while sent < len(items):
+                chunk = items[sent:sent + self.handoff_chunk]
+                sent += len(chunk)
+                results = await asyncio.gather(
+                    *[self.call_store(node, *item) for item in chunk])
+                if not any(result[0] for result in results):
+                    log.warning("handoff to %s failed after %i of %i items",
+                                node, sent, len(items))
+                    return
+                await asyncio.sleep(self.handoff_pause)
+        finally:
+            del self.handoffs[node.id]
+
     def handle_call_response(self, result, node):
         #print("result >>>>")
         #print(result)
+        if not result[0] and result[1] is BUSY_REPLY:
+            # the peer is alive but overloaded, callers try another one
+            return result
+
         if not result[0]:
             #log.warning("no response from %s, removing from router", node)
-            self.router.remove_contact(node)
+            self.router.mark_failed(node)
+            if self.lookup_cache is not None:
+                self.lookup_cache.node_failed(node)
             return result
 
         #log.info("got successful response from %s", node)
@@ -1,20 +1,148 @@
-import heapq
 import time
-import operator
+import bisect
 import asyncio
+import logging
 
 from itertools import chain
 from collections import OrderedDict
-from utils import shared_prefix, bytes_to_bit_string
+
+import distance
+from node import Node
+
+log = logging.getLogger(__name__)
+
+
+class ContactIndex:
+    """
+    The contacts held by the buckets of a table, sorted by id so that the
+    closest ones to any id can be found without looking at the others.
+
+    Ids sharing all but their lowest b bits with a target form a contiguous
+    run of the sorted ids, and every id in the run is closer to the target
+    than any id outside of it.
+    """
+    # above this many contacts the bisect of closest beats a bulk scan
+    kernel_max = 2048
+
+    def __init__(self):
+        self.ids = []
+        self.nodes = {}
+        # self.ids packed for the distance kernel, None when out of date
+        self.packed = None
+
+    def add(self, node):
+        if node.long_id not in self.nodes:
+            bisect.insort(self.ids, node.long_id)
+            self.packed = None
+        self.nodes[node.long_id] = node
+
+    def remove(self, node):
+        if self.nodes.pop(node.long_id, None) is not None:
+            del self.ids[bisect.bisect_left(self.ids, node.long_id)]
+            self.packed = None
+
+    def closest(self, target, k):
+        """
+        Up to k contacts closest to the id target, nearest first.
+        """
+        nodes = self.nodes
+        return [nodes[long_id]
+                for long_id in self._closest(target, k, 0, len(self.ids))]
+
+    def closest_many(self, targets, k):
+        """
+        For each of the ids targets, up to k contacts closest to it, nearest
+        first, compared in bulk when the distance kernel has NumPy and the
+        table is small enough for a full scan to beat the bisect.
+        """
+        if not distance.HAVE_NUMPY or len(self.ids) > self.kernel_max:
+            return [self.closest(target, k) for target in targets]
+        if self.packed is None:
+            self.packed = distance.pack(self.ids)
+        ids, nodes = self.ids, self.nodes
+        return [[nodes[ids[i]] for i in row] for row in
+                distance.nearest(targets, ids, k, self.packed)]
+
+    def _closest(self, target, count, first, last):
+        """
+        The count ids of ids[first:last] closest to target, nearest first.
+        That slice is a run around target.
+        """
+        ids = self.ids
+        if last - first <= count:
+            return sorted(ids[first:last], key=target.__xor__)
+
+        high = self._span(target, count, first, last)
+        if not high:
+            return [target]
+
+        # all of the half run holding target is needed, and the closest ids
+        # of the other half are the closest ones to target with that bit
+        # flipped, which falls in it
+        half = high - 1
+        start = (target >> half) << half
+        inner_first = bisect.bisect_left(ids, start, first, last)
+        inner_last = bisect.bisect_left(ids, start + (1 << half),
+                                        inner_first, last)
+        inner = sorted(ids[inner_first:inner_last], key=target.__xor__)
+        flipped = target ^ (1 << half)
+        if flipped > target:
+            outer_first = inner_last
+            outer_last = bisect.bisect_left(ids, start + (2 << half),
+                                            inner_last, last)
+        else:
+            outer_first = bisect.bisect_left(ids, start - (1 << half),
+                                             first, inner_first)
+            outer_last = inner_first
+        return inner + self._closest(flipped, count - len(inner),
+                                     outer_first, outer_last)
+
+    def branches(self, target):
+        """
+        Mask of the bits at which some id first differs from target, where
+        the ids branch off the path to target in a binary trie of them.
+        """
+        ids = self.ids
+        mask = 0
+        for bit in range(160):
+            # ids sharing the bits of target above bit but not bit itself
+            start = ((target >> bit) ^ 1) << bit
+            index = bisect.bisect_left(ids, start)
+            if index < len(ids) and ids[index] < start + (1 << bit):
+                mask |= 1 << bit
+        return mask
+
+    def _span(self, target, count, first, last):
+        # bisect on the low bits left free, the run ids[first:last] around
+        # target holds at least count ids
+        ids = self.ids
+        low = 0
+        high = max((target ^ ids[first]).bit_length(),
+                   (target ^ ids[last - 1]).bit_length())
+        while low < high:
+            bits = (low + high) // 2
+            start = (target >> bits) << bits
+            size = bisect.bisect_left(ids, start + (1 << bits), first, last) \
+                - bisect.bisect_left(ids, start, first, last)
+            if size >= count:
+                high = bits
+            else:
+                low = bits + 1
+        return high
+
+    def __len__(self):
+        return len(self.ids)
 
 
 class KBucket:
-    def __init__(self, rangeLower, rangeUpper, ksize):
+    def __init__(self, rangeLower, rangeUpper, ksize, index=None):
         self.range = (rangeLower, rangeUpper)
         self.nodes = OrderedDict()
         self.replacement_nodes = OrderedDict()
         self.touch_last_updated()
         self.ksize = ksize
+        # the table wide ContactIndex kept in sync with self.nodes
+        self.index = index
 
     def touch_last_updated(self):
         self.last_updated = time.monotonic()
@@ -23,9 +151,9 @@ class KBucket:
         return list(self.nodes.values())
 
     def split(self):
-        midpoint = (self.range[0] + self.range[1]) / 2
-        one = KBucket(self.range[0], midpoint, self.ksize)
-        two = KBucket(midpoint + 1, self.range[1], self.ksize)
+        midpoint = (self.range[0] + self.range[1]) // 2
+        one = KBucket(self.range[0], midpoint, self.ksize, self.index)
+        two = KBucket(midpoint + 1, self.range[1], self.ksize, self.index)
         nodes = chain(self.nodes.values(), self.replacement_nodes.values())
         for node in nodes:
             bucket = one if node.long_id <= midpoint else two
@@ -39,10 +167,8 @@ class KBucket:
 
         if node.id in self.nodes:
             del self.nodes[node.id]
-
-            if self.replacement_nodes:
-                newnode_id, newnode = self.replacement_nodes.popitem()
-                self.nodes[newnode_id] = newnode
+            if self.index is not None:
+                self.index.remove(node)
 
     def has_in_range(self, node):
         return self.range[0] <= node.long_id <= self.range[1]
@@ -61,12 +187,19 @@ class KBucket:
                 del self.replacement_nodes[node.id]
             self.replacement_nodes[node.id] = node
             return False
+        if self.index is not None:
+            self.index.add(node)
         return True
 
     def depth(self):
-        vals = self.nodes.values()
-        sprefix = shared_prefix([bytes_to_bit_string(n.id) for n in vals])
-        return len(sprefix)
+        """
+        Number of leading bits shared by the ids of all nodes in the bucket.
+        """
+        if not self.nodes:
+            return 0
+        ids = [n.long_id for n in self.nodes.values()]
+        # the smallest and largest ids differ at the first unshared bit
+        return 160 - (min(ids) ^ max(ids)).bit_length()
 
     def head(self):
         return list(self.nodes.values())[0]
@@ -78,63 +211,107 @@ class KBucket:
         return len(self.nodes)
 
 
-class TableTraverser:
-    def __init__(self, table, startNode):
-        index = table.get_bucket_for(startNode)
-        table.buckets[index].touch_last_updated()
-        self.current_nodes = table.buckets[index].get_nodes()
-        self.left_buckets = table.buckets[:index]
-        self.right_buckets = table.buckets[(index + 1):]
-        self.left = True
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        if self.current_nodes:
-            return self.current_nodes.pop()
-
-        if self.left and self.left_buckets:
-            self.current_nodes = self.left_buckets.pop().get_nodes()
-            self.left = False
-            return next(self)
-
-        if self.right_buckets:
-            self.current_nodes = self.right_buckets.pop(0).get_nodes()
-            self.left = True
-            return next(self)
-
-        raise StopIteration
-
-
 class RoutingTable:
-    def __init__(self, protocol, ksize, node):
+    # round trip time assumed for contacts never timed, like the initial
+    # retransmission timeout of the RPC layer
+    unknown_rtt = 1.0
+
+    def __init__(self, protocol, ksize, node, max_failures=3):
         self.node = node
         self.protocol = protocol
         self.ksize = ksize
+        # consecutive failed calls before a contact is dropped
+        self.max_failures = max_failures
+        # ids of the bucket heads being pinged
+        self.checking = set()
         self.flush()
 
     def flush(self):
-        self.buckets = [KBucket(0, 2 ** 160, self.ksize)]
+        self.contacts = ContactIndex()
+        self.buckets = [KBucket(0, 2 ** 160 - 1, self.ksize, self.contacts)]
+        # inclusive upper bound of each bucket, sorted like self.buckets
+        self.bounds = [self.buckets[0].range[1]]
+        # node id -> time a contact was last heard from
+        self.last_seen = {}
+        # node id -> calls to the contact that failed in a row
+        self.failures = {}
 
     def split_bucket(self, index):
         one, two = self.buckets[index].split()
         self.buckets[index] = one
         self.buckets.insert(index + 1, two)
+        self.bounds[index] = one.range[1]
+        self.bounds.insert(index + 1, two.range[1])
 
-    def lonely_buckets(self):
-        hrago = time.monotonic() - 3600
+    def lonely_buckets(self, max_age=3600):
+        hrago = time.monotonic() - max_age
         return [b for b in self.buckets if b.last_updated < hrago]
 
     def remove_contact(self, node):
         index = self.get_bucket_for(node)
-        self.buckets[index].remove_node(node)
+        bucket = self.buckets[index]
+        bucket.remove_node(node)
+        self.last_seen.pop(node.id, None)
+        self.failures.pop(node.id, None)
+        if bucket.replacement_nodes and len(bucket) < self.ksize:
+            asyncio.ensure_future(self.promote_replacement(node))
+
+    async def promote_replacement(self, node):
+        """
+        Fill the free slot left in the bucket of the id of node with its
+        most recently seen replacement that still answers a ping.
+        Replacements that do not are dropped.
+        """
+        while True:
+            # the bucket may have been split while pinging
+            bucket = self.buckets[self.get_bucket_for(node)]
+            if not bucket.replacement_nodes or len(bucket) >= self.ksize:
+                return False
+            _, candidate = bucket.replacement_nodes.popitem()
+            # a successful ping welcomes it into the bucket
+            result = await self.protocol.call_ping(candidate)
+            if result[0]:
+                return True
+
+    def mark_seen(self, node):
+        self.last_seen[node.id] = time.monotonic()
+        self.failures.pop(node.id, None)
+
+    def by_latency(self, nodes, target):
+        """
+        nodes ordered by the bucket of target they fall in, that is by the
+        length of their XOR distance to it, and the fastest first among
+        the contacts of a bucket, which are equally useful to a lookup.
+        Round trip times are the ones the RPC layer measured.
+        """
+        get_rtt, unknown = self.protocol.get_rtt, self.unknown_rtt
+        estimates = {n.id: get_rtt((n.ip, n.port)) for n in nodes}
+        return sorted(nodes, key=lambda n: (
+            (n.long_id ^ target.long_id).bit_length(),
+            unknown if estimates[n.id] is None else estimates[n.id][0]))
+
+    def mark_failed(self, node):
+        """
+        Count a failed call to node, dropping it once max_failures calls in
+        a row have failed. Returns whether it was dropped. Failures of nodes
+        that are not contacts of the table are not counted.
+        """
+        if self.contacts.nodes.get(node.long_id) is not node:
+            return False
+        failures = self.failures.get(node.id, 0) + 1
+        if failures < self.max_failures:
+            self.failures[node.id] = failures
+            return False
+        self.remove_contact(node)
+        return True
 
     def is_new_node(self, node):
         index = self.get_bucket_for(node)
         return self.buckets[index].is_new_node(node)
 
     def add_contact(self, node):
+        self.last_seen[node.id] = time.monotonic()
+        self.failures.pop(node.id, None)
         index = self.get_bucket_for(node)
         bucket = self.buckets[index]
 
@@ -145,22 +322,121 @@ class RoutingTable:
             self.split_bucket(index)
             self.add_contact(node)
         else:
-            asyncio.ensure_future(self.protocol.call_ping(bucket.head()))
+            self.check_head(bucket)
+
+    def check_head(self, bucket):
+        """
+        Ping the least recently seen contact of a full bucket, unless that
+        is already being done for an earlier contact that did not fit.
+        """
+        head = bucket.head()
+        if head.id not in self.checking:
+            self.checking.add(head.id)
+            asyncio.ensure_future(self._check_head(head))
+
+    async def _check_head(self, head):
+        try:
+            result = await self.protocol.call_ping(head)
+        finally:
+            self.checking.discard(head.id)
+        bucket = self.buckets[self.get_bucket_for(head)]
+        if result[0] and not bucket.is_new_node(head):
+            # move it to the tail, the next check looks at another contact
+            bucket.add_node(head)
+
+    def neighbourhood(self, node):
+        """
+        The ids closer to node than to any contact: those sharing with node
+        every bit of the mask returned, which lie in the range [lower,
+        upper) also returned.
+
+        The closest contact to an id is found walking down a binary trie of
+        the contacts along the bits of the id, so an id differing from node
+        at a bit where a contact branches off the path to node is closer to
+        that contact. The leading bits all in the mask give the range.
+        """
+        mask = self.contacts.branches(node.long_id)
+        bits = (mask ^ (2 ** 160 - 1)).bit_length()
+        lower = (node.long_id >> bits) << bits
+        return lower, lower + (1 << bits), mask
 
     def get_bucket_for(self, node):
-        for index, bucket in enumerate(self.buckets):
-            if node.long_id < bucket.range[1]:
-                return index
-        return None
-
-    def find_neighbors(self, node, k=None, exclude=None):
+        # buckets cover contiguous ranges, the first one whose upper bound
+        # is not below the id holds it
+        index = bisect.bisect_left(self.bounds, node.long_id)
+        if index == len(self.bounds):
+            return None
+        return index
+
+    def find_neighbors(self, node, k=None, exclude=None, fast=False):
+        """
+        The k contacts closest to node, leaving out node itself and the
+        contacts at exclude. With fast, the contacts of the farthest bucket
+        reached are the fastest of the 2k closest, see by_latency.
+        """
         k = k or self.ksize
-        nodes = []
-        for neighbor in TableTraverser(self, node):
-            notexcluded = exclude is None or not neighbor.same_home_as(exclude) #<-- exclude or node ??
-            if neighbor.id != node.id and notexcluded:
-                heapq.heappush(nodes, (node.distance_to(neighbor), neighbor))
-            if len(nodes) == k:
+        if fast:
+            neighbors = self.find_neighbors(node, 2 * k, exclude)
+            return self.by_latency(neighbors, node)[:k]
+        self.buckets[self.get_bucket_for(node)].touch_last_updated()
+        # the node itself is left out, as well as contacts at exclude
+        wanted = k + (node.long_id in self.contacts.nodes)
+        while True:
+            nearest = self.contacts.closest(node.long_id, wanted)
+            neighbors = [n for n in nearest if n.id != node.id and
+                         (exclude is None or not n.same_home_as(exclude))]
+            if len(neighbors) >= k or len(nearest) < wanted:
+                return neighbors[:k]
+            # ask again for as many more as were left out
+            wanted += k - len(neighbors)
+
+    def snapshot(self):
+        """
+        The buckets and their contacts as plain tuples that survive a
+        restart, times being ages in seconds: (lower, upper, age, contacts,
+        replacements) for each bucket and (id, ip, port, age) for each
+        contact.
+        """
+        now = time.monotonic()
+
+        def contacts(nodes):
+            return [(n.id, n.ip, n.port, now - self.last_seen.get(n.id, now))
+                    for n in nodes.values()]
+        return [(b.range[0], b.range[1], now - b.last_updated,
+                 contacts(b.nodes), contacts(b.replacement_nodes))
+                for b in self.buckets]
+
+    def load_snapshot(self, snapshot):
+        """
+        Replace the table with the one in snapshot, keeping its bucket
+        layout if it still covers the whole id space.
+        """
+        self.flush()
+        now = time.monotonic()
+        expected = 0
+        for lower, upper, _, _, _ in snapshot:
+            if lower != expected or upper < lower:
                 break
+            expected = upper + 1
+
+        if expected != 2 ** 160:
+            log.warning("snapshot buckets do not cover the id space, "
+                        "adding its contacts one by one")
+            for _, _, _, contacts, replacements in snapshot:
+                for node_id, ip, port, age in chain(contacts, replacements):
+                    node = Node(node_id, ip, port)
+                    self.add_contact(node)
+                    self.last_seen[node.id] = now - age
+            return
 
-        return list(map(operator.itemgetter(1), heapq.nsmallest(k, nodes)))
+        self.buckets = []
+        for lower, upper, age, contacts, replacements in snapshot:
+            bucket = KBucket(lower, upper, self.ksize, self.contacts)
+            bucket.last_updated = now - age
+            for node_id, ip, port, seen in chain(contacts, replacements):
+                node = Node(node_id, ip, port)
+                if bucket.has_in_range(node):
+                    bucket.add_node(node)
+                    self.last_seen[node.id] = now - seen
+            self.buckets.append(bucket)
+        self.bounds = [bucket.range[1] for bucket in self.buckets]
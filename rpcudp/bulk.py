@@ -0,0 +1,195 @@
+"""
+TCP side channel for message bodies too large to send comfortably over UDP.
+
+The side that has a large message registers it as an offer and only sends a
+small descriptor carrying the offer token over UDP. The receiving side then
+pulls the bytes from the sender's TCP listener, which is bound to the same
+port number as its UDP endpoint, over a pooled connection.
+"""
+import asyncio
+import logging
+import os
+import struct
+
+LOG = logging.getLogger(__name__)
+
+TOKEN_SIZE = 16
+
+FOUND = 0
+MISSING = 1
+
+# status, length of the body that follows
+REPLY_HEADER = struct.Struct('>BQ')
+
+
+class _Connection:  # pylint: disable=too-few-public-methods
+    """
+    A pooled client connection to the bulk listener of one peer.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.lock = asyncio.Lock()
+        self.idle = None
+
+    def close(self):
+        """
+        Close the connection and forget its idle timer.
+        """
+        if self.idle is not None:
+            self.idle.cancel()
+        self.writer.close()
+
+
+class BulkChannel:  # pylint: disable=too-many-instance-attributes
+    """
+    Serves offered payloads to peers and fetches payloads offered by peers.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, offer_timeout=30, idle_timeout=60, fetch_timeout=30,
+                 max_size=2 ** 28):
+        """
+        Create a bulk channel.
+
+        Args:
+            offer_timeout (int): Time an unfetched offer is kept around
+            idle_timeout (int): Time an unused pooled connection stays open
+            fetch_timeout (int): Time a fetch may take before giving up
+            max_size (int): Largest payload accepted from a peer
+        """
+        self._offer_timeout = offer_timeout
+        self._idle_timeout = idle_timeout
+        self._fetch_timeout = fetch_timeout
+        self._max_size = max_size
+        self._offers = {}
+        self._pool = {}
+        self._server = None
+        # serving task -> writer of the connection it serves
+        self._serving = {}
+
+    @property
+    def listening(self):
+        """
+        Whether the channel serves offers to peers.
+        """
+        return self._server is not None
+
+    async def listen(self, host, port):
+        """
+        Serve offers to peers on a TCP listener at host and port.
+        """
+        self._server = await asyncio.start_server(self._serve, host, port)
+        LOG.info("bulk channel listening on %s:%i", host, port)
+
+    def close(self):
+        """
+        Stop serving, closing every connection and dropping every offer.
+        """
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for task, writer in list(self._serving.items()):
+            writer.close()
+            task.cancel()
+        self._serving.clear()
+        for _, handle in self._offers.values():
+            handle.cancel()
+        self._offers.clear()
+        for connection in self._pool.values():
+            connection.close()
+        self._pool.clear()
+
+    def offer(self, data):
+        """
+        Make an in-memory payload available to peers, returning its token.
+        """
+        token = os.urandom(TOKEN_SIZE)
+        loop = asyncio.get_event_loop()
+        handle = loop.call_later(self._offer_timeout,
+                                 self._offers.pop, token, None)
+        self._offers[token] = (data, handle)
+        return token
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self._serving[task] = writer
+        try:
+            while True:
+                token = await reader.readexactly(TOKEN_SIZE)
+                payload, handle = self._offers.pop(token, (None, None))
+                if payload is None:
+                    writer.write(REPLY_HEADER.pack(MISSING, 0))
+                else:
+                    handle.cancel()
+                    writer.write(REPLY_HEADER.pack(FOUND, len(payload)))
+                    writer.write(payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            self._serving.pop(task, None)
+            writer.close()
+
+    async def fetch(self, address, token):
+        """
+        Pull the payload offered as token by the peer at address. Returns
+        None if the peer is unreachable, too slow, no longer has the offer
+        or offers more than max_size bytes.
+        """
+        try:
+            return await asyncio.wait_for(self._fetch(address, token),
+                                          self._fetch_timeout)
+        except asyncio.TimeoutError:
+            LOG.warning("bulk fetch from %s timed out", address)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as err:
+            LOG.warning("bulk fetch from %s failed: %s", address, err)
+        self._drop(address)
+        return None
+
+    async def _fetch(self, address, token):
+        connection = await self._connect(address)
+        async with connection.lock:
+            connection.writer.write(token)
+            header = await connection.reader.readexactly(REPLY_HEADER.size)
+            status, size = REPLY_HEADER.unpack(header)
+            if size > self._max_size:
+                LOG.warning("bulk offer of %i bytes from %s is too large",
+                            size, address)
+                # the body is still coming, the connection is useless
+                self._drop(address)
+                return None
+            data = await connection.reader.readexactly(size)
+        self._touch(address, connection)
+
+        if status != FOUND:
+            LOG.warning("bulk offer from %s is gone", address)
+            return None
+        return data
+
+    async def _connect(self, address):
+        connection = self._pool.get(address)
+        if connection is not None and not connection.writer.is_closing():
+            self._touch(address, connection)
+            return connection
+        reader, writer = await asyncio.open_connection(*address)
+        existing = self._pool.get(address)
+        if existing is not None and not existing.writer.is_closing():
+            # another fetch connected while we were waiting
+            writer.close()
+            return existing
+        connection = _Connection(reader, writer)
+        self._pool[address] = connection
+        self._touch(address, connection)
+        return connection
+
+    def _touch(self, address, connection):
+        if connection.idle is not None:
+            connection.idle.cancel()
+        loop = asyncio.get_event_loop()
+        connection.idle = loop.call_later(self._idle_timeout,
+                                          self._drop, address)
+
+    def _drop(self, address):
+        connection = self._pool.pop(address, None)
+        if connection is not None:
+            connection.close()
@@ -0,0 +1,373 @@
+"""
+Fast msgpack encoder/decoder for the frames the RPC layer actually sends.
+
+Frames are ``[name, args]`` arrays whose arguments are method names, 20 byte
+node ids, ``(id, ip, port)`` contact triples, small ints and binary values.
+This module packs and unpacks exactly that subset of msgpack with
+precompiled ``struct.Struct`` objects and per-type / per-leading-byte
+dispatch tables. Its output is plain msgpack, byte for byte what
+``umsgpack.packb`` produces for these types, and anything outside the
+subset (floats, ext types, timestamps, huge ints) is handed to the generic
+umsgpack implementation.
+
+For the compact framing, lists of IPv4 contacts can also be packed as an
+ext holding fixed 26 byte records, see packb_compact.
+"""
+import io
+import socket
+import struct
+
+from rpcudp import umsgpack
+
+_U8 = struct.Struct('>B')
+_U16 = struct.Struct('>H')
+_U32 = struct.Struct('>I')
+_U64 = struct.Struct('>Q')
+_I8 = struct.Struct('>b')
+_I16 = struct.Struct('>h')
+_I32 = struct.Struct('>i')
+_I64 = struct.Struct('>q')
+_F32 = struct.Struct('>f')
+_F64 = struct.Struct('>d')
+
+# the header of a 20 byte node id, by far the most common binary
+_BIN20 = b'\xc4\x14'
+_FIXINTS = [bytes((i,)) for i in range(128)]
+
+
+##############################################################################
+# Packing
+##############################################################################
+
+
+def _pack_none(_obj, parts):
+    parts.append(b'\xc0')
+
+
+def _pack_bool(obj, parts):
+    parts.append(b'\xc3' if obj else b'\xc2')
+
+
+def _pack_int(obj, parts):
+    if 0 <= obj < 128:
+        parts.append(_FIXINTS[obj])
+    elif 0 <= obj < 0x10000:
+        if obj < 0x100:
+            parts.append(b'\xcc' + _U8.pack(obj))
+        else:
+            parts.append(b'\xcd' + _U16.pack(obj))
+    elif 0 <= obj < 0x100000000:
+        parts.append(b'\xce' + _U32.pack(obj))
+    else:
+        # negative and 64 bit ints are rare on the wire
+        parts.append(umsgpack.packb(obj))
+
+
+def _pack_bytes(obj, parts):
+    size = len(obj)
+    if size == 20:
+        parts.append(_BIN20)
+    elif size < 0x100:
+        parts.append(b'\xc4' + _U8.pack(size))
+    elif size < 0x10000:
+        parts.append(b'\xc5' + _U16.pack(size))
+    else:
+        parts.append(b'\xc6' + _U32.pack(size))
+    parts.append(obj)
+
+
+def _pack_str(obj, parts):
+    data = obj.encode('utf-8')
+    size = len(data)
+    if size < 32:
+        parts.append(_FIXSTRS[size])
+    elif size < 0x100:
+        parts.append(b'\xd9' + _U8.pack(size))
+    elif size < 0x10000:
+        parts.append(b'\xda' + _U16.pack(size))
+    else:
+        parts.append(b'\xdb' + _U32.pack(size))
+    parts.append(data)
+
+
+def _pack_array(obj, parts):
+    size = len(obj)
+    if size < 16:
+        parts.append(_FIXARRAYS[size])
+    elif size < 0x10000:
+        parts.append(b'\xdc' + _U16.pack(size))
+    else:
+        parts.append(b'\xdd' + _U32.pack(size))
+    for item in obj:
+        _PACKERS.get(item.__class__, _pack_other)(item, parts)
+
+
+def _pack_map(obj, parts):
+    size = len(obj)
+    if size < 16:
+        parts.append(_FIXMAPS[size])
+    elif size < 0x10000:
+        parts.append(b'\xde' + _U16.pack(size))
+    else:
+        parts.append(b'\xdf' + _U32.pack(size))
+    for key, value in obj.items():
+        _PACKERS.get(key.__class__, _pack_other)(key, parts)
+        _PACKERS.get(value.__class__, _pack_other)(value, parts)
+
+
+def _pack_other(obj, parts):
+    parts.append(umsgpack.packb(obj))
+
+
+_FIXSTRS = [bytes((0xa0 | i,)) for i in range(32)]
+_FIXARRAYS = [bytes((0x90 | i,)) for i in range(16)]
+_FIXMAPS = [bytes((0x80 | i,)) for i in range(16)]
+
+_PACKERS = {
+    type(None): _pack_none,
+    bool: _pack_bool,
+    int: _pack_int,
+    bytes: _pack_bytes,
+    str: _pack_str,
+    list: _pack_array,
+    tuple: _pack_array,
+    dict: _pack_map,
+}
+
+
+def packb(obj):
+    """
+    Serialize obj into msgpack bytes, like umsgpack.packb.
+    """
+    parts = []
+    _PACKERS.get(obj.__class__, _pack_other)(obj, parts)
+    return b''.join(parts)
+
+
+##############################################################################
+# Unpacking
+##############################################################################
+
+
+def _need(buf, end):
+    if end > len(buf):
+        raise umsgpack.InsufficientDataException()
+
+
+def _unpack_fixint(code, _buf, pos):
+    return code, pos
+
+
+def _unpack_negative_fixint(code, _buf, pos):
+    return code - 0x100, pos
+
+
+def _unpack_constant(value):
+    def unpack(_code, _buf, pos):
+        return value, pos
+    return unpack
+
+
+def _unpack_struct(fmt):
+    def unpack(_code, buf, pos):
+        return fmt.unpack_from(buf, pos)[0], pos + fmt.size
+    return unpack
+
+
+def _unpack_raw(fmt, decode):
+    def unpack(_code, buf, pos):
+        size = fmt.unpack_from(buf, pos)[0]
+        pos += fmt.size
+        end = pos + size
+        _need(buf, end)
+        if decode:
+            return buf[pos:end].decode('utf-8'), end
+        return buf[pos:end], end
+    return unpack
+
+
+def _unpack_fixstr(code, buf, pos):
+    end = pos + (code & 0x1f)
+    _need(buf, end)
+    return buf[pos:end].decode('utf-8'), end
+
+
+def _unpack_items(size, buf, pos):
+    items = []
+    append = items.append
+    for _ in range(size):
+        code = buf[pos]
+        item, pos = _UNPACKERS[code](code, buf, pos + 1)
+        append(item)
+    return items, pos
+
+
+def _unpack_fixarray(code, buf, pos):
+    return _unpack_items(code & 0x0f, buf, pos)
+
+
+def _unpack_array(fmt):
+    def unpack(_code, buf, pos):
+        size = fmt.unpack_from(buf, pos)[0]
+        return _unpack_items(size, buf, pos + fmt.size)
+    return unpack
+
+
+def _unpack_pairs(size, buf, pos):
+    items = {}
+    for _ in range(size):
+        code = buf[pos]
+        key, pos = _UNPACKERS[code](code, buf, pos + 1)
+        if isinstance(key, list):
+            key = umsgpack._deep_list_to_tuple(key)  # pylint: disable=W0212
+        code = buf[pos]
+        items[key], pos = _UNPACKERS[code](code, buf, pos + 1)
+    return items, pos
+
+
+def _unpack_fixmap(code, buf, pos):
+    return _unpack_pairs(code & 0x0f, buf, pos)
+
+
+def _unpack_map(fmt):
+    def unpack(_code, buf, pos):
+        size = fmt.unpack_from(buf, pos)[0]
+        return _unpack_pairs(size, buf, pos + fmt.size)
+    return unpack
+
+
+def _unpack_other(_code, buf, pos):
+    stream = io.BytesIO(buf)
+    stream.seek(pos - 1)
+    obj = umsgpack.unpack(stream)
+    return obj, stream.tell()
+
+
+def _build_unpackers():
+    table = [_unpack_other] * 256
+    for code in range(0x00, 0x80):
+        table[code] = _unpack_fixint
+    for code in range(0x80, 0x90):
+        table[code] = _unpack_fixmap
+    for code in range(0x90, 0xa0):
+        table[code] = _unpack_fixarray
+    for code in range(0xa0, 0xc0):
+        table[code] = _unpack_fixstr
+    table[0xc0] = _unpack_constant(None)
+    table[0xc2] = _unpack_constant(False)
+    table[0xc3] = _unpack_constant(True)
+    table[0xc4] = _unpack_raw(_U8, False)
+    table[0xc5] = _unpack_raw(_U16, False)
+    table[0xc6] = _unpack_raw(_U32, False)
+    table[0xca] = _unpack_struct(_F32)
+    table[0xcb] = _unpack_struct(_F64)
+    table[0xcc] = _unpack_struct(_U8)
+    table[0xcd] = _unpack_struct(_U16)
+    table[0xce] = _unpack_struct(_U32)
+    table[0xcf] = _unpack_struct(_U64)
+    table[0xd0] = _unpack_struct(_I8)
+    table[0xd1] = _unpack_struct(_I16)
+    table[0xd2] = _unpack_struct(_I32)
+    table[0xd3] = _unpack_struct(_I64)
+    table[0xd9] = _unpack_raw(_U8, True)
+    table[0xda] = _unpack_raw(_U16, True)
+    table[0xdb] = _unpack_raw(_U32, True)
+    table[0xdc] = _unpack_array(_U16)
+    table[0xdd] = _unpack_array(_U32)
+    table[0xde] = _unpack_map(_U16)
+    table[0xdf] = _unpack_map(_U32)
+    for code in range(0xe0, 0x100):
+        table[code] = _unpack_negative_fixint
+    return table
+
+
+_UNPACKERS = _build_unpackers()
+
+
+def unpack_from(buf, offset=0, end=None):
+    """
+    Deserialize the msgpack object starting at offset in the bytes buf,
+    without copying the rest of the buffer. An object running past end,
+    when given, is as truncated as one running past the end of buf.
+    """
+    try:
+        code = buf[offset]
+        obj, pos = _UNPACKERS[code](code, buf, offset + 1)
+    except (IndexError, struct.error) as err:
+        raise umsgpack.InsufficientDataException() from err
+    except UnicodeDecodeError as err:
+        raise umsgpack.InvalidStringException(
+            "unpacked string is invalid utf-8") from err
+    if end is not None and pos > end:
+        raise umsgpack.InsufficientDataException()
+    return obj
+
+
+def unpackb(buf):
+    """
+    Deserialize msgpack bytes into a Python object, like umsgpack.unpackb.
+    """
+    return unpack_from(buf, 0)
+
+
+##############################################################################
+# Compact contact lists
+##############################################################################
+
+CONTACTS_EXT = 1
+
+# 20 byte node id, IPv4 address, port
+CONTACT = struct.Struct('>20s4sH')
+
+
+def _pack_contacts(obj):
+    """
+    Pack a list of (id, ip, port) contacts into fixed size records, or
+    return None if obj is not such a list of IPv4 contacts.
+    """
+    if not isinstance(obj, (list, tuple)) or not obj:
+        return None
+    records = []
+    for contact in obj:
+        if not isinstance(contact, (list, tuple)) or len(contact) != 3:
+            return None
+        node_id, host, port = contact
+        if not isinstance(node_id, bytes) or len(node_id) != 20 \
+                or not isinstance(host, str) or not isinstance(port, int):
+            return None
+        try:
+            records.append(CONTACT.pack(node_id, socket.inet_pton(
+                socket.AF_INET, host), port))
+        except (OSError, struct.error):
+            return None
+    return b''.join(records)
+
+
+def packb_compact(obj):
+    """
+    Serialize obj like packb, except that a list of contacts is packed as
+    an ext of 26 byte records instead of an array of arrays.
+    """
+    records = _pack_contacts(obj)
+    if records is None:
+        return packb(obj)
+    return umsgpack.packb(umsgpack.Ext(CONTACTS_EXT, records))
+
+
+def _contact(node_id, host, port):
+    return (node_id, host, port)
+
+
+def unpack_compact_from(buf, offset=0, contact=_contact, end=None):
+    """
+    Deserialize an object packed with packb_compact, building each contact
+    of a contact list with contact(id, ip, port).
+    """
+    obj = unpack_from(buf, offset, end)
+    if not isinstance(obj, umsgpack.Ext) or obj.type != CONTACTS_EXT:
+        return obj
+    if len(obj.data) % CONTACT.size:
+        raise umsgpack.InsufficientDataException()
+    ntoa = socket.inet_ntoa
+    return [contact(node_id, ntoa(host), port)
+            for node_id, host, port in CONTACT.iter_unpack(obj.data)]
@@ -0,0 +1,147 @@
+"""
+Counters and latency histograms for the RPCs a node sends and serves.
+
+Everything is kept per method name in plain integers and fixed bucket
+histograms, so recording a call is a few additions and one bisect, cheap
+enough to leave on all the time. Snapshots are plain dicts of lists and
+numbers, which pack to msgpack as they are and can be served to peers.
+"""
+import bisect
+
+# upper bounds in seconds of the latency buckets, the last bucket of a
+# histogram counts everything slower than the largest bound
+LATENCY_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                  0.5, 1.0, 2.5, 5.0, 10.0)
+
+OK = 'ok'
+FAILED = 'failed'
+TIMEOUT = 'timeout'
+BUSY = 'busy'
+
+
+class _MethodMetrics:  # pylint: disable=R0902,R0903
+    """
+    What is known about one method, on the calling or the serving side.
+    """
+    __slots__ = ('count', 'outcomes', 'bytes_out', 'bytes_in',
+                 'outstanding', 'max_outstanding', 'latency', 'total_time')
+
+    def __init__(self, buckets):
+        self.count = 0
+        self.outcomes = {OK: 0, FAILED: 0, TIMEOUT: 0, BUSY: 0}
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.outstanding = 0
+        self.max_outstanding = 0
+        self.latency = [0] * buckets
+        self.total_time = 0.0
+
+    def as_dict(self):
+        """
+        Snapshot of the counters of the method.
+        """
+        return {
+            'count': self.count,
+            'ok': self.outcomes[OK],
+            'failed': self.outcomes[FAILED],
+            'timeouts': self.outcomes[TIMEOUT],
+            'busy': self.outcomes[BUSY],
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'outstanding': self.outstanding,
+            'max_outstanding': self.max_outstanding,
+            'latency': list(self.latency),
+            'total_time': self.total_time,
+        }
+
+
+class RPCMetrics:
+    """
+    Per method metrics for calls made to peers and requests served to them.
+    """
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        """
+        Create an empty set of metrics.
+
+        Args:
+            bounds (tuple): Sorted upper bounds in seconds of the latency
+                            histogram buckets
+        """
+        self._bounds = tuple(bounds)
+        self._calls = {}
+        self._served = {}
+
+    def _method(self, table, name):
+        metrics = table.get(name)
+        if metrics is None:
+            metrics = table[name] = _MethodMetrics(len(self._bounds) + 1)
+        return metrics
+
+    @staticmethod
+    def _start(metrics):
+        metrics.count += 1
+        metrics.outstanding += 1
+        if metrics.outstanding > metrics.max_outstanding:
+            metrics.max_outstanding = metrics.outstanding
+
+    def _finish(self, metrics, elapsed, outcome):
+        metrics.outstanding -= 1
+        metrics.outcomes[outcome] += 1
+        metrics.latency[bisect.bisect_left(self._bounds, elapsed)] += 1
+        metrics.total_time += elapsed
+
+    def call_sent(self, name, size):
+        """
+        Record a call of name sent to a peer with a size bytes payload.
+        """
+        metrics = self._method(self._calls, name)
+        metrics.bytes_out += size
+        self._start(metrics)
+
+    def call_done(self, name, elapsed, outcome, size=0):
+        """
+        Record the end of a call of name after elapsed seconds, with a size
+        bytes response if it got one.
+        """
+        metrics = self._method(self._calls, name)
+        metrics.bytes_in += size
+        self._finish(metrics, elapsed, outcome)
+
+    def request_received(self, name, size):
+        """
+        Record a request for name with a size bytes payload from a peer,
+        accepted for handling.
+        """
+        metrics = self._method(self._served, name)
+        metrics.bytes_in += size
+        self._start(metrics)
+
+    def request_refused(self, name, size):
+        """
+        Record a request for name answered busy without being handled.
+        """
+        metrics = self._method(self._served, name)
+        metrics.count += 1
+        metrics.bytes_in += size
+        metrics.outcomes[BUSY] += 1
+
+    def request_done(self, name, elapsed, outcome, size=0):
+        """
+        Record the end of a request for name, elapsed seconds after it was
+        received, with a size bytes response if one was sent.
+        """
+        metrics = self._method(self._served, name)
+        metrics.bytes_out += size
+        self._finish(metrics, elapsed, outcome)
+
+    def as_dict(self):
+        """
+        Snapshot of all metrics, by side and then by method name.
+        """
+        return {
+            'latency_bounds': list(self._bounds),
+            'calls': {name: metrics.as_dict()
+                      for name, metrics in self._calls.items()},
+            'served': {name: metrics.as_dict()
+                       for name, metrics in self._served.items()},
+        }
@@ -2,60 +2,431 @@
 Package for interacting on the network via a Async Protocol
 """
 import asyncio
+import functools
+import itertools
 import logging
 import os
+import struct
+import time
 from base64 import b64encode
-from hashlib import sha1
+from collections import OrderedDict, deque
 
+from rpcudp import codec
+from rpcudp import metrics
 from rpcudp import umsgpack
 
+from rpcudp.bulk import BulkChannel, TOKEN_SIZE
 from rpcudp.exceptions import MalformedMessage
+from rpcudp.wheel import TimingWheel
 
 LOG = logging.getLogger(__name__)
 
+REQUEST = b'\x00'
+RESPONSE = b'\x01'
+FRAGMENT = b'\x02'
+FRAGMENT_ACK = b'\x03'
+BULK = b'\x04'
+BATCH = b'\x05'
+COMPACT_REQUEST = b'\x06'
+COMPACT_RESPONSE = b'\x07'
+BUSY = b'\x08'
 
-class RPCProtocol(asyncio.DatagramProtocol):
+REQUESTS = (REQUEST, COMPACT_REQUEST)
+RESPONSES = (RESPONSE, COMPACT_RESPONSE)
+
+# version of the compact framing, the first byte of every compact payload
+FRAMING_VERSION = 1
+FRAMING_HEADER = bytes((FRAMING_VERSION,))
+
+# kind of the fragmented message, fragment index, total fragments
+FRAGMENT_HEADER = struct.Struct('>cII')
+# kind of the fragmented message, number of fragments received in order
+ACK_HEADER = struct.Struct('>cI')
+SACK_ENTRY = struct.Struct('>I')
+# kind of the message offered over the bulk channel, offer token, size
+BULK_DESCRIPTOR = struct.Struct(f'>c{TOKEN_SIZE}sQ')
+# length of a datagram packed into a batch, followed by the datagram
+BATCH_ENTRY = struct.Struct('>H')
+# random per-protocol session salt, per-protocol message counter; the same
+# 20 bytes a message id has always taken on the wire
+MSG_ID = struct.Struct('>12sQ')
+
+
+class _Busy:  # pylint: disable=too-few-public-methods
+    """
+    Result payload of a call the peer refused because it is overloaded.
+    """
+    def __repr__(self):
+        return 'BUSY'
+
+
+# a call answered with a busy reply resolves to (False, BUSY_REPLY)
+BUSY_REPLY = _Busy()
+
+
+class _Call:  # pylint: disable=R0902,R0903
+    """
+    An outstanding request waiting for its response.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, name, future, address, datagram, deadline):
+        self.name = name
+        self.future = future
+        self.address = address
+        # kept for retransmission, None when the request was fragmented,
+        # which takes care of its own losses
+        self.datagram = datagram
+        # legacy encoding of a compact request, resent along with it for
+        # peers that turn out not to understand compact frames
+        self.fallback = None
+        self.deadline = deadline
+        self.sent = time.monotonic()
+        self.attempts = 0
+        self.timer = None
+
+
+class _Request:  # pylint: disable=R0902,R0903
+    """
+    A request from a peer waiting to be handled or being handled.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, msg_id, address, name, func, args, batched, compact):
+        self.msg_id = msg_id
+        self.address = address
+        self.name = name
+        self.func = func
+        self.args = args
+        self.batched = batched
+        self.compact = compact
+        self.received = time.monotonic()
+
+
+class _OutgoingTransfer:  # pylint: disable=too-few-public-methods
+    """
+    Sender side state of a message split into numbered fragments.
+    """
+    def __init__(self, fragments):
+        self.fragments = fragments
+        self.acked = set()
+        # lowest fragment index that has not been acknowledged yet
+        self.base = 0
+        # next fragment index that has never been sent
+        self.next = 0
+        # fragment index -> (time last sent, number of sends)
+        self.inflight = {}
+        self.timer = None
+
+    @property
+    def done(self):
+        """
+        Whether every fragment has been acknowledged.
+        """
+        return self.base >= len(self.fragments)
+
+
+class _IncomingTransfer:  # pylint: disable=too-few-public-methods
+    """
+    Receiver side state of a message being reassembled from fragments.
+    """
+    def __init__(self, total):
+        self.total = total
+        self.chunks = {}
+        # number of fragments received without gaps
+        self.cumulative = 0
+        self.done = False
+        self.expiry = None
+
+
+class _Batch:  # pylint: disable=too-few-public-methods
+    """
+    Datagrams waiting to be coalesced into one batch datagram.
+    """
+    def __init__(self):
+        self.datagrams = []
+        self.size = len(BATCH)
+        self.handle = None
+
+
+class RPCProtocol(asyncio.DatagramProtocol):  # pylint: disable=R0902
     """
     Protocol implementation using msgpack to encode messages and asyncio
     to handle async sending / recieving.
+
+    Messages that do not fit in ``max_datagram`` bytes are split into
+    numbered fragments that are sent with a sliding window, acknowledged
+    selectively by the receiver and reassembled there before being handled
+    like any other message.
+
+    Once ``listen_bulk`` has been called, messages larger than
+    ``bulk_threshold`` are not sent over UDP at all: only a descriptor is,
+    and the receiver pulls the body over TCP from the bulk channel.
+
+    Requests and fragments are resent when they are not answered within a
+    retransmission timeout derived from the smoothed round trip time and its
+    variance measured for each peer, doubling on every resend. All of these
+    timers live on a single timing wheel rather than one loop handle each.
+
+    With a ``batch_window``, small messages to the same peer are held for
+    that long and packed into one batch datagram of at most ``batch_budget``
+    bytes. Responses to requests that arrived in a batch are batched back,
+    even when the window is not set, since the peer understands batches.
+
+    Methods listed in ``rpc_methods`` are called with compact frames: a
+    framing version byte and a 1 byte method id (the index in
+    ``rpc_methods``) instead of the method name, and contact lists in
+    responses packed as fixed 26 byte records that are decoded straight
+    into ``contact_factory(id, ip, port)``. Peers not yet known to speak the
+    compact framing get the legacy frame when the compact one is resent.
+
+    Incoming requests wait in per-peer queues that are served round robin,
+    with at most ``max_active`` coroutine handlers running at once. Since
+    datagrams are read one per loop iteration and synchronous handlers run
+    right away, those queues rarely fill up; the backlog is rather measured
+    as leaky buckets filled by every request and drained at ``request_rate``
+    (``request_rate_per_peer`` for a single peer) requests per second. When
+    a request does not fit in the queues or the buckets, the peer gets an
+    immediate busy reply and its call resolves to ``(False, BUSY_REPLY)``
+    instead of timing out.
+
+    Calls made and requests served are counted per method in ``metrics``,
+    see rpcudp.metrics.RPCMetrics.
     """
-    def __init__(self, wait_timeout=5):
+    # append only, the position of a name is its id on the wire
+    rpc_methods = ()
+    contact_factory = tuple
+
+    # pylint: disable=too-many-arguments,too-many-locals
+    def __init__(self, wait_timeout=5, max_datagram=8192,
+                 fragment_size=1400, window=32, fragment_retries=8,
+                 max_fragments=65536, bulk_threshold=65536, retries=3,
+                 initial_rto=1.0, min_rto=0.05, reply_cache=1024,
+                 batch_window=None, batch_budget=1400, max_active=64,
+                 max_queued=1024, max_queued_per_peer=128,
+                 request_rate=10000, request_rate_per_peer=1000):
         """
         Create a protocol instance.
 
         Args:
             wait_timeout (int): Time to wait for a response before giving up
+            max_datagram (int): Largest message sent as a single datagram
+            fragment_size (int): Payload bytes carried by each fragment
+            window (int): Fragments that may be unacknowledged at once
+            fragment_retries (int): Resends of a fragment before giving up
+            max_fragments (int): Largest number of fragments in a message
+            bulk_threshold (int): Smallest message sent over the bulk channel
+            retries (int): Resends of a request before giving up
+            initial_rto (float): Retransmission timeout for unmeasured peers
+            min_rto (float): Lower bound for the retransmission timeout
+            reply_cache (int): Recent responses kept to answer resent
+                               requests without handling them twice
+            batch_window (float): Time to hold messages for coalescing,
+                                  None to send every message on its own
+            batch_budget (int): Largest batch datagram
+            max_active (int): Coroutine request handlers run concurrently
+            max_queued (int): Requests waiting to be handled before
+                              replying busy
+            max_queued_per_peer (int): Requests from a single peer waiting
+                                       to be handled before replying busy
+            request_rate (int): Requests per second handled before they
+                                count as waiting
+            request_rate_per_peer (int): Requests per second from a single
+                                         peer handled before they count as
+                                         waiting
         """
         self._wait_timeout = wait_timeout
+        self._max_datagram = max_datagram
+        self._fragment_size = fragment_size
+        self._window = window
+        self._fragment_retries = fragment_retries
+        self._max_fragments = max_fragments
+        self._retries = retries
+        self._initial_rto = initial_rto
+        self._min_rto = min_rto
+        self._reply_cache = reply_cache
         self._outstanding = {}
+        self._rtt = {}
+        self._replies = OrderedDict()
+        self._sending = {}
+        self._receiving = {}
+        self._bulk_threshold = bulk_threshold
+        self._batch_window = batch_window
+        self._batch_budget = batch_budget
+        self._batches = {}
+        self._max_active = max_active
+        self._max_queued = max_queued
+        self._max_queued_per_peer = max_queued_per_peer
+        # address -> requests waiting to be handled, in round robin order
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._active = 0
+        self._draining = None
+        self._request_rate = request_rate
+        self._request_rate_per_peer = request_rate_per_peer
+        # level of the leaky buckets and when they were last drained, the
+        # per-peer ones from the least to the most recently used
+        self._load = (0.0, time.monotonic())
+        self._peer_load = OrderedDict()
+        self._bulk = BulkChannel(offer_timeout=wait_timeout * 6,
+                                 fetch_timeout=wait_timeout * 6)
+        self._wheel = TimingWheel()
+        self._salt = os.urandom(12)
+        self._counter = itertools.count()
+        self._method_ids = {name: index
+                            for index, name in enumerate(self.rpc_methods)}
+        # address -> framing version the peer is known to speak
+        self._framing = {}
+        self.metrics = metrics.RPCMetrics()
         self.transport = None
 
     def connection_made(self, transport):
         self.transport = transport
 
+    async def listen_bulk(self, host, port):
+        """
+        Start the TCP listener that serves large message bodies to peers.
+        """
+        await self._bulk.listen(host, port)
+
+    def connection_lost(self, exc):
+        for transfer in self._sending.values():
+            if transfer.timer is not None:
+                transfer.timer.cancel()
+        for transfer in self._receiving.values():
+            if transfer.expiry is not None:
+                transfer.expiry.cancel()
+        for batch in self._batches.values():
+            batch.handle.cancel()
+        self._batches.clear()
+        if self._draining is not None:
+            self._draining.cancel()
+            self._draining = None
+        self._queues.clear()
+        self._queued = 0
+        self._peer_load.clear()
+        self._sending.clear()
+        self._receiving.clear()
+        self._bulk.close()
+        # the timers that would time out the calls in flight are dropped
+        # along with the wheel, so give up on those calls right away
+        now = time.monotonic()
+        for call in self._outstanding.values():
+            self.metrics.call_done(call.name, now - call.sent,
+                                   metrics.TIMEOUT)
+            if not call.future.done():
+                call.future.set_result((False, None))
+        self._outstanding.clear()
+        self._wheel.stop()
+
     def datagram_received(self, data, addr):
         LOG.debug("received datagram from %s", addr)
-        asyncio.ensure_future(self._solve_datagram(data, addr))
+        try:
+            if data[:1] == BATCH:
+                self._accept_batch(data, addr)
+            else:
+                self._solve_datagram(data, 0, len(data), addr)
+        except (MalformedMessage, umsgpack.UnpackException,
+                struct.error) as err:
+            LOG.warning("received malformed datagram from %s: %s", addr, err)
 
-    async def _solve_datagram(self, datagram, address):
-        if len(datagram) < 22:
+    # pylint: disable=too-many-arguments
+    def _solve_datagram(self, datagram, start, end, address, batched=False):
+        """
+        Handle the datagram found between start and end of the received
+        buffer, parsing it in place rather than slicing copies out of it.
+        """
+        if end - start < 21:
             LOG.warning("received datagram too small from %s,"
                         " ignoring", address)
             return
 
-        msg_id = datagram[1:21]
-        data = umsgpack.unpackb(datagram[21:])
+        kind = datagram[start:start + 1]
+        msg_id = datagram[start + 1:start + 21]
+        offset = start + 21
 
-        if datagram[:1] == b'\x00':
-            # schedule accepting request and returning the result
-            asyncio.ensure_future(self._accept_request(msg_id, data, address))
-        elif datagram[:1] == b'\x01':
-            self._accept_response(msg_id, data, address)
+        if kind in REQUESTS or kind in RESPONSES:
+            self._dispatch(kind, msg_id, datagram, offset, address, batched,
+                           end=end)
+        elif kind == FRAGMENT:
+            payload = memoryview(datagram)[offset:end]
+            self._accept_fragment(msg_id, payload, address)
+        elif kind == FRAGMENT_ACK:
+            payload = memoryview(datagram)[offset:end]
+            self._accept_fragment_ack(msg_id, payload, address)
+        elif kind == BULK:
+            payload = memoryview(datagram)[offset:end]
+            self._accept_bulk(msg_id, payload, address)
+        elif kind == BUSY:
+            self._accept_busy(msg_id, address)
         else:
             # otherwise, don't know the format, don't do anything
             LOG.debug("Received unknown message from %s, ignoring", address)
 
-    def _accept_response(self, msg_id, data, address):
+    def _accept_batch(self, datagram, address):
+        offset = len(BATCH)
+        while offset + BATCH_ENTRY.size <= len(datagram):
+            size, = BATCH_ENTRY.unpack_from(datagram, offset)
+            offset += BATCH_ENTRY.size
+            if offset + size > len(datagram):
+                LOG.warning("received truncated batch from %s", address)
+                return
+            self._solve_datagram(datagram, offset, offset + size, address,
+                                 batched=True)
+            offset += size
+
+    # pylint: disable=too-many-arguments
+    def _dispatch(self, kind, msg_id, buffer, offset, address,
+                  batched=False, seen=False, end=None):
+        end = len(buffer) if end is None else end
+        size = end - offset
+        compact = kind in (COMPACT_REQUEST, COMPACT_RESPONSE)
+        if not compact:
+            data = codec.unpack_from(buffer, offset, end)
+        elif offset + (2 if kind == COMPACT_REQUEST else 1) > end:
+            raise MalformedMessage("Truncated compact frame")
+        elif buffer[offset] != FRAMING_VERSION:
+            LOG.debug("received unsupported framing version %i from %s, "
+                      "ignoring", buffer[offset], address)
+            return
+        elif kind == COMPACT_RESPONSE:
+            self._framing[address] = FRAMING_VERSION
+            data = codec.unpack_compact_from(buffer, offset + 1,
+                                             self.contact_factory, end)
+        else:
+            self._framing[address] = FRAMING_VERSION
+            method = buffer[offset + 1]
+            if method >= len(self.rpc_methods):
+                raise MalformedMessage(f"Unknown method id {method}")
+            args = codec.unpack_from(buffer, offset + 2, end)
+            data = [self.rpc_methods[method], args]
+
+        if kind in RESPONSES:
+            self._accept_response(msg_id, data, address, size, compact)
+        elif not seen and self._is_duplicate(msg_id, address):
+            LOG.debug("received resent request %s from %s",
+                      b64encode(msg_id), address)
+        else:
+            self._accept_request(msg_id, data, address, batched, compact,
+                                 size)
+
+    def _is_duplicate(self, msg_id, address):
+        """
+        Check whether a request was seen before, answering it again from the
+        reply cache if its response has already been sent.
+        """
+        key = (address, msg_id)
+        if key not in self._replies:
+            self._replies[key] = None
+            while len(self._replies) > self._reply_cache:
+                self._replies.popitem(last=False)
+            return False
+        txdata = self._replies[key]
+        if txdata:
+            self.transport.sendto(txdata, address)
+        return True
+
+    # pylint: disable=too-many-arguments
+    def _accept_response(self, msg_id, data, address, size=0,
+                         compact=False):
         msgargs = (b64encode(msg_id), address)
         if msg_id not in self._outstanding:
             LOG.warning("received unknown message %s "
@@ -63,15 +434,76 @@ class RPCProtocol(asyncio.DatagramProtocol):
             return
         LOG.debug("received response %s for message "
                   "id %s from %s", data, *msgargs)
-        future, timeout = self._outstanding[msg_id]
-        timeout.cancel()
-        future.set_result((True, data))
-        del self._outstanding[msg_id]
+        call = self._outstanding.pop(msg_id)
+        call.timer.cancel()
+        elapsed = time.monotonic() - call.sent
+        self.metrics.call_done(call.name, elapsed, metrics.OK, size)
+        if call.attempts == 0 and call.datagram is not None \
+                and call.datagram[:1] != BULK:
+            # only unambiguous samples, as in Karn's algorithm
+            self._sample_rtt(address, elapsed)
+        if call.fallback is not None and call.attempts and not compact \
+                and address not in self._framing:
+            # answered in the legacy framing although the compact request
+            # was sent along with the legacy one
+            self._framing[address] = 0
+        if not call.future.done():
+            call.future.set_result((True, data))
+
+    def _accept_busy(self, msg_id, address):
+        if msg_id not in self._outstanding:
+            return
+        LOG.debug("peer %s too busy for message id %s",
+                  address, b64encode(msg_id))
+        call = self._outstanding.pop(msg_id)
+        call.timer.cancel()
+        self.metrics.call_done(call.name, time.monotonic() - call.sent,
+                               metrics.BUSY)
+        if not call.future.done():
+            call.future.set_result((False, BUSY_REPLY))
+
+    def _sample_rtt(self, address, rtt):
+        """
+        Fold a round trip time measurement into the smoothed estimate kept
+        for address (RFC 6298).
+        """
+        if address not in self._rtt:
+            self._rtt[address] = (rtt, rtt / 2)
+            return
+        srtt, rttvar = self._rtt[address]
+        rttvar = 0.75 * rttvar + 0.25 * abs(srtt - rtt)
+        srtt = 0.875 * srtt + 0.125 * rtt
+        self._rtt[address] = (srtt, rttvar)
 
-    async def _accept_request(self, msg_id, data, address):
+    def get_rtt(self, address):
+        """
+        The smoothed round trip time to address and its variance, or None
+        if it has not been measured.
+        """
+        return self._rtt.get(address)
+
+    def set_rtt(self, address, srtt, rttvar):
+        """
+        Seed the round trip estimate for address, e.g. with the one measured
+        before a restart.
+        """
+        self._rtt[address] = (srtt, rttvar)
+
+    def _rto(self, address):
+        if address not in self._rtt:
+            return self._initial_rto
+        srtt, rttvar = self._rtt[address]
+        rto = max(srtt + 4 * rttvar, self._min_rto)
+        return min(rto, self._wait_timeout)
+
+    # pylint: disable=too-many-arguments
+    def _accept_request(self, msg_id, data, address, batched=False,
+                        compact=False, size=0):
         if not isinstance(data, list) or len(data) != 2:
             raise MalformedMessage("Could not read packet: %s" % data)
         funcname, args = data
+        if not isinstance(args, list):
+            raise MalformedMessage(f"Arguments are not a list: {args}")
         func = getattr(self, "rpc_%s" % funcname, None)
         if func is None or not callable(func):
             msgargs = (self.__class__.__name__, funcname)
@@ -79,20 +511,422 @@ class RPCProtocol(asyncio.DatagramProtocol):
                         "rpc_%s; ignoring request", *msgargs)
             return
 
-        if not asyncio.iscoroutinefunction(func):
-            func = asyncio.coroutine(func)
-        response = await func(address, *args)
+        if not self._admit(address):
+            LOG.debug("too busy for request %s from %s",
+                      b64encode(msg_id), address)
+            self.metrics.request_refused(funcname, size)
+            txdata = BUSY + msg_id
+            self.transport.sendto(txdata, address)
+            if (address, msg_id) in self._replies:
+                self._replies[(address, msg_id)] = txdata
+            return
+
+        self.metrics.request_received(funcname, size)
+        queue = self._queues.get(address)
+        if queue is None:
+            queue = self._queues[address] = deque()
+        queue.append(_Request(msg_id, address, funcname, func, args,
+                              batched, compact))
+        self._queued += 1
+        if self._draining is None:
+            loop = asyncio.get_event_loop()
+            self._draining = loop.call_soon(self._drain_requests)
+
+    def _admit(self, address):
+        """
+        Pour a request from address into the leaky buckets, unless it does
+        not fit in them or in the request queues.
+        """
+        now = time.monotonic()
+        level, drained = self._load
+        load = max(level - (now - drained) * self._request_rate, 0)
+        level, drained = self._peer_load.pop(address, (0, now))
+        peer_load = max(level - (now - drained) * self._request_rate_per_peer,
+                        0)
+        queue = self._queues.get(address)
+        backlog = max(peer_load, len(queue) if queue is not None else 0)
+        admitted = max(load, self._queued) + 1 <= self._max_queued and \
+            backlog + 1 <= self._max_queued_per_peer
+        if admitted:
+            load += 1
+            peer_load += 1
+        self._load = (load, now)
+        self._peer_load[address] = (peer_load, now)
+
+        # forget the peers whose bucket has drained
+        rate = self._request_rate_per_peer
+        for peer, (level, drained) in list(self._peer_load.items()):
+            if level - (now - drained) * rate > 0:
+                break
+            del self._peer_load[peer]
+        return admitted
+
+    def _drain_requests(self):
+        """
+        Handle queued requests, taking one from each peer in turn, until the
+        queues are empty or enough coroutine handlers are running.
+        """
+        self._draining = None
+        while self._queues and self._active < self._max_active:
+            address, queue = next(iter(self._queues.items()))
+            request = queue.popleft()
+            self._queued -= 1
+            if queue:
+                self._queues.move_to_end(address)
+            else:
+                del self._queues[address]
+            self._run_request(request)
+
+    def _run_request(self, request):
+        if asyncio.iscoroutinefunction(request.func):
+            # the only task created for a request
+            self._active += 1
+            try:
+                coroutine = request.func(request.address, *request.args)
+            except Exception:  # pylint: disable=broad-except
+                # the arguments do not fit the handler
+                LOG.exception("rpc_%s failed for request from %s",
+                              request.name, request.address)
+                self._active -= 1
+                self._request_failed(request)
+                return
+            task = asyncio.ensure_future(coroutine)
+            task.add_done_callback(functools.partial(self._request_done,
+                                                     request))
+            return
+
+        try:
+            response = request.func(request.address, *request.args)
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception("rpc_%s failed for request from %s",
+                          request.name, request.address)
+            self._request_failed(request)
+            return
+        self._send_response(request, response)
+
+    def _request_done(self, request, task):
+        self._active -= 1
+        if self._queues and self._draining is None:
+            loop = asyncio.get_event_loop()
+            self._draining = loop.call_soon(self._drain_requests)
+        if task.cancelled():
+            self._request_failed(request)
+            return
+        if task.exception() is not None:
+            LOG.error("request %s from %s failed: %r",
+                      b64encode(request.msg_id), request.address,
+                      task.exception())
+            self._request_failed(request)
+            return
+        self._send_response(request, task.result())
+
+    def _request_failed(self, request):
+        # forget the request so that a resend of it is handled afresh
+        key = (request.address, request.msg_id)
+        if key in self._replies and self._replies[key] is None:
+            del self._replies[key]
+        self.metrics.request_done(request.name,
+                                  time.monotonic() - request.received,
+                                  metrics.FAILED)
+
+    def _send_response(self, request, response):
+        msg_id, address = request.msg_id, request.address
         LOG.debug("sending response %s for msg id %s to %s",
                   response, b64encode(msg_id), address)
-        txdata = b'\x01' + msg_id + umsgpack.packb(response)
-        self.transport.sendto(txdata, address)
+        window = (self._batch_window or 0) if request.batched else None
+        if request.compact:
+            kind = COMPACT_RESPONSE
+            data = FRAMING_HEADER + codec.packb_compact(response)
+        else:
+            kind, data = RESPONSE, codec.packb(response)
+        txdata = self._send(kind, msg_id, data, address, window)
+        self.metrics.request_done(request.name,
+                                  time.monotonic() - request.received,
+                                  metrics.OK, len(data))
+        if (address, msg_id) in self._replies:
+            self._replies[(address, msg_id)] = txdata or b''
 
     def _timeout(self, msg_id):
-        args = (b64encode(msg_id), self._wait_timeout)
+        call = self._outstanding[msg_id]
+        remaining = call.deadline - time.monotonic()
+        if call.datagram is not None and call.attempts < self._retries \
+                and remaining > 0:
+            call.attempts += 1
+            LOG.debug("resending msg id %s to %s (attempt %i)",
+                      b64encode(msg_id), call.address, call.attempts + 1)
+            self.transport.sendto(call.datagram, call.address)
+            if call.fallback is not None:
+                # the peer may not understand compact frames
+                self.transport.sendto(call.fallback, call.address)
+            backoff = self._rto(call.address) * 2 ** call.attempts
+            call.timer = self._wheel.call_later(min(backoff, remaining),
+                                                self._timeout, msg_id)
+            return
+
+        args = (b64encode(msg_id), call.address, call.attempts + 1)
         LOG.error("Did not received reply for msg "
-                  "id %s within %i seconds", *args)
-        self._outstanding[msg_id][0].set_result((False, None))
+                  "id %s from %s after %i attempts", *args)
         del self._outstanding[msg_id]
+        self.metrics.call_done(call.name, time.monotonic() - call.sent,
+                               metrics.TIMEOUT)
+        if not call.future.done():
+            call.future.set_result((False, None))
+
+    def _extend_timeout(self, msg_id):
+        """
+        Restart the response timer of an outstanding request, used while a
+        fragmented request or response is still making progress.
+        """
+        if msg_id not in self._outstanding:
+            return
+        call = self._outstanding[msg_id]
+        call.timer.cancel()
+        call.deadline = time.monotonic() + self._wait_timeout
+        call.timer = self._wheel.call_later(self._wait_timeout,
+                                            self._timeout, msg_id)
+
+    def _accept_bulk(self, msg_id, payload, address):
+        if len(payload) != BULK_DESCRIPTOR.size:
+            LOG.warning("received malformed bulk descriptor from %s, "
+                        "ignoring", address)
+            return
+        kind, token, size = BULK_DESCRIPTOR.unpack(payload)
+        LOG.debug("fetching %i bytes for msg id %s from %s",
+                  size, b64encode(msg_id), address)
+        if kind in RESPONSES:
+            self._extend_timeout(msg_id)
+        elif self._is_duplicate(msg_id, address):
+            # the offer is gone once fetched, answer from the reply cache
+            return
+        asyncio.ensure_future(self._fetch_bulk(kind, msg_id, token, address))
+
+    async def _fetch_bulk(self, kind, msg_id, token, address):
+        data = await self._bulk.fetch(address, token)
+        if data is None:
+            if kind in REQUESTS:
+                # forget the request so that a resend of it is fetched again
+                key = (address, msg_id)
+                if key in self._replies and self._replies[key] is None:
+                    del self._replies[key]
+            return
+        try:
+            self._dispatch(kind, msg_id, data, 0, address, seen=True)
+        except (MalformedMessage, umsgpack.UnpackException) as err:
+            LOG.warning("received malformed bulk message from %s: %s",
+                        address, err)
+
+    # pylint: disable=too-many-arguments
+    def _send(self, kind, msg_id, data, address, window=None):
+        """
+        Send a message by whichever means fits its size, coalescing it with
+        other messages to address for up to window seconds if given. Returns
+        the datagram to resend if it is lost, None if it was fragmented.
+        """
+        if len(data) <= self._max_datagram:
+            txdata = kind + msg_id + data
+            if window is None:
+                self.transport.sendto(txdata, address)
+            else:
+                self._enqueue(txdata, address, window)
+            return txdata
+
+        if self._bulk.listening and len(data) > self._bulk_threshold:
+            token = self._bulk.offer(data)
+            descriptor = BULK_DESCRIPTOR.pack(kind, token, len(data))
+            txdata = BULK + msg_id + descriptor
+            self.transport.sendto(txdata, address)
+            return txdata
+
+        view = memoryview(data)
+        size = self._fragment_size
+        fragments = [view[i:i + size] for i in range(0, len(data), size)]
+        LOG.debug("sending msg id %s to %s in %i fragments",
+                  b64encode(msg_id), address, len(fragments))
+        transfer = _OutgoingTransfer(fragments)
+        self._sending[(address, kind, msg_id)] = transfer
+        self._send_window((address, kind, msg_id), transfer)
+        self._schedule_resend((address, kind, msg_id), transfer)
+        return None
+
+    def _enqueue(self, txdata, address, window):
+        entry = BATCH_ENTRY.size + len(txdata)
+        if len(BATCH) + entry > self._batch_budget:
+            self.transport.sendto(txdata, address)
+            return
+
+        batch = self._batches.get(address)
+        if batch is not None and batch.size + entry > self._batch_budget:
+            self._flush_batch(address)
+            batch = None
+        if batch is None:
+            batch = _Batch()
+            self._batches[address] = batch
+            loop = asyncio.get_event_loop()
+            batch.handle = loop.call_later(window, self._flush_batch, address)
+        batch.datagrams.append(txdata)
+        batch.size += entry
+
+    def _flush_batch(self, address):
+        batch = self._batches.pop(address, None)
+        if batch is None:
+            return
+        batch.handle.cancel()
+        if len(batch.datagrams) == 1:
+            self.transport.sendto(batch.datagrams[0], address)
+            return
+        LOG.debug("sending batch of %i messages to %s",
+                  len(batch.datagrams), address)
+        entries = [BATCH]
+        for txdata in batch.datagrams:
+            entries.append(BATCH_ENTRY.pack(len(txdata)))
+            entries.append(txdata)
+        self.transport.sendto(b''.join(entries), address)
+
+    def _send_fragment(self, key, transfer, index):
+        address, kind, msg_id = key
+        header = FRAGMENT_HEADER.pack(kind, index, len(transfer.fragments))
+        fragment = transfer.fragments[index]
+        self.transport.sendto(b''.join((FRAGMENT, msg_id, header, fragment)),
+                              address)
+        _, sends = transfer.inflight.get(index, (None, 0))
+        transfer.inflight[index] = (time.monotonic(), sends + 1)
+
+    def _send_window(self, key, transfer):
+        total = len(transfer.fragments)
+        limit = min(transfer.base + self._window, total)
+        while transfer.next < limit:
+            if transfer.next not in transfer.acked:
+                self._send_fragment(key, transfer, transfer.next)
+            transfer.next += 1
+
+    def _schedule_resend(self, key, transfer):
+        transfer.timer = self._wheel.call_later(self._rto(key[0]),
+                                                self._resend_fragments, key)
+
+    def _resend_fragments(self, key):
+        transfer = self._sending.get(key)
+        if transfer is None:
+            return
+        now = time.monotonic()
+        rto = self._rto(key[0])
+        for index, (sent, sends) in list(transfer.inflight.items()):
+            if sent > now - rto * 2 ** (sends - 1):
+                continue
+            if sends > self._fragment_retries:
+                LOG.warning("giving up on msg id %s to %s after %i resends "
+                            "of fragment %i", b64encode(key[2]), key[0],
+                            sends, index)
+                del self._sending[key]
+                return
+            self._send_fragment(key, transfer, index)
+        self._schedule_resend(key, transfer)
+
+    def _accept_fragment_ack(self, msg_id, payload, address):
+        if len(payload) < ACK_HEADER.size:
+            return
+        kind, cumulative = ACK_HEADER.unpack_from(payload)
+        key = (address, kind, msg_id)
+        transfer = self._sending.get(key)
+        if transfer is None:
+            return
+
+        acked = set(range(transfer.base, cumulative))
+        offset = ACK_HEADER.size
+        while offset + SACK_ENTRY.size <= len(payload):
+            acked.add(SACK_ENTRY.unpack_from(payload, offset)[0])
+            offset += SACK_ENTRY.size
+        sample = None
+        for index in acked:
+            sent, sends = transfer.inflight.pop(index, (None, 0))
+            if sends == 1 and (sample is None or sent > sample):
+                sample = sent
+        if sample is not None:
+            self._sample_rtt(address, time.monotonic() - sample)
+        transfer.acked.update(acked)
+        while transfer.base in transfer.acked:
+            transfer.base += 1
+
+        if kind in REQUESTS:
+            self._extend_timeout(msg_id)
+        if transfer.done:
+            LOG.debug("all fragments of msg id %s acknowledged by %s",
+                      b64encode(msg_id), address)
+            transfer.timer.cancel()
+            del self._sending[key]
+            return
+        self._send_window(key, transfer)
+
+    def _accept_fragment(self, msg_id, payload, address):
+        if len(payload) < FRAGMENT_HEADER.size:
+            return
+        kind, index, total = FRAGMENT_HEADER.unpack_from(payload)
+        if total > self._max_fragments or index >= total:
+            LOG.warning("received malformed fragment from %s, ignoring",
+                        address)
+            return
+
+        key = (address, kind, msg_id)
+        transfer = self._receiving.get(key)
+        if transfer is None:
+            transfer = _IncomingTransfer(total)
+            self._receiving[key] = transfer
+        if transfer.expiry is not None:
+            transfer.expiry.cancel()
+        transfer.expiry = self._wheel.call_later(self._wait_timeout,
+                                                 self._receiving.pop, key,
+                                                 None)
+
+        if not transfer.done and index not in transfer.chunks:
+            transfer.chunks[index] = payload[FRAGMENT_HEADER.size:]
+            while transfer.cumulative in transfer.chunks:
+                transfer.cumulative += 1
+        self._ack_fragments(msg_id, kind, transfer, address)
+
+        if kind in RESPONSES:
+            self._extend_timeout(msg_id)
+        if transfer.done or transfer.cumulative < transfer.total:
+            return
+
+        # keep the finished transfer around until it expires, so fragments
+        # resent because of a lost ack are acknowledged but not handled twice
+        transfer.done = True
+        chunks = transfer.chunks
+        transfer.chunks = {}
+        data = b''.join(chunks[i] for i in range(transfer.total))
+        self._dispatch(kind, msg_id, data, 0, address)
+
+    def _ack_fragments(self, msg_id, kind, transfer, address):
+        if transfer.done:
+            cumulative, selective = transfer.total, []
+        else:
+            cumulative = transfer.cumulative
+            limit = cumulative + self._window
+            selective = sorted(i for i in transfer.chunks if i < limit)
+        header = ACK_HEADER.pack(kind, cumulative)
+        sacks = b''.join(SACK_ENTRY.pack(i) for i in selective
+                         if i > cumulative)
+        self.transport.sendto(FRAGMENT_ACK + msg_id + header + sacks, address)
+
+    def _encode_call(self, name, args, address):
+        """
+        Encode a call to the remote method name, compactly if the method has
+        an id and the peer is not known to only speak the legacy framing.
+        Returns the message kind, its payload, and the legacy payload to
+        fall back to if the peer has not confirmed the compact framing yet.
+        """
+        method = self._method_ids.get(name)
+        framing = self._framing.get(address)
+        if method is None or framing == 0:
+            return REQUEST, codec.packb([name, args]), None
+
+        data = FRAMING_HEADER + bytes((method,)) + codec.packb(args)
+        if framing is not None:
+            return COMPACT_REQUEST, data, None
+        legacy = codec.packb([name, args])
+        if len(data) > self._max_datagram:
+            # fragmented messages are not resent, so do not guess
+            return REQUEST, legacy, None
+        return COMPACT_REQUEST, data, legacy
 
     def __getattr__(self, name):
         """
@@ -117,24 +951,31 @@ class RPCProtocol(asyncio.DatagramProtocol):
             pass
 
         def func(address, *args):
-            msg_id = sha1(os.urandom(32)).digest()
-            data = umsgpack.packb([name, args])
-            if len(data) > 8192 * 1024 * 1024 * 1024:
-                raise MalformedMessage("Total length of function "
-                                       "name and arguments cannot exceed 8K")
-            txdata = b'\x00' + msg_id + data
+            msg_id = MSG_ID.pack(self._salt, next(self._counter))
+            kind, data, legacy = self._encode_call(name, args, address)
+            max_size = self._max_fragments * self._fragment_size
+            if len(data) > max_size and not self._bulk.listening:
+                raise MalformedMessage("Total length of function name and "
+                                       "arguments cannot exceed "
+                                       f"{max_size} bytes")
             LOG.debug("calling remote function %s on %s (msgid %s)",
                       name, address, b64encode(msg_id))
-            self.transport.sendto(txdata, address)
+            txdata = self._send(kind, msg_id, data, address,
+                                self._batch_window)
+            self.metrics.call_sent(name, len(data))
 
             loop = asyncio.get_event_loop()
             if hasattr(loop, 'create_future'):
                 future = loop.create_future()
             else:
                 future = asyncio.Future()
-            timeout = loop.call_later(self._wait_timeout,
-                                      self._timeout, msg_id)
-            self._outstanding[msg_id] = (future, timeout)
+            deadline = time.monotonic() + self._wait_timeout
+            call = _Call(name, future, address, txdata, deadline)
+            if txdata is not None and legacy is not None:
+                call.fallback = REQUEST + msg_id + legacy
+            delay = self._rto(address) if txdata else self._wait_timeout
+            call.timer = self._wheel.call_later(delay, self._timeout, msg_id)
+            self._outstanding[msg_id] = call
             return future
 
         return func
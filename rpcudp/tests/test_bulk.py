@@ -0,0 +1,66 @@
+# pylint: disable=missing-docstring
+import asyncio
+import os
+import unittest
+
+from rpcudp.bulk import BulkChannel
+
+
+class BulkTestCase(unittest.IsolatedAsyncioTestCase):
+    async def channels(self, **kwargs):
+        """
+        A listening channel, a fetching channel and the listener's address.
+        """
+        server = BulkChannel(**kwargs)
+        await server.listen('127.0.0.1', 0)
+        self.addCleanup(server.close)
+        # pylint: disable=protected-access
+        address = server._server.sockets[0].getsockname()
+        client = BulkChannel(**kwargs)
+        self.addCleanup(client.close)
+        return server, client, address
+
+
+class TestBulkChannel(BulkTestCase):
+    async def test_fetch_round_trip(self):
+        server, client, address = await self.channels()
+        data = os.urandom(100000)
+        token = server.offer(data)
+        self.assertEqual(await client.fetch(address, token), data)
+        # offers are fetched once
+        self.assertIsNone(await client.fetch(address, token))
+
+    async def test_oversized_payload_is_rejected(self):
+        server, client, address = await self.channels(max_size=1000)
+        token = server.offer(os.urandom(1001))
+        self.assertIsNone(await client.fetch(address, token))
+        token = server.offer(b'x' * 1000)
+        self.assertEqual(await client.fetch(address, token), b'x' * 1000)
+
+    async def test_fetch_times_out(self):
+        async def silent(reader, writer):
+            await reader.read()
+            writer.close()
+        listener = await asyncio.start_server(silent, '127.0.0.1', 0)
+        self.addCleanup(listener.close)
+        address = listener.sockets[0].getsockname()
+
+        client = BulkChannel(fetch_timeout=0.1)
+        self.addCleanup(client.close)
+        self.assertIsNone(await client.fetch(address, os.urandom(16)))
+
+    async def test_close_closes_served_connections(self):
+        server, client, address = await self.channels()
+        token = server.offer(b'payload')
+        self.assertEqual(await client.fetch(address, token), b'payload')
+        # pylint: disable=protected-access
+        self.assertEqual(len(server._serving), 1)
+        connection = client._pool[address]
+
+        server.close()
+        self.assertEqual(server._serving, {})
+        self.assertEqual(await connection.reader.read(), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# pylint: disable=missing-docstring
+import os
+import unittest
+
+from rpcudp import codec
+from rpcudp import umsgpack
+
+VALUES = [
+    None, True, False,
+    0, 1, 127, 128, 255, 256, 65535, 65536, 2 ** 32 - 1, 2 ** 32, 2 ** 64 - 1,
+    -1, -32, -33, -128, -129, -2 ** 15, -2 ** 31, -2 ** 63,
+    1.5, -0.25,
+    '', 'a', 'x' * 31, 'x' * 32, 'x' * 256, 'x' * 70000, 'h\xe9llo',
+    b'', os.urandom(20), os.urandom(300), os.urandom(70000),
+    [], list(range(15)), list(range(16)), list(range(70000)),
+    {}, {'a': 1}, {i: i for i in range(16)},
+    ['find_node', [os.urandom(20), os.urandom(20)]],
+    ['store', [os.urandom(20), [os.urandom(20), '10.0.0.1', 8468]]],
+    [(os.urandom(20), '127.0.0.1', 8468) for _ in range(20)],
+    umsgpack.Ext(5, b'ext'),
+]
+
+
+class TestCodec(unittest.TestCase):
+    def test_output_matches_umsgpack(self):
+        for value in VALUES:
+            with self.subTest(value=repr(value)[:40]):
+                self.assertEqual(codec.packb(value), umsgpack.packb(value))
+
+    def test_round_trip_matches_umsgpack(self):
+        for value in VALUES:
+            with self.subTest(value=repr(value)[:40]):
+                data = umsgpack.packb(value)
+                self.assertEqual(codec.unpackb(data), umsgpack.unpackb(data))
+
+    def test_list_map_keys_become_tuples(self):
+        data = umsgpack.packb({(1, 2): 'a'})
+        self.assertEqual(codec.unpackb(data), {(1, 2): 'a'})
+
+    def test_unpack_from_offset(self):
+        data = b'\x00' * 21 + codec.packb(['ping', [b'id']])
+        self.assertEqual(codec.unpack_from(data, 21), ['ping', [b'id']])
+
+    def test_unpack_from_stops_at_end(self):
+        data = codec.packb(b'x' * 40) + codec.packb(b'y' * 40)
+        self.assertEqual(codec.unpack_from(data, 0, 42), b'x' * 40)
+        with self.assertRaises(umsgpack.InsufficientDataException):
+            codec.unpack_from(data, 0, 41)
+        with self.assertRaises(umsgpack.InsufficientDataException):
+            codec.unpack_compact_from(data, 0, end=41)
+
+    def test_truncated_input_is_rejected(self):
+        data = codec.packb(['store', [os.urandom(20), 'x' * 40, 12345]])
+        for size in range(len(data)):
+            with self.subTest(size=size):
+                with self.assertRaises(umsgpack.InsufficientDataException):
+                    codec.unpackb(data[:size])
+
+    def test_invalid_utf8_is_rejected(self):
+        with self.assertRaises(umsgpack.InvalidStringException):
+            codec.unpackb(b'\xa2\xff\xfe')
+
+
+class TestCompactContacts(unittest.TestCase):
+    def test_contacts_round_trip(self):
+        contacts = [[os.urandom(20), f'10.0.0.{i}', 8000 + i]
+                    for i in range(20)]
+        data = codec.packb_compact(contacts)
+        # an ext 16 header, then the records
+        self.assertEqual(len(data), 4 + 20 * codec.CONTACT.size)
+        self.assertEqual(codec.unpack_compact_from(data),
+                         [tuple(contact) for contact in contacts])
+
+    def test_contact_factory(self):
+        contacts = [[os.urandom(20), '10.0.0.1', 8000]]
+        data = codec.packb_compact(contacts)
+        unpacked = codec.unpack_compact_from(
+            data, contact=lambda *contact: list(contact))
+        self.assertEqual(unpacked, contacts)
+
+    def test_other_values_pack_as_msgpack(self):
+        others = [
+            [], None, b'value', ['not', 'contacts'],
+            [[os.urandom(20), '::1', 8000]],
+            [[os.urandom(19), '10.0.0.1', 8000]],
+            [[os.urandom(20), '10.0.0.1', 70000]],
+        ]
+        for value in others:
+            with self.subTest(value=value):
+                data = codec.packb_compact(value)
+                self.assertEqual(data, codec.packb(value))
+                self.assertEqual(codec.unpack_compact_from(data),
+                                 umsgpack.unpackb(data))
+
+    def test_partial_record_is_rejected(self):
+        data = umsgpack.packb(umsgpack.Ext(codec.CONTACTS_EXT, b'x' * 27))
+        with self.assertRaises(umsgpack.InsufficientDataException):
+            codec.unpack_compact_from(data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# pylint: disable=missing-docstring
+import unittest
+
+from rpcudp import metrics
+from rpcudp.metrics import RPCMetrics, LATENCY_BOUNDS
+
+
+class TestRPCMetrics(unittest.TestCase):
+    def test_call_outcomes(self):
+        stats = RPCMetrics()
+        for outcome in (metrics.OK, metrics.OK, metrics.TIMEOUT,
+                        metrics.BUSY, metrics.FAILED):
+            stats.call_sent('find_node', 10)
+            stats.call_done('find_node', 0.01, outcome,
+                            100 if outcome == metrics.OK else 0)
+        calls = stats.as_dict()['calls']['find_node']
+        self.assertEqual(calls['count'], 5)
+        self.assertEqual(calls['ok'], 2)
+        self.assertEqual(calls['timeouts'], 1)
+        self.assertEqual(calls['busy'], 1)
+        self.assertEqual(calls['failed'], 1)
+        self.assertEqual(calls['bytes_out'], 50)
+        self.assertEqual(calls['bytes_in'], 200)
+        self.assertAlmostEqual(calls['total_time'], 0.05)
+        self.assertEqual(stats.as_dict()['served'], {})
+
+    def test_served_requests(self):
+        stats = RPCMetrics()
+        stats.request_received('store', 300)
+        stats.request_done('store', 0.002, metrics.OK, 4)
+        stats.request_received('store', 300)
+        stats.request_done('store', 0.002, metrics.FAILED)
+        stats.request_refused('store', 300)
+        served = stats.as_dict()['served']['store']
+        self.assertEqual(served['count'], 3)
+        self.assertEqual((served['ok'], served['failed'], served['busy']),
+                         (1, 1, 1))
+        self.assertEqual(served['bytes_in'], 900)
+        self.assertEqual(served['bytes_out'], 4)
+        # refused requests are not timed
+        self.assertEqual(sum(served['latency']), 2)
+        self.assertEqual(served['outstanding'], 0)
+
+    def test_outstanding(self):
+        stats = RPCMetrics()
+        for _ in range(3):
+            stats.call_sent('ping', 0)
+        stats.call_done('ping', 0.1, metrics.OK)
+        stats.call_sent('ping', 0)
+        calls = stats.as_dict()['calls']['ping']
+        self.assertEqual(calls['outstanding'], 3)
+        self.assertEqual(calls['max_outstanding'], 3)
+        for _ in range(3):
+            stats.call_done('ping', 0.1, metrics.OK)
+        calls = stats.as_dict()['calls']['ping']
+        self.assertEqual(calls['outstanding'], 0)
+        self.assertEqual(calls['max_outstanding'], 3)
+
+    def test_latency_buckets(self):
+        stats = RPCMetrics(bounds=(0.01, 0.1, 1.0))
+        # a bucket counts up to its bound included
+        for elapsed in (0, 0.01, 0.0100001, 0.1, 1.0, 1.0001, 60):
+            stats.call_sent('ping', 0)
+            stats.call_done('ping', elapsed, metrics.OK)
+        result = stats.as_dict()
+        self.assertEqual(result['latency_bounds'], [0.01, 0.1, 1.0])
+        self.assertEqual(result['calls']['ping']['latency'], [2, 2, 1, 2])
+
+    def test_default_buckets(self):
+        stats = RPCMetrics()
+        stats.call_sent('ping', 0)
+        stats.call_done('ping', LATENCY_BOUNDS[-1] * 2, metrics.OK)
+        latency = stats.as_dict()['calls']['ping']['latency']
+        self.assertEqual(len(latency), len(LATENCY_BOUNDS) + 1)
+        self.assertEqual(latency[-1], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
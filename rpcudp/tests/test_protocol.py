@@ -0,0 +1,424 @@
+# pylint: disable=missing-docstring
+import asyncio
+import os
+import unittest
+
+from rpcudp import codec
+from rpcudp.protocol import RPCProtocol, BUSY_REPLY, FRAGMENT, \
+    FRAGMENT_HEADER, REQUEST, RESPONSE, BATCH, BATCH_ENTRY, \
+    COMPACT_REQUEST, COMPACT_RESPONSE, FRAMING_VERSION
+
+
+class EchoProtocol(RPCProtocol):
+    def rpc_echo(self, sender, value):  # pylint: disable=unused-argument
+        return value
+
+
+class CountingProtocol(EchoProtocol):
+    """
+    Counts the requests it handles, failing the first one if told to.
+    """
+    def __init__(self, fail_first=False, **kwargs):
+        super().__init__(**kwargs)
+        self.handled = 0
+        self.fail_first = fail_first
+
+    def rpc_count(self, sender):  # pylint: disable=unused-argument
+        self.handled += 1
+        if self.fail_first and self.handled == 1:
+            raise RuntimeError("first request fails")
+        return self.handled
+
+
+class SlowProtocol(CountingProtocol):
+    # pylint: disable=unused-argument
+    async def rpc_slow(self, sender, value):
+        await asyncio.sleep(0.01)
+        return value
+
+
+class CompactProtocol(CountingProtocol):
+    rpc_methods = ('echo', 'count')
+
+
+class LegacyProtocol(CountingProtocol):
+    """
+    A peer from before the compact framing, which ignores compact frames.
+    """
+    def datagram_received(self, data, addr):
+        if data[:1] not in (COMPACT_REQUEST, COMPACT_RESPONSE):
+            super().datagram_received(data, addr)
+
+
+class LossyTransport:
+    """
+    Wraps a datagram transport, dropping the datagrams drop says to drop
+    and remembering everything that was sent.
+    """
+    def __init__(self, transport, drop):
+        self.transport = transport
+        self.drop = drop
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append(data)
+        if not self.drop(data):
+            self.transport.sendto(data, address)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+def fragment_index(data):
+    """
+    The index of the fragment in datagram data, None for other datagrams.
+    """
+    if data[:1] != FRAGMENT:
+        return None
+    _, index, _ = FRAGMENT_HEADER.unpack_from(data, 21)
+    return index
+
+
+async def endpoint(factory):
+    loop = asyncio.get_event_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        factory, local_addr=('127.0.0.1', 0))
+    return protocol, transport.get_extra_info('sockname')
+
+
+class ProtocolTestCase(unittest.IsolatedAsyncioTestCase):
+    async def pair(self, client=None, server=None):
+        """
+        A client and a server protocol, and the address of the server.
+        """
+        client, _ = await endpoint(client or EchoProtocol)
+        server, address = await endpoint(server or EchoProtocol)
+        self.addCleanup(client.transport.close)
+        self.addCleanup(server.transport.close)
+        return client, server, address
+
+
+class TestFragments(ProtocolTestCase):
+    async def test_large_message_round_trip(self):
+        client, _, address = await self.pair(
+            lambda: EchoProtocol(max_datagram=512, fragment_size=256))
+        value = os.urandom(20000)
+        result = await client.echo(address, value)
+        self.assertEqual(result, (True, value))
+
+    async def test_lost_fragments_are_resent_alone(self):
+        client, _, address = await self.pair(
+            lambda: EchoProtocol(max_datagram=512, fragment_size=256,
+                                 initial_rto=0.05))
+        lost = {3, 7}
+
+        def drop(data):
+            index = fragment_index(data)
+            if index in lost:
+                lost.discard(index)
+                return True
+            return False
+        client.transport = LossyTransport(client.transport, drop)
+
+        value = os.urandom(4000)
+        result = await client.echo(address, value)
+        self.assertEqual(result, (True, value))
+        sends = {}
+        for data in client.transport.sent:
+            index = fragment_index(data)
+            if index is not None:
+                sends[index] = sends.get(index, 0) + 1
+        # only the lost fragments went out twice, the others were acked
+        # selectively
+        self.assertEqual({i for i, n in sends.items() if n > 1}, {3, 7})
+
+
+class FlakyFetch:  # pylint: disable=too-few-public-methods
+    """
+    Wraps the fetch of a bulk channel, failing the first one.
+    """
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.attempts = 0
+
+    async def __call__(self, address, token):
+        self.attempts += 1
+        if self.attempts == 1:
+            return None
+        return await self.fetch(address, token)
+
+
+class TestBulk(ProtocolTestCase):
+    async def bulk_pair(self):
+        def factory():
+            return CountingProtocol(max_datagram=512, bulk_threshold=1024,
+                                    initial_rto=0.05)
+        client, server, address = await self.pair(factory, factory)
+        for protocol in (client, server):
+            port = protocol.transport.get_extra_info('sockname')[1]
+            await protocol.listen_bulk('127.0.0.1', port)
+        return client, server, address
+
+    async def test_large_message_round_trip(self):
+        client, _, address = await self.bulk_pair()
+        value = os.urandom(100000)
+        self.assertEqual(await client.echo(address, value), (True, value))
+
+    async def test_failed_fetch_is_retried(self):
+        client, server, address = await self.bulk_pair()
+        # pylint: disable=protected-access
+        server._bulk.fetch = FlakyFetch(server._bulk.fetch)
+        value = os.urandom(100000)
+        self.assertEqual(await client.echo(address, value), (True, value))
+        self.assertEqual(server._bulk.fetch.attempts, 2)
+
+
+class TestRetransmission(ProtocolTestCase):
+    async def test_rtt_is_measured(self):
+        client, _, address = await self.pair(
+            lambda: EchoProtocol(initial_rto=0.5, min_rto=0.01))
+        self.assertIsNone(client.get_rtt(address))
+        await client.echo(address, b'ping')
+        srtt, _ = client.get_rtt(address)
+        self.assertLess(srtt, 0.5)
+        # pylint: disable=protected-access
+        self.assertLess(client._rto(address), 0.5)
+        self.assertGreaterEqual(client._rto(address), 0.01)
+
+    async def test_lost_response_is_answered_from_cache(self):
+        client, server, address = await self.pair(
+            lambda: EchoProtocol(initial_rto=0.05), CountingProtocol)
+        lost = [True]
+
+        def drop(data):
+            if data[:1] == RESPONSE and lost:
+                return lost.pop()
+            return False
+        server.transport = LossyTransport(server.transport, drop)
+
+        self.assertEqual(await client.count(address), (True, 1))
+        # the resend was answered without running the handler again
+        self.assertEqual(server.handled, 1)
+
+    async def test_failed_request_is_handled_again(self):
+        client, server, address = await self.pair(
+            lambda: EchoProtocol(initial_rto=0.05),
+            lambda: CountingProtocol(fail_first=True))
+        self.assertEqual(await client.count(address), (True, 2))
+        self.assertEqual(server.handled, 2)
+
+    async def test_calls_in_flight_end_when_closed(self):
+        client, _, address = await self.pair()
+        # the request is lost, the call is still in flight
+        client.transport = LossyTransport(client.transport, lambda _: True)
+        future = client.echo(address, b'ping')
+        client.transport.close()
+        self.assertEqual(await asyncio.wait_for(future, 1), (False, None))
+        calls = client.metrics.as_dict()['calls']['echo']
+        self.assertEqual(calls['timeouts'], 1)
+        self.assertEqual(calls['outstanding'], 0)
+
+
+class TestBatching(ProtocolTestCase):
+    async def test_calls_share_a_batch_datagram(self):
+        client, server, address = await self.pair(
+            lambda: EchoProtocol(batch_window=0.01))
+        client.transport = LossyTransport(client.transport, lambda _: False)
+        server.transport = LossyTransport(server.transport, lambda _: False)
+
+        values = [os.urandom(50) for _ in range(10)]
+        results = await asyncio.gather(
+            *(client.echo(address, value) for value in values))
+        self.assertEqual(results, [(True, value) for value in values])
+        # requests went out together, responses came back together
+        self.assertEqual(len(client.transport.sent), 1)
+        self.assertEqual(client.transport.sent[0][:1], BATCH)
+        self.assertEqual(len(server.transport.sent), 1)
+        self.assertEqual(server.transport.sent[0][:1], BATCH)
+
+    async def test_batches_respect_the_budget(self):
+        client, _, address = await self.pair(
+            lambda: EchoProtocol(batch_window=0.01, batch_budget=400))
+        client.transport = LossyTransport(client.transport, lambda _: False)
+
+        values = [os.urandom(100) for _ in range(10)]
+        results = await asyncio.gather(
+            *(client.echo(address, value) for value in values))
+        self.assertEqual(results, [(True, value) for value in values])
+        self.assertGreater(len(client.transport.sent), 1)
+        for data in client.transport.sent:
+            self.assertLessEqual(len(data), 400)
+
+    async def test_truncated_batch_is_ignored(self):
+        client, server, address = await self.pair()
+        client.transport = LossyTransport(client.transport, lambda _: False)
+        await client.echo(address, b'ping')
+        request = client.transport.sent[0]
+        truncated = BATCH + BATCH_ENTRY.pack(len(request) + 10) + request
+        with self.assertLogs('rpcudp.protocol', 'WARNING'):
+            server.datagram_received(truncated, ('127.0.0.1', 1))
+
+
+class TestCompactFraming(ProtocolTestCase):
+    async def test_compact_peers_confirm_the_framing(self):
+        client, server, address = await self.pair(CompactProtocol,
+                                                  CompactProtocol)
+        client.transport = LossyTransport(client.transport, lambda _: False)
+        self.assertEqual(await client.echo(address, b'ping'), (True, b'ping'))
+        self.assertEqual(await client.count(address), (True, 1))
+        self.assertEqual([data[:1] for data in client.transport.sent],
+                         [COMPACT_REQUEST, COMPACT_REQUEST])
+        # pylint: disable=protected-access
+        self.assertEqual(client._framing[address], FRAMING_VERSION)
+        self.assertEqual(server.handled, 1)
+
+    async def test_legacy_peer_is_downgraded(self):
+        client, server, address = await self.pair(
+            lambda: CompactProtocol(initial_rto=0.05), LegacyProtocol)
+        self.assertEqual(await client.count(address), (True, 1))
+        # pylint: disable=protected-access
+        self.assertEqual(client._framing[address], 0)
+        client.transport = LossyTransport(client.transport, lambda _: False)
+        self.assertEqual(await client.count(address), (True, 2))
+        self.assertEqual(client.transport.sent[0][:1], b'\x00')
+        self.assertEqual(server.handled, 2)
+
+    async def test_lost_compact_request_does_not_downgrade(self):
+        client, server, address = await self.pair(
+            lambda: CompactProtocol(initial_rto=0.05), CompactProtocol)
+        lost = [True]
+
+        def drop(data):
+            if data[:1] == COMPACT_REQUEST and lost:
+                return lost.pop()
+            return False
+        client.transport = LossyTransport(client.transport, drop)
+
+        self.assertEqual(await client.count(address), (True, 1))
+        # pylint: disable=protected-access
+        self.assertEqual(client._framing[address], FRAMING_VERSION)
+        self.assertEqual(server.handled, 1)
+
+    async def test_truncated_compact_request_is_rejected(self):
+        _, server, _ = await self.pair(server=CompactProtocol)
+        datagram = COMPACT_REQUEST + os.urandom(20) + bytes((FRAMING_VERSION,))
+        with self.assertLogs('rpcudp.protocol', 'WARNING'):
+            server.datagram_received(datagram, ('127.0.0.1', 1))
+        self.assertEqual(server.handled, 0)
+
+    async def test_batched_frame_is_bounded_by_its_entry(self):
+        client, server, address = await self.pair(CompactProtocol,
+                                                  CompactProtocol)
+        client.transport = LossyTransport(client.transport, lambda _: False)
+        await client.echo(address, b'x' * 40)
+        request = client.transport.sent[0]
+        # the arguments of the first entry run into the second one
+        first = request[:-10]
+        second = request
+        batch = BATCH + BATCH_ENTRY.pack(len(first)) + first + \
+            BATCH_ENTRY.pack(len(second)) + second
+        # pylint: disable=protected-access
+        server._replies.clear()
+        with self.assertLogs('rpcudp.protocol', 'WARNING'):
+            server.datagram_received(batch, ('127.0.0.1', 1))
+
+
+class TestAdmission(ProtocolTestCase):
+    async def test_burst_from_one_peer_gets_busy_replies(self):
+        client, server, address = await self.pair(
+            server=lambda: CountingProtocol(max_queued_per_peer=4,
+                                            request_rate_per_peer=1))
+        results = await asyncio.gather(
+            *(client.count(address) for _ in range(10)))
+        self.assertEqual(results[:4], [(True, i) for i in range(1, 5)])
+        self.assertEqual(results[4:], [(False, BUSY_REPLY)] * 6)
+        self.assertEqual(server.handled, 4)
+        served = server.metrics.as_dict()['served']['count']
+        self.assertEqual(served['busy'], 6)
+        calls = client.metrics.as_dict()['calls']['count']
+        self.assertEqual(calls['busy'], 6)
+
+    async def test_other_peers_are_still_served(self):
+        client, _, address = await self.pair(
+            server=lambda: CountingProtocol(max_queued_per_peer=4,
+                                            request_rate_per_peer=1))
+        other, _ = await endpoint(EchoProtocol)
+        self.addCleanup(other.transport.close)
+        await asyncio.gather(*(client.count(address) for _ in range(10)))
+        self.assertEqual(await other.count(address), (True, 5))
+        self.assertEqual(await client.count(address), (False, BUSY_REPLY))
+
+    async def test_global_rate_limits_all_peers(self):
+        client, server, address = await self.pair(
+            server=lambda: CountingProtocol(max_queued=4, request_rate=1))
+        other, _ = await endpoint(EchoProtocol)
+        self.addCleanup(other.transport.close)
+        await asyncio.gather(*(client.count(address) for _ in range(4)))
+        self.assertEqual(await other.count(address), (False, BUSY_REPLY))
+        self.assertEqual(server.handled, 4)
+
+    async def test_bucket_drains_over_time(self):
+        client, server, address = await self.pair(
+            server=lambda: CountingProtocol(max_queued_per_peer=4,
+                                            request_rate_per_peer=50))
+        await asyncio.gather(*(client.count(address) for _ in range(10)))
+        self.assertEqual(server.handled, 4)
+        await asyncio.sleep(0.1)
+        self.assertEqual(await client.count(address), (True, 5))
+
+    async def test_bad_arguments_free_the_handler_slot(self):
+        client, server, address = await self.pair(
+            server=lambda: SlowProtocol(max_active=2))
+        for _ in range(4):
+            # one argument short
+            request = REQUEST + os.urandom(20) + codec.packb(['slow', []])
+            with self.assertLogs('rpcudp.protocol', 'ERROR'):
+                server.datagram_received(request, ('127.0.0.1', 1))
+                await asyncio.sleep(0)
+        # pylint: disable=protected-access
+        self.assertEqual(server._active, 0)
+        self.assertEqual(await client.slow(address, b'x'), (True, b'x'))
+
+    async def test_arguments_must_be_a_list(self):
+        _, server, _ = await self.pair(server=SlowProtocol)
+        request = REQUEST + os.urandom(20) + codec.packb(['slow', 5])
+        with self.assertLogs('rpcudp.protocol', 'WARNING'):
+            server.datagram_received(request, ('127.0.0.1', 1))
+        self.assertEqual(server.metrics.as_dict()['served'], {})
+
+
+class TestMetrics(ProtocolTestCase):
+    async def test_calls_and_requests_are_counted(self):
+        client, server, address = await self.pair(CompactProtocol,
+                                                  CompactProtocol)
+        await client.echo(address, b'x' * 100)
+        calls = client.metrics.as_dict()['calls']['echo']
+        served = server.metrics.as_dict()['served']['echo']
+        self.assertEqual((calls['count'], calls['ok']), (1, 1))
+        self.assertEqual((served['count'], served['ok']), (1, 1))
+        self.assertEqual(calls['bytes_out'], served['bytes_in'])
+        self.assertEqual(calls['bytes_in'], served['bytes_out'])
+        self.assertGreater(calls['bytes_out'], 100)
+        self.assertEqual(sum(calls['latency']), 1)
+
+    async def test_failed_requests_and_timeouts_are_counted(self):
+        client, server, address = await self.pair(
+            lambda: EchoProtocol(wait_timeout=0.1, initial_rto=0.05),
+            lambda: CountingProtocol(fail_first=True))
+        sent = []
+
+        def drop(data):
+            # the first request fails at the server, its resends are lost
+            sent.append(data)
+            return len(sent) > 1
+        client.transport = LossyTransport(client.transport, drop)
+        self.assertEqual(await client.count(address), (False, None))
+        calls = client.metrics.as_dict()['calls']['count']
+        self.assertEqual(calls['timeouts'], 1)
+        self.assertEqual(calls['outstanding'], 0)
+        served = server.metrics.as_dict()['served']['count']
+        self.assertEqual(served['failed'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
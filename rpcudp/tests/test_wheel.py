@@ -0,0 +1,72 @@
+# pylint: disable=missing-docstring
+import asyncio
+import unittest
+
+from rpcudp.wheel import TimingWheel
+
+
+class TestTimingWheel(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.wheel = TimingWheel(tick=0.01, size=8)
+        self.addCleanup(self.wheel.stop)
+        self.fired = []
+
+    def fire(self, name):
+        loop = asyncio.get_event_loop()
+        self.fired.append((name, loop.time()))
+
+    async def test_timer_fires_after_delay(self):
+        start = asyncio.get_event_loop().time()
+        self.wheel.call_later(0.05, self.fire, 'a')
+        self.assertEqual(len(self.wheel), 1)
+        await asyncio.sleep(0.2)
+        self.assertEqual(len(self.fired), 1)
+        name, when = self.fired[0]
+        self.assertEqual(name, 'a')
+        self.assertGreaterEqual(when - start, 0.05)
+        self.assertEqual(len(self.wheel), 0)
+
+    async def test_timers_fire_in_deadline_order(self):
+        self.wheel.call_later(0.06, self.fire, 'c')
+        self.wheel.call_later(0.02, self.fire, 'a')
+        self.wheel.call_later(0.04, self.fire, 'b')
+        await asyncio.sleep(0.2)
+        self.assertEqual([name for name, _ in self.fired], ['a', 'b', 'c'])
+
+    async def test_cancelled_timer_does_not_fire(self):
+        timer = self.wheel.call_later(0.02, self.fire, 'a')
+        self.wheel.call_later(0.03, self.fire, 'b')
+        timer.cancel()
+        await asyncio.sleep(0.2)
+        self.assertEqual([name for name, _ in self.fired], ['b'])
+
+    async def test_timer_beyond_one_turn_waits_extra_rounds(self):
+        # eight slots of 10ms: a 250ms timer is three turns away
+        start = asyncio.get_event_loop().time()
+        self.wheel.call_later(0.25, self.fire, 'a')
+        await asyncio.sleep(0.2)
+        self.assertEqual(self.fired, [])
+        await asyncio.sleep(0.2)
+        self.assertEqual(len(self.fired), 1)
+        self.assertGreaterEqual(self.fired[0][1] - start, 0.25)
+
+    async def test_failing_callback_does_not_stop_the_wheel(self):
+        def fail():
+            raise RuntimeError("callback fails")
+        self.wheel.call_later(0.02, fail)
+        self.wheel.call_later(0.02, self.fire, 'a')
+        self.wheel.call_later(0.05, self.fire, 'b')
+        with self.assertLogs('rpcudp.wheel', 'ERROR'):
+            await asyncio.sleep(0.2)
+        self.assertEqual([name for name, _ in self.fired], ['a', 'b'])
+
+    async def test_stop_drops_pending_timers(self):
+        self.wheel.call_later(0.02, self.fire, 'a')
+        self.wheel.stop()
+        self.assertEqual(len(self.wheel), 0)
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.fired, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+Hashed timing wheel for the many short-lived timers an RPC node keeps.
+
+Every outstanding request, fragment transfer and reassembly needs a timer,
+and almost all of them are cancelled before they fire. Instead of one event
+loop handle per timer, timers are dropped into the slot of the wheel their
+deadline hashes to, and a single loop callback turns the wheel once per
+tick, firing everything that is due in that slot as one batch.
+"""
+import asyncio
+import logging
+import math
+
+LOG = logging.getLogger(__name__)
+
+
+class _Timer:  # pylint: disable=too-few-public-methods
+    """
+    A timer scheduled on a TimingWheel. Cancelling only marks it, it is
+    dropped when the wheel next reaches its slot.
+    """
+    __slots__ = ('callback', 'args', 'rounds', 'cancelled')
+
+    def __init__(self, callback, args, rounds):
+        self.callback = callback
+        self.args = args
+        self.rounds = rounds
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Keep the timer from firing.
+        """
+        self.cancelled = True
+
+
+class TimingWheel:
+    """
+    Timers with a resolution of one tick, fired in batches.
+    """
+    def __init__(self, tick=0.01, size=512):
+        """
+        Create a timing wheel.
+
+        Args:
+            tick (float): Duration of a slot, the resolution of the timers
+            size (int): Number of slots, timers further away than one turn
+                        of the wheel wait for extra rounds in their slot
+        """
+        self._tick = tick
+        self._slots = [[] for _ in range(size)]
+        self._origin = 0
+        self._position = 0
+        self._pending = 0
+        self._handle = None
+
+    def __len__(self):
+        return self._pending
+
+    def call_later(self, delay, callback, *args):
+        """
+        Arrange for callback to be called with args after at least delay
+        seconds, rounded up to the next tick. Returns a cancellable timer.
+        """
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        if self._handle is None:
+            self._origin = now
+            self._position = 0
+            self._handle = loop.call_later(self._tick, self._turn)
+
+        target = math.ceil((now + delay - self._origin) / self._tick)
+        target = max(target, self._position + 1)
+        size = len(self._slots)
+        timer = _Timer(callback, args,
+                       (target - self._position - 1) // size)
+        self._slots[target % size].append(timer)
+        self._pending += 1
+        return timer
+
+    def stop(self):
+        """
+        Drop every pending timer and stop turning the wheel.
+        """
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for slot in self._slots:
+            slot.clear()
+        self._pending = 0
+
+    def _turn(self):
+        loop = asyncio.get_event_loop()
+        due = int((loop.time() - self._origin) / self._tick)
+        size = len(self._slots)
+        while self._position < due and self._pending:
+            self._position += 1
+            index = self._position % size
+            slot = self._slots[index]
+            if not slot:
+                continue
+
+            waiting = []
+            expired = []
+            for timer in slot:
+                if timer.cancelled:
+                    self._pending -= 1
+                elif timer.rounds:
+                    timer.rounds -= 1
+                    waiting.append(timer)
+                else:
+                    self._pending -= 1
+                    expired.append(timer)
+            # callbacks may schedule new timers, possibly into this slot
+            self._slots[index] = waiting
+            for timer in expired:
+                try:
+                    timer.callback(*timer.args)
+                except Exception:  # pylint: disable=broad-except
+                    LOG.exception("timer callback %s failed", timer.callback)
+
+        if not self._pending:
+            self._handle = None
+            return
+        self._position = max(self._position, due)
+        delay = self._origin + (self._position + 1) * self._tick - loop.time()
+        self._handle = loop.call_later(max(delay, 0), self._turn)
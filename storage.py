@@ -1,4 +1,5 @@
 import time
+import bisect
 import pickle
 import operator
 
@@ -39,6 +40,31 @@ class IStorage(ABC):
         Get the iterator for this storage, should yield tuple of (key, value)
         """
 
+    def iter_republish(self, seconds_old):
+        """
+        Return (dkey, key, name, value, hash) tuples, the arguments to
+        Server.set_digest that store again the items older than
+        seconds_old. Storages that cannot tell return nothing.
+        """
+        return []
+
+    def keys_between(self, lower, upper):
+        """
+        Return the keys whose ids, read as big endian integers, are in
+        [lower, upper), in id order.
+        """
+        ids = [int.from_bytes(key, 'big') for key, _ in self]
+        return [key.to_bytes(20, 'big') for key in sorted(ids)
+                if lower <= key < upper]
+
+    def store_args(self, dkey):
+        """
+        Return (dkey, key, name, value, hash) tuples, the arguments to
+        KademliaProtocol.call_store that store what is kept under dkey on
+        another node. Storages that cannot tell return nothing.
+        """
+        return []
+
 class ForgetfulStorage(IStorage):
     def __init__(self, ttl=604800):
         """
@@ -101,6 +127,8 @@ class AwesomeStorage(IStorage):
         self.data_tag = OrderedDict()
         self.data_file = OrderedDict()
         self.max_age = ttl
+        # ids of the keys in data_tag as integers, sorted
+        self.index = []
 
     def __setitem__(self, key, value):
         return IStorage.__setitem__(key,value)
@@ -121,6 +149,7 @@ class AwesomeStorage(IStorage):
             else:
                 s.add(value)
             self.data_tag[dkey] = (time.monotonic(), pickle.dumps(s))
+            bisect.insort(self.index, int.from_bytes(dkey, 'big'))
         dvalue = value
         if hash:
             dvalue = digest(value)
@@ -144,7 +173,9 @@ class AwesomeStorage(IStorage):
 
     def cull(self):
         for _, _ in self.iter_older_than(self.max_age):
-            self.data_tag.popitem(last = False)
+            dkey, _ = self.data_tag.popitem(last = False)
+            long_id = int.from_bytes(dkey, 'big')
+            del self.index[bisect.bisect_left(self.index, long_id)]
 
     def get(self, key, default = None):
         self.cull()
@@ -213,6 +244,37 @@ class AwesomeStorage(IStorage):
         matches = takewhile(lambda r: t >= r[1], zipped)
         return list(map(operator.itemgetter(0,2),matches))
 
+    def iter_republish(self, seconds_old):
+        items = []
+        for dkey, files in self.iter_older_than(seconds_old):
+            items.extend(self._store_args(dkey, files))
+        return items
+
+    def keys_between(self, lower, upper):
+        first = bisect.bisect_left(self.index, lower)
+        last = bisect.bisect_left(self.index, upper, first)
+        return [key.to_bytes(20, 'big') for key in self.index[first:last]]
+
+    def store_args(self, dkey):
+        self.cull()
+        if dkey not in self.data_tag:
+            return []
+        return self._store_args(dkey, self.data_tag[dkey][1])
+
+    def _store_args(self, dkey, files):
+        items = []
+        for file_id in pickle.loads(files):
+            if file_id not in self.data_file:
+                continue
+            f, t, name = pickle.loads(self.data_file[file_id][1])
+            value = pickle.loads(f)
+            # the tag that was hashed into dkey
+            tags = [tag for tag in pickle.loads(t) if digest(tag) == dkey]
+            if tags:
+                items.append((dkey, tags[0], name, value,
+                              digest(value) == file_id))
+        return items
+
     def _triple_iter(self):
         ikeys = self.data_tag.keys()
         it = map(operator.itemgetter(0),self.data_tag.values())
@@ -5,15 +5,18 @@ import storage
 
 from network import Server
 
-# Usage: <python3> <node_ip> <node_port> <bootstrap_node_ip> <bootstrap_node_port>
+# Usage: <python3> <node_ip> <node_port> <bootstrap_node_ip> <bootstrap_node_port> [<bootstrap_node_ip> <bootstrap_node_port> ...]
 
 loop = asyncio.get_event_loop()
 loop.set_debug(True)
 
 server = Server(storage=storage.AwesomeStorage())
 loop.run_until_complete(server.listen(int(sys.argv[2]), sys.argv[1]))
-bootstrap_node = (sys.argv[3], int(sys.argv[4]))
-loop.run_until_complete(server.bootstrap([bootstrap_node]))
+bootstrap_nodes = [(sys.argv[i], int(sys.argv[i + 1]))
+                   for i in range(3, len(sys.argv) - 1, 2)]
+loop.run_until_complete(server.bootstrap(bootstrap_nodes))
+loop.run_until_complete(server.ready.wait())
+print("node ready with %i contacts" % len(server.protocol.router.contacts))
 
 try:
     loop.run_forever()
@@ -0,0 +1,210 @@
+# pylint: disable=missing-docstring
+import asyncio
+import random
+import unittest
+
+from crawling import NodeSpiderCrawl, ValueSpiderCrawl, LookupSession, \
+    LookupTrace, DONE, DEADLINE, BUDGET
+from node import Node
+from routing import RoutingTable
+
+
+class Network:  # pylint: disable=too-many-instance-attributes
+    """
+    Stands in for the protocol of a node in a network of count nodes which
+    all know each other, answering find_node and find_value calls after
+    delay seconds. Dead nodes do not answer, and the others already know
+    it. The nodes in holders return value to find_value.
+    """
+    def __init__(self, count, ksize, seed=22):
+        self.rng = random.Random(seed)
+        self.ksize = ksize
+        self.nodes = [Node(self.rng.getrandbits(160).to_bytes(20, 'big'),
+                           '127.0.0.1', port) for port in range(count)]
+        self.router = RoutingTable(self, ksize, Node(bytes(20)))
+        self.delay = 0.001
+        # ids of the nodes that do not answer, and delays per node id
+        self.dead = set()
+        self.delays = {}
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self.holders = set()
+        self.value = None
+
+    def get_rtt(self, _address):
+        return None
+
+    def closest(self, target, count=None):
+        return sorted(self.nodes, key=target.distance_to)[:count or
+                                                          self.ksize]
+
+    async def call_find_node(self, peer, target):
+        self.calls.append(peer)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delays.get(peer.id, self.delay))
+        finally:
+            self.active -= 1
+        if peer.id in self.dead:
+            return (False, None)
+        alive = [node for node in self.closest(target, len(self.nodes))
+                 if node.id not in self.dead]
+        return (True, [tuple(node) for node in alive[:self.ksize]])
+
+    async def call_find_value(self, peer, target):
+        if peer.id in self.holders:
+            self.calls.append(peer)
+            return (True, {'value': self.value})
+        return await self.call_find_node(peer, target)
+
+    def target(self):
+        return Node(self.rng.getrandbits(160).to_bytes(20, 'big'))
+
+    def start(self, target, count=3):
+        """
+        count peers to start a lookup of target from, far from it.
+        """
+        return sorted(self.nodes, key=target.distance_to)[-count:]
+
+
+class TestNodeSpiderCrawl(unittest.IsolatedAsyncioTestCase):
+    async def test_finds_the_closest_nodes(self):
+        network = Network(200, 8)
+        for _ in range(5):
+            target = network.target()
+            crawl = NodeSpiderCrawl(network, target, network.start(target),
+                                    8, 3)
+            found = await crawl.find()
+            self.assertEqual(found, network.closest(target))
+
+    async def test_keeps_alpha_calls_in_flight(self):
+        network = Network(200, 8)
+        target = network.target()
+        peers = network.start(target)
+        # a slow peer does not hold up the calls to the others
+        network.delays[peers[0].id] = 0.2
+        crawl = NodeSpiderCrawl(network, target, peers, 8, 3)
+        found = await crawl.find()
+        self.assertEqual(found, network.closest(target))
+        self.assertEqual(network.max_active, 3)
+        self.assertEqual(len(set(network.calls)), len(network.calls))
+
+    async def test_failed_peers_are_left_out(self):
+        network = Network(200, 8)
+        target = network.target()
+        closest = network.closest(target, 10)
+        # we only know of dead peers close to the target
+        network.dead = {node.id for node in closest[:2]}
+        crawl = NodeSpiderCrawl(network, target,
+                                closest[:2] + network.start(target, 1), 8, 3)
+        found = await crawl.find()
+        self.assertEqual(found, closest[2:])
+
+
+class TestValueSpiderCrawl(unittest.IsolatedAsyncioTestCase):
+    async def test_finds_the_value(self):
+        network = Network(200, 8)
+        target = network.target()
+        network.holders = {node.id for node in network.closest(target, 3)}
+        network.value = b'value'
+        crawl = ValueSpiderCrawl(network, target, network.start(target), 8, 3)
+        self.assertEqual(await crawl.find(), b'value')
+
+    async def test_missing_value(self):
+        network = Network(200, 8)
+        target = network.target()
+        crawl = ValueSpiderCrawl(network, target, network.start(target), 8, 3)
+        self.assertIsNone(await crawl.find())
+
+
+class TestLookupSession(unittest.IsolatedAsyncioTestCase):
+    async def test_lookups_share_the_calls_in_flight(self):
+        network = Network(200, 8)
+        session = LookupSession(4)
+        targets = [network.target() for _ in range(5)]
+        crawls = [NodeSpiderCrawl(network, target, network.start(target),
+                                  8, 3) for target in targets]
+        found = await asyncio.gather(*map(session.find, crawls))
+        self.assertEqual(found, [network.closest(t) for t in targets])
+        self.assertEqual(network.max_active, 4)
+        self.assertEqual(session.crawls, set())
+
+    async def test_failed_peers_are_skipped(self):
+        network = Network(200, 8)
+        session = LookupSession(4)
+        target = network.target()
+        peers = network.start(target)
+        network.dead = {peers[0].id}
+        for _ in range(2):
+            crawl = NodeSpiderCrawl(network, target, peers, 8, 3)
+            self.assertEqual(await session.find(crawl),
+                             network.closest(target))
+        # the second lookup did not call the peer the first one saw fail
+        self.assertEqual(network.calls.count(peers[0]), 1)
+
+    async def test_nodes_learnt_are_shared(self):
+        network = Network(200, 8)
+        session = LookupSession(4)
+        first, second = (NodeSpiderCrawl(network, target, [], 8, 3)
+                         for target in (network.target(), network.target()))
+        session.crawls.update((first, second))
+        nodes = network.nodes[:5]
+        session.learn(first, nodes, 2)
+        self.assertEqual(len(first.nearest), 0)
+        self.assertEqual(set(second.nearest.get_ids()),
+                         {node.id for node in nodes})
+        self.assertEqual(second.hops[nodes[0].id], 2)
+        # nodes are only passed on the first time any lookup learns them
+        second.nearest.remove([nodes[0].id])
+        session.learn(first, nodes[:1], 3)
+        self.assertNotIn(nodes[0].id, second.nearest.get_ids())
+
+
+class TestLookupBounds(unittest.IsolatedAsyncioTestCase):
+    async def test_deadline(self):
+        network = Network(200, 8)
+        network.delay = 1
+        target = network.target()
+        crawl = NodeSpiderCrawl(network, target, network.start(target), 8, 3,
+                                timeout=0.1)
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        found = await crawl.find()
+        self.assertLess(loop.time() - start, 0.5)
+        self.assertEqual(crawl.outcome, DEADLINE)
+        # what was known when the deadline struck
+        self.assertEqual(len(found), 3)
+
+    async def test_call_budget(self):
+        network = Network(200, 8)
+        target = network.target()
+        crawl = NodeSpiderCrawl(network, target, network.start(target), 8, 3,
+                                max_calls=5)
+        await crawl.find()
+        self.assertEqual(crawl.outcome, BUDGET)
+        self.assertEqual(crawl.calls, 5)
+        self.assertEqual(len(network.calls), 5)
+
+    async def test_trace(self):
+        network = Network(200, 8)
+        target = network.target()
+        peers = network.start(target)
+        network.dead = {peers[0].id}
+        trace = LookupTrace(target)
+        crawl = NodeSpiderCrawl(network, target, peers, 8, 3, trace=trace)
+        await crawl.find()
+        result = trace.as_dict()
+        self.assertEqual(result['outcome'], DONE)
+        self.assertEqual(len(result['calls']), crawl.calls)
+        self.assertEqual(result['failed'], 1)
+        self.assertEqual(result['hops'], 2)
+        # the first answer holds the closest nodes, the calls that follow
+        # only confirm them
+        self.assertLessEqual(result['converged_calls'], 3)
+        self.assertLess(result['converged_calls'], crawl.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,295 @@
+# pylint: disable=missing-docstring,protected-access
+import asyncio
+import os
+import random
+import tempfile
+import time
+import unittest
+
+from crawling import NodeSpiderCrawl, ValueSpiderCrawl
+from network import LookupCache, Server
+from node import Node
+from rpcudp.protocol import BUSY_REPLY
+from storage import ForgetfulStorage
+
+
+def contact(index):
+    return Node(bytes([index]) * 20, '127.0.0.1', index)
+
+
+class RepublishStorage(ForgetfulStorage):
+    def __init__(self, items):
+        super().__init__()
+        self.items = items
+
+    def iter_republish(self, seconds_old):
+        return list(self.items)
+
+
+class RepublishServer(Server):
+    async def _republish(self, item):
+        if item == 'fails':
+            raise RuntimeError("republish fails")
+        return item == 'stored'
+
+
+class SlowRepublishServer(Server):
+    """
+    A server whose republishes never end, remembering their tasks.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.republishing = []
+
+    async def _republish(self, item):
+        self.republishing.append(asyncio.current_task())
+        await asyncio.sleep(10)
+        return True
+
+
+class FailingSeedServer(Server):
+    """
+    A server that cannot reach the seeds on port 1, the second time after
+    a while.
+    """
+    attempts = 0
+
+    async def bootstrap_node(self, addr):
+        if addr[1] == 1:
+            self.attempts += 1
+            if self.attempts > 1:
+                await asyncio.sleep(0.1)
+            raise OSError("seed unreachable")
+        return await super().bootstrap_node(addr)
+
+
+class TestBootstrap(unittest.IsolatedAsyncioTestCase):
+    async def server(self, server_class=Server):
+        server = server_class()
+        await server.listen(0, '127.0.0.1')
+        self.addCleanup(server.stop)
+        port = server.transport.get_extra_info('sockname')[1]
+        return server, ('127.0.0.1', port)
+
+    async def test_failing_seeds_are_skipped(self):
+        errors = []
+        loop = asyncio.get_event_loop()
+        loop.set_exception_handler(lambda _, context: errors.append(context))
+        seed, address = await self.server()
+        server, _ = await self.server(FailingSeedServer)
+
+        # one seed fails before the good one answers, one after
+        with self.assertLogs('network', 'WARNING'):
+            await server.bootstrap([('127.0.0.1', 1), address,
+                                    ('127.0.0.1', 1)])
+            await asyncio.sleep(0.2)
+        self.assertFalse(server.protocol.router.is_new_node(seed.node))
+        self.assertEqual(errors, [])
+
+
+class TestListen(unittest.IsolatedAsyncioTestCase):
+    async def test_bulk_listener_shares_the_udp_port(self):
+        server = Server()
+        await server.listen(0, '127.0.0.1')
+        self.addCleanup(server.stop)
+        port = server.transport.get_extra_info('sockname')[1]
+        bulk = server.protocol._bulk._server.sockets[0].getsockname()
+        self.assertEqual(bulk[1], port)
+
+    async def test_taken_bulk_port_is_left_out(self):
+        taken = await asyncio.start_server(lambda *_: None, '127.0.0.1', 0)
+        self.addCleanup(taken.close)
+        port = taken.sockets[0].getsockname()[1]
+        server = Server()
+        with self.assertLogs('network', 'WARNING'):
+            await server.listen(port, '127.0.0.1')
+        self.addCleanup(server.stop)
+        self.assertFalse(server.protocol._bulk.listening)
+
+
+class StateServer(Server):
+    """
+    A server that counts its revalidations instead of pinging anyone.
+    """
+    revalidations = 0
+
+    async def revalidate(self, concurrency=16):
+        self.revalidations += 1
+        return 0
+
+
+class TestState(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.rng = random.Random(14)
+
+    async def server(self, server=None, contacts=30):
+        server = server or Server()
+        await server.listen(0, '127.0.0.1')
+        self.addCleanup(server.stop)
+        for port in range(1, contacts + 1):
+            node_id = self.rng.getrandbits(160).to_bytes(20, 'big')
+            server.protocol.router.add_contact(
+                Node(node_id, '127.0.0.1', port))
+        return server
+
+    @staticmethod
+    def layout(server):
+        return [(b.range, list(b.nodes), list(b.replacement_nodes))
+                for b in server.protocol.router.buckets]
+
+    async def test_restart_restores_the_table(self):
+        server = await self.server()
+        router = server.protocol.router
+        self.assertGreater(len(router.buckets), 1)
+        oldest = next(iter(router.last_seen))
+        router.last_seen[oldest] -= 100
+        server.protocol.set_rtt(('127.0.0.1', 1), 0.2, 0.05)
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, 'state')
+            server.save_state(fname)
+            restored = StateServer.load_state(fname)
+        await self.server(restored, contacts=0)
+
+        self.assertEqual(restored.node.id, server.node.id)
+        self.assertEqual(self.layout(restored), self.layout(server))
+        self.assertAlmostEqual(
+            restored.protocol.router.last_seen[oldest],
+            router.last_seen[oldest], delta=0.1)
+        self.assertEqual(restored.protocol.get_rtt(('127.0.0.1', 1)),
+                         (0.2, 0.05))
+        self.assertIsNone(restored.protocol.get_rtt(('127.0.0.1', 2)))
+        await asyncio.sleep(0)
+        self.assertEqual(restored.revalidations, 1)
+
+    async def test_revalidate_drops_silent_contacts(self):
+        server = await self.server(contacts=12)
+
+        async def call_ping(node):
+            if node.port % 3 == 0:
+                return (True, node.id)
+            if node.port % 3 == 1:
+                return (False, BUSY_REPLY)
+            return (False, None)
+        server.protocol.call_ping = call_ping
+
+        self.assertEqual(await server.revalidate(concurrency=2), 4)
+        router = server.protocol.router
+        ports = sorted(n.port for n in router.contacts.nodes.values())
+        # busy contacts are alive, only the silent ones are dropped
+        self.assertEqual(ports, [1, 3, 4, 6, 7, 9, 10, 12])
+
+
+class TestLookupCache(unittest.TestCase):
+    def test_put_and_get(self):
+        cache = LookupCache()
+        nodes = [contact(1), contact(2)]
+        cache.put(b'a', nodes)
+        self.assertEqual(cache.get(b'a'), nodes)
+        # callers get a copy
+        cache.get(b'a').append(contact(3))
+        self.assertEqual(cache.get(b'a'), nodes)
+        self.assertIsNone(cache.get(b'b'))
+
+    def test_entries_expire(self):
+        cache = LookupCache(ttl=0.01)
+        cache.put(b'a', [contact(1)])
+        time.sleep(0.02)
+        self.assertIsNone(cache.get(b'a'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.keys_of, {})
+
+    def test_least_recently_used_is_dropped(self):
+        cache = LookupCache(maxsize=2)
+        cache.put(b'a', [contact(1)])
+        cache.put(b'b', [contact(2)])
+        cache.get(b'a')
+        cache.put(b'c', [contact(3)])
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual(cache.get(b'a'), [contact(1)])
+        self.assertEqual(cache.get(b'c'), [contact(3)])
+        self.assertNotIn(contact(2).id, cache.keys_of)
+
+    def test_failed_node_drops_its_entries(self):
+        cache = LookupCache()
+        cache.put(b'a', [contact(1), contact(2)])
+        cache.put(b'b', [contact(2), contact(3)])
+        cache.put(b'c', [contact(3)])
+        cache.node_failed(contact(2))
+        self.assertIsNone(cache.get(b'a'))
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual(cache.get(b'c'), [contact(3)])
+        self.assertEqual(set(cache.keys_of), {contact(3).id})
+
+    def test_disabled(self):
+        cache = LookupCache(maxsize=0)
+        cache.put(b'a', [contact(1)])
+        self.assertIsNone(cache.get(b'a'))
+
+
+class CountingServer(Server):
+    """
+    A server whose lookups take a while and only count themselves.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.crawls = []
+
+    async def _crawl(self, crawl_class, node, nearest, session):
+        self.crawls.append((crawl_class, node.id))
+        await asyncio.sleep(0.05)
+        return [node]
+
+
+class TestSharedLookups(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_lookups_share_one_crawl(self):
+        server = CountingServer()
+        target, other = Node(bytes(20)), Node(bytes([1]) * 20)
+        results = await asyncio.gather(
+            server._find_nodes(target, []),
+            server._find_nodes(target, []),
+            server._find_nodes(other, []),
+            server._lookup(ValueSpiderCrawl, target, []))
+        self.assertEqual(results, [[target], [target], [other], [target]])
+        self.assertEqual(sorted(server.crawls, key=str), sorted([
+            (NodeSpiderCrawl, target.id), (NodeSpiderCrawl, other.id),
+            (ValueSpiderCrawl, target.id)], key=str))
+        self.assertEqual(server.pending_lookups, {})
+        # done lookups are not shared
+        await server._lookup(NodeSpiderCrawl, target, [])
+        self.assertEqual(len(server.crawls), 4)
+
+    async def test_cancelled_caller_does_not_cancel_others(self):
+        server = CountingServer()
+        target = Node(bytes(20))
+        first = asyncio.ensure_future(server._find_nodes(target, []))
+        second = asyncio.ensure_future(server._find_nodes(target, []))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        self.assertEqual(await second, [target])
+        self.assertEqual(len(server.crawls), 1)
+
+
+class TestRefresh(unittest.IsolatedAsyncioTestCase):
+    async def test_only_successful_republishes_count(self):
+        items = ['stored', 'lost', 'fails', 'stored']
+        server = RepublishServer(storage=RepublishStorage(items),
+                                 refresh_interval=0.1)
+        await server.listen(0, '127.0.0.1')
+        self.addCleanup(server.stop)
+        await server.refresh_task
+        _, _, _, republished = server.last_refresh
+        self.assertEqual(republished, 2)
+
+    async def test_stop_cancels_the_running_jobs(self):
+        server = SlowRepublishServer(
+            storage=RepublishStorage(['stored'] * 8), refresh_interval=0.8)
+        await server.listen(0, '127.0.0.1')
+        await asyncio.sleep(0.15)
+        server.stop()
+        await asyncio.sleep(0.01)
+        self.assertTrue(server.republishing)
+        self.assertTrue(all(task.done() for task in server.republishing))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# pylint: disable=missing-docstring
+import pickle
+import random
+import unittest
+
+from node import Node, NodeHeap
+
+
+def random_node(rng, port=None):
+    return Node(rng.getrandbits(160).to_bytes(20, 'big'), '127.0.0.1',
+                port if port is not None else rng.randint(1, 65535))
+
+
+class TestNode(unittest.TestCase):
+    def test_nodes_are_interned(self):
+        node_id = bytes(range(20))
+        node = Node(node_id, '127.0.0.1', 1)
+        self.assertIs(Node(node_id, '127.0.0.1', 1), node)
+        self.assertIsNot(Node(node_id, '127.0.0.1', 2), node)
+        self.assertIs(pickle.loads(pickle.dumps(node)), node)
+
+    def test_distance(self):
+        one = Node(bytes(19) + b'\x05')
+        two = Node(bytes(19) + b'\x03')
+        self.assertEqual(one.distance_to(two), 6)
+        self.assertEqual(one.long_id, 5)
+
+
+class TestNodeHeap(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(21)
+        self.target = random_node(self.rng)
+
+    def brute(self, nodes, count):
+        return sorted(set(nodes), key=self.target.distance_to)[:count]
+
+    def test_keeps_the_closest(self):
+        heap = NodeHeap(self.target, 20)
+        pushed = []
+        for _ in range(10):
+            nodes = [random_node(self.rng) for _ in range(30)]
+            heap.push(nodes)
+            pushed.extend(nodes)
+            self.assertEqual(list(heap), self.brute(pushed, 20))
+        self.assertEqual(len(heap), 20)
+        self.assertEqual(heap.get_ids(), [n.id for n in
+                                          self.brute(pushed, 20)])
+
+    def test_holds_at_most_twice_maxsize(self):
+        heap = NodeHeap(self.target, 5)
+        nodes = [random_node(self.rng) for _ in range(100)]
+        for node in nodes:
+            heap.push(node)
+        self.assertEqual(len(heap.distances), 10)
+        self.assertEqual(len(heap.nodes), 10)
+        self.assertLessEqual(len(heap.uncontacted), 10)
+        # the backups take the place of removed nodes
+        closest = self.brute(nodes, 10)
+        heap.remove([n.id for n in closest[:3]])
+        self.assertEqual(list(heap), closest[3:8])
+        self.assertEqual(heap.popleft(), closest[3])
+
+    def test_duplicates_are_ignored(self):
+        heap = NodeHeap(self.target, 5)
+        node = random_node(self.rng)
+        heap.push([node, node])
+        heap.push(node)
+        self.assertEqual(list(heap), [node])
+        self.assertIn(node, heap)
+        self.assertIs(heap.get_node(node.id), node)
+
+    def test_contacted(self):
+        heap = NodeHeap(self.target, 3)
+        nodes = self.brute([random_node(self.rng) for _ in range(6)], 6)
+        heap.push(nodes)
+        self.assertEqual(heap.get_uncontacted(), nodes[:3])
+        self.assertFalse(heap.have_contacted_all())
+        for node in nodes[:2]:
+            heap.mark_contacted(node)
+        self.assertEqual(heap.get_uncontacted(), nodes[2:3])
+        heap.mark_contacted(nodes[2])
+        # the backups beyond maxsize do not count
+        self.assertTrue(heap.have_contacted_all())
+        self.assertEqual(heap.get_uncontacted(), [])
+
+        # a backup moving up still needs to be contacted
+        heap.remove([nodes[0].id])
+        self.assertEqual(heap.get_uncontacted(), [nodes[3]])
+        # contacted nodes pushed again are not uncontacted
+        heap.remove([nodes[1].id])
+        heap.push(nodes[1])
+        self.assertEqual(heap.get_uncontacted(), [nodes[3]])
+
+    def test_empty(self):
+        heap = NodeHeap(self.target, 3)
+        self.assertIsNone(heap.popleft())
+        self.assertTrue(heap.have_contacted_all())
+        self.assertEqual(list(heap), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
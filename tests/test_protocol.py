@@ -0,0 +1,127 @@
+# pylint: disable=missing-docstring
+import asyncio
+import bisect
+import random
+import unittest
+
+from node import Node
+from protocol import KademliaProtocol
+from rpcudp.protocol import COMPACT_REQUEST
+from storage import ForgetfulStorage
+
+
+class KeyStorage:
+    """
+    Stands in for a storage, holding nothing but sorted keys.
+    """
+    def __init__(self, keys):
+        self.ids = sorted(int.from_bytes(key, 'big') for key in keys)
+
+    def keys_between(self, lower, upper):
+        first = bisect.bisect_left(self.ids, lower)
+        last = bisect.bisect_left(self.ids, upper)
+        return [key.to_bytes(20, 'big') for key in self.ids[first:last]]
+
+    def store_args(self, dkey):
+        return [(dkey,)]
+
+
+class HandoffProtocol(KademliaProtocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handed = {}
+
+    def handoff(self, node, items):
+        self.handed[node.id] = [dkey for dkey, in items]
+
+
+def random_id(rng):
+    return rng.getrandbits(160).to_bytes(20, 'big')
+
+
+class TestWelcome(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(17)
+
+    def expected_handoff(self, protocol, node, keys):
+        """
+        The keys to hand off to node, looking at every key.
+        """
+        expected = []
+        for dkey in keys:
+            keynode = Node(dkey)
+            neighbors = protocol.router.find_neighbors(keynode)
+            if neighbors:
+                last = neighbors[-1].distance_to(keynode)
+                new_node_close = node.distance_to(keynode) < last
+                first = neighbors[0].distance_to(keynode)
+                this_closest = \
+                    protocol.source_node.distance_to(keynode) < first
+            if not neighbors or (new_node_close and this_closest):
+                expected.append(dkey)
+        return sorted(expected)
+
+    def test_handoff_matches_full_scan(self):
+        for contacts in (0, 5, 30, 300):
+            own = Node(random_id(self.rng), '127.0.0.1', 1)
+            # keys around our own id, as stored in a network, and others
+            keys = {(own.long_id ^ self.rng.getrandbits(
+                self.rng.randint(1, 160))).to_bytes(20, 'big')
+                    for _ in range(500)}
+            protocol = HandoffProtocol(own, KeyStorage(keys), 20)
+            for port in range(contacts):
+                protocol.router.add_contact(
+                    Node(random_id(self.rng), '127.0.0.1', port + 2))
+            for port in range(20):
+                if port % 2:
+                    node = Node(random_id(self.rng), '127.0.0.1', port)
+                else:
+                    # close to our own id
+                    node_id = own.long_id ^ self.rng.getrandbits(
+                        self.rng.randint(1, 40))
+                    node = Node(node_id.to_bytes(20, 'big'), '127.0.0.1',
+                                port)
+                if node.id in keys:
+                    # a key is never a node id, leave that case out
+                    continue
+                expected = self.expected_handoff(protocol, node, keys)
+                protocol.welcome_if_new(node)
+                self.assertEqual(protocol.handed.get(node.id, []), expected)
+
+
+class TestStats(unittest.IsolatedAsyncioTestCase):
+    async def protocol(self, node_id):
+        loop = asyncio.get_event_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: KademliaProtocol(Node(node_id), ForgetfulStorage(), 20),
+            local_addr=('127.0.0.1', 0))
+        self.addCleanup(transport.close)
+        port = transport.get_extra_info('sockname')[1]
+        return protocol, Node(node_id, '127.0.0.1', port)
+
+    async def test_stats_round_trip(self):
+        client, _ = await self.protocol(bytes([1]) * 20)
+        server, node = await self.protocol(bytes([2]) * 20)
+        await client.call_ping(node)
+        sent = []
+        send = client.transport.sendto
+
+        def sendto(data, address):
+            sent.append(data)
+            send(data, address)
+        client.transport.sendto = sendto
+
+        result = await client.call_stats(node)
+        self.assertEqual([data[:1] for data in sent], [COMPACT_REQUEST])
+        self.assertTrue(result[0])
+        stats = result[1]
+        self.assertEqual(stats['latency_bounds'],
+                         server.metrics.as_dict()['latency_bounds'])
+        ping = stats['served']['ping']
+        self.assertEqual((ping['count'], ping['ok']), (1, 1))
+        self.assertIsInstance(ping['total_time'], float)
+        self.assertEqual(stats['served']['stats']['outstanding'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
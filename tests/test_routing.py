@@ -0,0 +1,267 @@
+# pylint: disable=missing-docstring
+import asyncio
+import random
+import unittest
+
+import distance
+from node import Node
+from routing import ContactIndex, RoutingTable
+
+
+def random_id(rng):
+    return rng.getrandbits(160).to_bytes(20, 'big')
+
+
+def brute_closest(nodes, target, k):
+    return sorted(nodes, key=lambda n: n.long_id ^ target)[:k]
+
+
+class TestContactIndex(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(12)
+
+    def index_of(self, count):
+        index = ContactIndex()
+        nodes = [Node(random_id(self.rng), '127.0.0.1', i)
+                 for i in range(count)]
+        for node in nodes:
+            index.add(node)
+        return index, nodes
+
+    def test_closest_matches_brute_force(self):
+        for count in (0, 1, 5, 20, 21, 300):
+            index, nodes = self.index_of(count)
+            targets = [self.rng.getrandbits(160) for _ in range(30)]
+            # contact ids themselves, and ids next to them
+            targets += [n.long_id for n in nodes[:10]]
+            targets += [n.long_id ^ 1 for n in nodes[:10]]
+            for target in targets:
+                for k in (1, 3, 20):
+                    self.assertEqual(index.closest(target, k),
+                                     brute_closest(nodes, target, k))
+
+    def test_closest_with_clustered_ids(self):
+        # ids sharing long prefixes, as in the buckets near a node's own id
+        index = ContactIndex()
+        base = self.rng.getrandbits(160)
+        nodes = []
+        for i in range(200):
+            long_id = base ^ self.rng.getrandbits(self.rng.randint(1, 40))
+            if long_id not in index.nodes:
+                node = Node(long_id.to_bytes(20, 'big'), '127.0.0.1', i)
+                nodes.append(node)
+                index.add(node)
+        for _ in range(50):
+            target = base ^ self.rng.getrandbits(self.rng.randint(1, 160))
+            self.assertEqual(index.closest(target, 20),
+                             brute_closest(nodes, target, 20))
+
+    def test_remove(self):
+        index, nodes = self.index_of(50)
+        for node in nodes[:25]:
+            index.remove(node)
+        index.remove(nodes[0])
+        self.assertEqual(len(index), 25)
+        target = self.rng.getrandbits(160)
+        self.assertEqual(index.closest(target, 10),
+                         brute_closest(nodes[25:], target, 10))
+
+    def test_branches(self):
+        index, _ = self.index_of(300)
+        for _ in range(30):
+            target = self.rng.getrandbits(160)
+            expected = 0
+            for long_id in index.ids:
+                expected |= 1 << ((long_id ^ target).bit_length() - 1)
+            self.assertEqual(index.branches(target), expected)
+        self.assertEqual(ContactIndex().branches(target), 0)
+
+    def test_closest_many_matches_closest(self):
+        index, _ = self.index_of(300)
+        targets = [self.rng.getrandbits(160) for _ in range(30)]
+        expected = [index.closest(target, 20) for target in targets]
+        self.assertEqual(index.closest_many(targets, 20), expected)
+        have_numpy = distance.HAVE_NUMPY
+        distance.HAVE_NUMPY = False
+        try:
+            self.assertEqual(index.closest_many(targets, 20), expected)
+        finally:
+            distance.HAVE_NUMPY = have_numpy
+
+
+class PingProtocol:
+    """
+    Stands in for KademliaProtocol, the pings resolving when told to.
+    """
+    def __init__(self):
+        self.pings = []
+        # address -> (srtt, rttvar)
+        self.rtt = {}
+
+    def get_rtt(self, address):
+        return self.rtt.get(address)
+
+    def call_ping(self, node):
+        future = asyncio.get_event_loop().create_future()
+        self.pings.append((node, future))
+        return future
+
+
+class TestRoutingTable(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.rng = random.Random(16)
+        self.protocol = PingProtocol()
+        self.router = RoutingTable(self.protocol, 2,
+                                   Node(random_id(self.rng)))
+
+    def node(self, port=1):
+        return Node(random_id(self.rng), '127.0.0.1', port)
+
+    def test_failures_are_counted_for_contacts_only(self):
+        contact = self.node()
+        self.router.add_contact(contact)
+        stranger = self.node()
+        for _ in range(10):
+            self.assertFalse(self.router.mark_failed(stranger))
+        # the same id at another address is not the contact either
+        moved = Node(contact.id, '127.0.0.1', 2)
+        self.assertFalse(self.router.mark_failed(moved))
+        self.assertEqual(self.router.failures, {})
+
+    def test_contact_is_dropped_after_max_failures(self):
+        contact = self.node()
+        self.router.add_contact(contact)
+        self.assertFalse(self.router.mark_failed(contact))
+        self.assertFalse(self.router.mark_failed(contact))
+        self.assertTrue(self.router.mark_failed(contact))
+        self.assertTrue(self.router.is_new_node(contact))
+        self.assertEqual(self.router.failures, {})
+
+    def test_success_resets_failures(self):
+        contact = self.node()
+        self.router.add_contact(contact)
+        self.router.mark_failed(contact)
+        self.router.mark_failed(contact)
+        self.router.mark_seen(contact)
+        self.assertFalse(self.router.mark_failed(contact))
+        self.assertFalse(self.router.is_new_node(contact))
+
+    def test_neighbourhood_holds_the_ids_closest_to_node(self):
+        for count in (0, 1, 3, 40, 200):
+            router = RoutingTable(self.protocol, 20, Node(random_id(self.rng)))
+            nodes = [self.node(i) for i in range(count)]
+            for node in nodes:
+                router.add_contact(node)
+            contacts = list(router.contacts.nodes.values())
+            own = self.rng.getrandbits(160)
+            lower, upper, mask = router.neighbourhood(
+                Node(own.to_bytes(20, 'big')))
+            # ids around own, ids near contacts and random ones
+            ids = [own ^ self.rng.getrandbits(self.rng.randint(1, 160))
+                   for _ in range(300)]
+            ids += [n.long_id ^ self.rng.getrandbits(8) for n in contacts]
+            ids += [self.rng.getrandbits(160) for _ in range(100)]
+            for long_id in ids:
+                closest = all(own ^ long_id < n.long_id ^ long_id
+                              for n in contacts)
+                inside = lower <= long_id < upper and \
+                    (long_id ^ own) & mask == 0
+                self.assertEqual(inside, closest)
+
+    def test_by_latency_orders_equally_close_contacts_by_rtt(self):
+        target = Node(bytes(20))
+        # two contacts in the farthest bucket of target, two in another
+        far = [Node(bytes([0x80 | i]) + bytes(19), '127.0.0.1', i)
+               for i in range(3)]
+        near = [Node(bytes([0x40 | i]) + bytes(19), '127.0.0.1', 10 + i)
+                for i in range(2)]
+        self.protocol.rtt[('127.0.0.1', 0)] = (2.0, 0.1)
+        self.protocol.rtt[('127.0.0.1', 2)] = (0.01, 0.1)
+        self.protocol.rtt[('127.0.0.1', 10)] = (0.5, 0.1)
+        self.protocol.rtt[('127.0.0.1', 11)] = (0.05, 0.1)
+        ordered = self.router.by_latency(far + near, target)
+        # far[1] was never timed and counts as unknown_rtt
+        self.assertEqual(ordered, [near[1], near[0], far[2], far[1], far[0]])
+
+    async def test_promotion_follows_bucket_splits(self):
+        bucket = self.router.buckets[0]
+        nodes = [self.node() for _ in range(4)]
+        for node in nodes:
+            bucket.add_node(node)
+        self.assertEqual(len(bucket.replacement_nodes), 2)
+
+        self.router.remove_contact(nodes[0])
+        await asyncio.sleep(0)
+        self.assertEqual(len(self.protocol.pings), 1)
+        candidate, ping = self.protocol.pings[0]
+        self.assertEqual(candidate, nodes[3])
+        # the split moves the other replacement into a bucket with room
+        self.router.split_bucket(0)
+        ping.set_result((False, None))
+        await asyncio.sleep(0)
+        self.assertEqual(len(self.protocol.pings), 1)
+        self.assertFalse(self.router.is_new_node(nodes[2]))
+
+
+class TestSnapshot(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.rng = random.Random(18)
+        self.own = Node(random_id(self.rng))
+
+    def table(self, count):
+        router = RoutingTable(PingProtocol(), 3, self.own)
+        for port in range(count):
+            router.add_contact(Node(random_id(self.rng), '127.0.0.1', port))
+        # contacts and buckets of different ages
+        for age, node_id in enumerate(router.last_seen):
+            router.last_seen[node_id] -= age
+        for age, bucket in enumerate(router.buckets):
+            bucket.last_updated -= 10 * age
+        return router
+
+    @staticmethod
+    def layout(router):
+        return [(b.range, set(b.nodes), set(b.replacement_nodes))
+                for b in router.buckets]
+
+    async def test_round_trip_keeps_the_layout(self):
+        router = self.table(60)
+        self.assertGreater(len(router.buckets), 1)
+        self.assertTrue(any(b.replacement_nodes for b in router.buckets))
+        restored = RoutingTable(PingProtocol(), 3, self.own)
+        restored.load_snapshot(router.snapshot())
+
+        self.assertEqual(self.layout(restored), self.layout(router))
+        self.assertEqual(restored.bounds, router.bounds)
+        self.assertEqual(set(restored.contacts.nodes),
+                         set(router.contacts.nodes))
+        for node_id, seen in router.last_seen.items():
+            self.assertAlmostEqual(restored.last_seen[node_id], seen,
+                                   delta=0.1)
+        for bucket, other in zip(restored.buckets, router.buckets):
+            self.assertAlmostEqual(bucket.last_updated, other.last_updated,
+                                   delta=0.1)
+
+    async def test_gaps_fall_back_to_adding_contacts(self):
+        router = self.table(60)
+        snapshot = router.snapshot()
+        del snapshot[0]
+        restored = RoutingTable(PingProtocol(), 3, self.own)
+        with self.assertLogs('routing', 'WARNING'):
+            restored.load_snapshot(snapshot)
+
+        self.assertEqual(restored.bounds[-1], 2 ** 160 - 1)
+        self.assertEqual(restored.bounds,
+                         [b.range[1] for b in restored.buckets])
+        saved = {node_id for bucket in snapshot
+                 for node_id, _, _, _ in bucket[3] + bucket[4]}
+        contacts = {n.id for n in restored.contacts.nodes.values()}
+        self.assertTrue(contacts)
+        self.assertTrue(contacts <= saved)
+        for node_id in contacts:
+            self.assertAlmostEqual(restored.last_seen[node_id],
+                                   router.last_seen[node_id], delta=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()